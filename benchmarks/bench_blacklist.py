@@ -0,0 +1,33 @@
+"""Compares the old per-rule blacklist loop with the compiled Blacklist.
+
+Run from the repo's root:
+    python3 -m benchmarks.bench_blacklist
+"""
+import random
+import timeit
+
+from src.parse import Blacklist, BlacklistedTag
+
+def main(rules_count: int = 5000, posts_count: int = 1000, tags_per_post: int = 30):
+    random.seed(0)
+    vocabulary = [f'tag_{i}' for i in range(20000)]
+    config = [[tag, random.sample(vocabulary, 2)] for tag in random.sample(vocabulary, rules_count)]
+    posts = [random.sample(vocabulary, tags_per_post) for _ in range(posts_count)]
+
+    blacklisted_tags = [BlacklistedTag.fromauto(rule) for rule in config]
+    def old_check():
+        for tags in posts:
+            tags = set(tags)
+            any(not bl_tag.check(tags) for bl_tag in blacklisted_tags)
+    blacklist = Blacklist.compile(config)
+    def new_check():
+        for tags in posts:
+            blacklist.matches(tags)
+
+    print(f"{rules_count} rules, {posts_count} posts with {tags_per_post} tags")
+    for name, func in (('per-rule loop', old_check), ('compiled index', new_check)):
+        best = min(timeit.repeat(func, repeat=3, number=1))
+        print(f"{name:<16}{best / posts_count * 1e6:>10.1f} us/post")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""Compares per-image cost of the old hash db usage (hex TEXT hashes,
+a commit per SELECT/UPDATE and INSERT) with the batched check_and_add_many
+on the WAL database.
+
+Run from the repo's root:
+    python3 -m benchmarks.bench_hash_db
+"""
+from tempfile import TemporaryDirectory
+from pathlib import Path
+from time import perf_counter
+import random
+import sqlite3
+
+from src.dublicate_checker import DublicateChecker, ImageHashes
+
+def old_check(db_file: Path, posts) -> float:
+    con = sqlite3.connect(db_file)
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS img_hashes (
+            img_hash TEXT PRIMARY KEY,
+            source_link TEXT,
+            matches INT DEFAULT 0 NOT NULL
+        )
+    """)
+    con.commit()
+    started = perf_counter()
+    for post in posts:
+        new_hashes = []
+        for img_hash, url in post:
+            hash_str = f"{img_hash:016x}"
+            found = con.execute("SELECT 1 FROM img_hashes WHERE img_hash = ?", (hash_str, )).fetchall()
+            if found:
+                con.execute("UPDATE img_hashes SET matches = matches + 1 WHERE img_hash = ?", (hash_str, ))
+                con.commit()
+            else:
+                new_hashes.append((hash_str, url))
+        for hash_str, url in new_hashes:
+            con.execute("INSERT OR IGNORE INTO img_hashes(img_hash, source_link) VALUES(?,?)", (hash_str, url))
+            con.commit()
+    elapsed = perf_counter() - started
+    con.close()
+    return elapsed
+
+def new_check(db_file: Path, posts) -> float:
+    checker = DublicateChecker(db_file=str(db_file))
+    checker.index
+    started = perf_counter()
+    for post in posts:
+        checker.check_and_add_many((ImageHashes(img_hash), url) for img_hash, url in post)
+    return perf_counter() - started
+
+def main(posts_count: int = 500, images_per_post: int = 4, dublicate_share: float = 0.2):
+    random.seed(0)
+    posts, known = [], []
+    for i in range(posts_count):
+        post = []
+        for j in range(images_per_post):
+            if known and random.random() < dublicate_share:
+                img_hash = random.choice(known)
+            else:
+                img_hash = random.getrandbits(64)
+                known.append(img_hash)
+            post.append((img_hash, f"https://cdn.donmai.us/sample/{i}_{j}.jpg"))
+        posts.append(post)
+    images = posts_count * images_per_post
+
+    print(f"{posts_count} posts with {images_per_post} images, {dublicate_share:.0%} dublicates")
+    with TemporaryDirectory() as tmp_dir:
+        for name, check in (('old per-image commits', old_check), ('check_and_add_many', new_check)):
+            elapsed = check(Path(tmp_dir).joinpath(f"{check.__name__}.db"), posts)
+            print(f"{name:<24}{elapsed / images * 1e3:>8.3f} ms/image")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""Measures the hash index with a million stored hashes: its memory, how
+long it takes to build it from the db and to load it from the snapshot
+on start, and the cost of checking a new image by the index compared
+with a db query per image. The db query only finds identical hashes,
+the index also finds hashes within max_hamming_distance bits.
+
+Run from the repo's root:
+    python3 -m benchmarks.bench_hash_index
+"""
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from pathlib import Path
+import tracemalloc
+import random
+import sqlite3
+
+from src.dublicate_checker import DublicateChecker, HashIndex
+from src.dublicate_checker.checker import to_db_hash
+
+def dict_index_bytes(hashes) -> int:
+    """Memory of the index as a set and dicts of lists, like it was before numpy"""
+    tracemalloc.start()
+    index_set = set(hashes)
+    tables = [{} for _ in range(4)]
+    for img_hash in hashes:
+        for i, table in enumerate(tables):
+            table.setdefault((img_hash >> (i * 16)) & 0xffff, []).append(img_hash)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del index_set, tables
+    return size
+
+def fill_db(db_file: Path, hashes) -> None:
+    DublicateChecker(db_file=str(db_file)).con.close()
+    con = sqlite3.connect(db_file)
+    with con:
+        con.executemany(
+            "INSERT INTO image_hashes(img_hash, source_link) VALUES(?,?)",
+            ((to_db_hash(img_hash), f"https://cdn.donmai.us/sample/{i}.jpg") for i, img_hash in enumerate(hashes))
+        )
+    con.close()
+
+def main(stored: int = 1_000_000, queries: int = 2000):
+    random.seed(0)
+    hashes = [random.getrandbits(64) for _ in range(stored)]
+    new_hashes = [random.getrandbits(64) for _ in range(queries)]
+    print(f"{stored} stored hashes")
+    print(f"set and dicts index  {dict_index_bytes(hashes) / 2**20:>8.1f} MB")
+    print(f"numpy index          {HashIndex(4, hashes).nbytes / 2**20:>8.1f} MB")
+
+    with TemporaryDirectory() as tmp_dir:
+        db_file = Path(tmp_dir).joinpath('image_hashes.db')
+        fill_db(db_file, hashes)
+        for name in ('start, build from db', 'start, load snapshot'):
+            checker = DublicateChecker(db_file=str(db_file))
+            started = perf_counter()
+            index = checker.index
+            print(f"{name:<21}{perf_counter() - started:>8.2f} s")
+
+        started = perf_counter()
+        for img_hash in new_hashes:
+            checker.con.execute(
+                "SELECT 1 FROM image_hashes WHERE img_hash = ?", (to_db_hash(img_hash), )
+            ).fetchall()
+        print(f"new image, exact, db {(perf_counter() - started) / queries * 1e6:>8.1f} us")
+        started = perf_counter()
+        for img_hash in new_hashes:
+            img_hash in index
+        print(f"new image, exact     {(perf_counter() - started) / queries * 1e6:>8.1f} us")
+        started = perf_counter()
+        for img_hash in new_hashes:
+            index.within(img_hash)
+        print(f"new image, {index.max_distance} bits    {(perf_counter() - started) / queries * 1e6:>8.1f} us")
+
+if __name__ == '__main__':
+    main()
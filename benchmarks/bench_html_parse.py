@@ -0,0 +1,59 @@
+"""Compares Danbooru page parsing time and peak memory of the full
+BeautifulSoup tree (old way) and the restricted fast extraction.
+
+Run from the repo's root:
+    python3 -m benchmarks.bench_html_parse
+"""
+from typing import Callable, Tuple
+from pathlib import Path
+from bs4 import BeautifulSoup
+import tracemalloc
+import timeit
+
+import src.parse.danbooru as danbooru
+from src.parse import DanbooruParser
+
+fixtures_dir = Path(__file__).parent.parent.joinpath('tests', 'parsers', 'fixtures')
+
+def measure(func: Callable[[], object], repeat: int = 5, number: int = 20) -> Tuple[float, int]:
+    """Returns best time per call in ms and peak memory in bytes"""
+    best = min(timeit.repeat(func, repeat=repeat, number=number)) / number
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best * 1000, peak
+
+def with_features(features: str, func: Callable[[], object]) -> Callable[[], object]:
+    def wrapper():
+        old_features = danbooru.soup_features
+        danbooru.soup_features = features
+        try:
+            return func()
+        finally:
+            danbooru.soup_features = old_features
+    return wrapper
+
+def main():
+    post_html = fixtures_dir.joinpath('danbooru_post_page.html').read_text(encoding='utf-8')
+    search_html = fixtures_dir.joinpath('danbooru_search_page.html').read_text(encoding='utf-8')
+    cases = {
+        'post page, full html.parser tree': lambda: DanbooruParser.post_from_soup(
+            BeautifulSoup(post_html, features="html.parser")),
+        'post page, restricted html.parser': with_features(
+            "html.parser", lambda: DanbooruParser.parse_post_html(post_html)),
+        'search page, full html.parser tree': lambda: DanbooruParser.previews_from_search_soup(
+            BeautifulSoup(search_html, features="html.parser")),
+        'search page, restricted html.parser': with_features(
+            "html.parser", lambda: DanbooruParser.parse_search_html(search_html)),
+    }
+    if danbooru.soup_features == "lxml":
+        cases['post page, restricted lxml'] = lambda: DanbooruParser.parse_post_html(post_html)
+        cases['search page, restricted lxml'] = lambda: DanbooruParser.parse_search_html(search_html)
+    print(f"{'case':<40}{'ms/page':>10}{'peak KiB':>12}")
+    for name, func in sorted(cases.items()):
+        ms, peak = measure(func)
+        print(f"{name:<40}{ms:>10.2f}{peak / 1024:>12.0f}")
+
+if __name__ == '__main__':
+    main()
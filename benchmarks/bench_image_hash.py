@@ -0,0 +1,43 @@
+"""Compares hashing time of imagehash.average_hash on a fully decoded
+image (old way) with hash_image_file, which decodes jpeg at a reduced
+scale once and computes aHash, dHash and pHash from it.
+
+Run from the repo's root:
+    python3 -m benchmarks.bench_image_hash
+"""
+from PIL import Image, ImageDraw
+from io import BytesIO
+import imagehash
+import random
+import timeit
+
+from src.dublicate_checker import hash_image_file
+
+def make_jpeg(width: int, height: int) -> bytes:
+    random.seed(0)
+    img = Image.new('RGB', (width, height), (200, 40, 40))
+    draw = ImageDraw.Draw(img)
+    for _ in range(20):
+        x, y = random.randrange(width), random.randrange(height)
+        draw.ellipse([x, y, x + width // 4, y + height // 4],
+                     fill=tuple(random.randrange(256) for _ in range(3)))
+    buffer = BytesIO()
+    img.save(buffer, 'JPEG', quality=90)
+    return buffer.getvalue()
+
+def main(sizes=((180, 180), (850, 1200), (2000, 3000), (4000, 6000)), number: int = 5):
+    for width, height in sizes:
+        data = make_jpeg(width, height)
+        def old_hash():
+            with Image.open(BytesIO(data)) as img:
+                imagehash.average_hash(img)
+        def new_hash():
+            hash_image_file(BytesIO(data))
+        old = min(timeit.repeat(old_hash, repeat=3, number=number)) / number
+        new = min(timeit.repeat(new_hash, repeat=3, number=number)) / number
+        size = f"{width}x{height}"
+        print(f"{size:<10} aHash full decode {old * 1e3:>8.1f} ms, "
+              f"aHash+dHash+pHash draft decode {new * 1e3:>6.1f} ms")
+
+if __name__ == '__main__':
+    main()
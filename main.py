@@ -3,15 +3,22 @@ logging.basicConfig(format='[%(asctime)s] [%(levelname)s %(name)s] %(message)s',
                     datefmt='%Y-%m-%d %H:%M:%S',
                     level=logging.INFO)
 
-from src.manager import PostManager
-from src.parse import DanbooruParser, BlacklistedTag as BTag
+from src.startup import startup_timer
+
+with startup_timer.phase("import src.manager"):
+    from src.manager import PostManager
+with startup_timer.phase("import src.parse"):
+    from src.parse import DanbooruParser, BlacklistedTag as BTag
 
 logger = logging.getLogger(__name__)
 
 def main():
-    dp = DanbooruParser()
-    post_manager = PostManager()
+    with startup_timer.phase("init DanbooruParser"):
+        dp = DanbooruParser()
+    with startup_timer.phase("init PostManager"):
+        post_manager = PostManager()
     post_manager.add_parser(dp)
+    logger.info(startup_timer.report())
     post_manager.main_loop()
 
 if __name__ == '__main__':
@@ -4,9 +4,20 @@ config_dir = Path("config")
 data_dir = Path("data")
 log_dir = Path("log")
 
-if not config_dir.is_dir():
-    raise FileNotFoundError(f'Config dir is missing: {config_dir}')
-if not data_dir.is_dir():
-    data_dir.mkdir()
-if not log_dir.is_dir():
-    log_dir.mkdir()
+def ensure_dir(path: Path) -> Path:
+    """Creates a directory if it is missing. Directories are created
+    by modules that write into them instead of at import time
+
+    Args:
+        path (Path): directory path
+
+    Raises:
+        FileNotFoundError: if config dir is missing, it can't be created empty
+
+    Returns:
+        Path: the same path
+    """
+    if path == config_dir and not path.is_dir():
+        raise FileNotFoundError(f'Config dir is missing: {config_dir}')
+    path.mkdir(parents=True, exist_ok=True)
+    return path
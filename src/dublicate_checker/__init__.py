@@ -1 +1,4 @@
-from .checker import DublicateChecker
\ No newline at end of file
+from .checker import DublicateChecker, HashMatch, UrlVerdict, format_hash
+from .hash_index import HashIndex
+from .hashing import ImageHashes, hash_image, hash_image_file
+from .batch import DedupeStage
\ No newline at end of file
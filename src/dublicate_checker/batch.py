@@ -0,0 +1,184 @@
+from typing import Deque, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from collections import deque
+from threading import Lock
+import multiprocessing
+import logging
+import os
+
+from src.parse import Post
+from src.request_utils import (
+    strip_args_from_url, download_photo_to_memory,
+    CircuitOpenError, MAX_CONCURRENT_REQUESTS
+)
+from .checker import DublicateChecker, HashMatch, UrlVerdict, format_hash
+from .hashing import ImageHashes, hash_image_bytes
+
+logger = logging.getLogger("DublicateChecker")
+
+class DedupeStage:
+    """Removes dublicate images from a stream of posts.
+
+    Images are downloaded and hashed in a thread pool. PIL releases the
+    GIL while decoding and resizing, so threads hash images in parallel
+    without the cost of starting processes. A process pool is only used
+    when `hash_workers` is set, it is started on the first downloaded image.
+    Database checks and inserts are done in the calling thread in post
+    order, so dublicates between posts of the same batch are found the
+    same way as if posts were checked one by one.
+
+    Posts' preview urls are hashed instead of their media when parser
+    knows them, media url is still stored as the hash's source link. If a
+    preview can't be downloaded or decoded, the media itself is hashed.
+    Media urls that were checked before are dublicates without downloading
+    them again: the image was either a dublicate then or it was kept and
+    posted. Images with a known platform digest are dublicates without
+    downloading them too.
+    """
+    def __init__(
+        self,
+        checker: DublicateChecker,
+        download_workers: int = MAX_CONCURRENT_REQUESTS,
+        hash_workers: Optional[int] = 0
+    ) -> None:
+        """
+        Args:
+            checker (DublicateChecker): checker with the hash database
+            download_workers (int, optional): concurrent downloads. Defaults to MAX_CONCURRENT_REQUESTS.
+            hash_workers (Optional[int], optional): hashing processes, 0 hashes in download threads,
+                None uses cpu count processes (no processes on a single core). Defaults to 0.
+        """
+        self.checker = checker
+        self.download_workers = download_workers
+        if hash_workers is None:
+            hash_workers = os.cpu_count() or 1
+            hash_workers = hash_workers if hash_workers > 1 else 0
+        self.hash_workers = hash_workers
+        # posts waiting for their hashes, bigger queue keeps more downloads in flight
+        self.max_pending_posts = 2 * download_workers
+        self.__download_pool: Optional[ThreadPoolExecutor] = None
+        self.__hash_pool: Optional[Executor] = None
+        self.__hash_pool_lock = Lock()
+
+    def __enter__(self) -> 'DedupeStage':
+        self.__download_pool = ThreadPoolExecutor(max_workers=self.download_workers)
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.__download_pool.shutdown(wait=True, cancel_futures=True)
+        if self.__hash_pool is not None:
+            self.__hash_pool.shutdown(wait=True, cancel_futures=True)
+        self.__download_pool, self.__hash_pool = None, None
+        # hashes of this update are saved, so the next start loads them at once
+        self.checker.save_index_snapshot()
+
+    def filter_posts(self, posts: Iterable[Post]) -> Iterator[Post]:
+        """Yields posts without dublicate images in the same order.
+
+        Args:
+            posts (Iterable[Post]): posts to check
+
+        Yields:
+            Post: post without dublicate images, it may have no images left
+        """
+        pending: Deque[Tuple[Post, List[Tuple[str, Future]]]] = deque()
+        for post in posts:
+            pending.append((post, self.__submit(post)))
+            # reducing finished posts early, waiting only when the queue is full
+            while pending and (len(pending) > self.max_pending_posts or self.__is_hashed(pending[0][1])):
+                yield self.__reduce(*pending.popleft())
+        while pending:
+            yield self.__reduce(*pending.popleft())
+
+    def __submit(self, post: Post) -> List[Tuple[str, Future]]:
+        urls = [
+            (url, hash_url)
+            for url, hash_url in zip(post.media_urls, post.hash_urls())
+            if strip_args_from_url(url).endswith(self.checker.allowed_formats)
+        ]
+        verdicts = self.checker.remembered_verdicts(url for url, _ in urls)
+        digests = self.__digests(post)
+        digest_matches = self.checker.match_digests(
+            digests[url] for url, _ in urls if url not in verdicts and digests.get(url)
+        )
+        images = []
+        for url, hash_url in urls:
+            known = verdicts.get(url) or digest_matches.get(digests.get(url))
+            if known is not None:
+                future = Future()
+                future.set_result(known)
+            else:
+                future = self.__download_pool.submit(self.__download_and_hash, url, hash_url)
+            images.append((url, future))
+        return images
+
+    def __download_and_hash(self, url: str, hash_url: str) -> ImageHashes:
+        if hash_url != url:
+            try:
+                return self.__hash_download(hash_url)
+            # previews may be missing for some files, the image itself is hashed then
+            except (ValueError, OSError) as e:
+                logger.info(f"Preview failed, hashing {url} instead. {e}")
+        return self.__hash_download(url)
+
+    def __hash_download(self, url: str) -> ImageHashes:
+        with download_photo_to_memory(url, max_bytes=self.checker.max_image_bytes) as buffer:
+            data = buffer.getvalue()
+        if self.hash_workers == 0:
+            return hash_image_bytes(data)
+        return self.__get_hash_pool().submit(hash_image_bytes, data).result()
+
+    def __get_hash_pool(self) -> Executor:
+        # updates without new images don't spawn processes at all
+        with self.__hash_pool_lock:
+            if self.__hash_pool is None:
+                # workers are spawned, forking a process with running threads is unsafe
+                self.__hash_pool = ProcessPoolExecutor(
+                    max_workers=self.hash_workers,
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+            return self.__hash_pool
+
+    @staticmethod
+    def __digests(post: Post) -> Dict[str, Optional[str]]:
+        return dict(zip(post.media_urls, post.digests)) if post.digests is not None else {}
+
+    @staticmethod
+    def __is_hashed(images: List[Tuple[str, Future]]) -> bool:
+        return all(future.done() for _, future in images)
+
+    def __reduce(self, post: Post, images: List[Tuple[str, Future]]) -> Post:
+        hashes: List[Tuple[ImageHashes, str]] = []
+        dublicates = set()
+        for url, future in images:
+            try:
+                result: Union[ImageHashes, UrlVerdict, HashMatch] = future.result()
+            # requests' exceptions and unreadable images are OSErrors, too large images are ValueErrors,
+            # the image is posted unchecked instead of failing the whole update
+            except (CircuitOpenError, ValueError, OSError) as e:
+                logger.warning(f"Skipping dublicate check of {url}. {e}")
+                continue
+            if isinstance(result, UrlVerdict):
+                first_verdict = 'dublicate' if result.match is not None else 'new'
+                logger.info(f"Got dublicate by url, it was {first_verdict} when checked first. Url: {url}")
+                dublicates.add(url)
+            elif isinstance(result, HashMatch):
+                logger.info(f"Got dublicate by digest. Url: {url}; Matched {format_hash(result.img_hash)} of {result.source_link}")
+                dublicates.add(url)
+            else:
+                hashes.append((result, url))
+        # checking and adding new hashes to the db at once
+        digests = self.__digests(post)
+        matches = self.checker.check_and_add_many(hashes, digests=[digests.get(url) for _, url in hashes])
+        for (photo_hash, url), match in zip(hashes, matches):
+            if match is not None:
+                logger.info(
+                    f"Got dublicate. Hash: {format_hash(photo_hash.ahash)}; Url: {url}; "
+                    f"Matched {format_hash(match.img_hash)} (distance {match.distance}) of {match.source_link}"
+                )
+                dublicates.add(url)
+            else:
+                logger.info(f"Not a dublicate. Hash: {format_hash(photo_hash.ahash)}; Url: {url}")
+        if len(dublicates) == 0:
+            return post
+        return post.without_media(dublicates)
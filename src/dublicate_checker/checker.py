@@ -1,89 +1,491 @@
-from secrets import token_hex
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+from dataclasses import dataclass
 from pathlib import Path
-from typing import List
-from PIL import Image
 from json import load
-import imagehash
+from time import time
 import logging
 import sqlite3
+import os
 
-from src.request_utils import strip_args_from_url, download_photo
-from src.config import data_dir, config_dir
+from src.request_utils import strip_args_from_url, download_photo_to_memory
+from src.config import data_dir, config_dir, ensure_dir
+from .hash_index import HashIndex, bytes_per_hash
+from .hashing import ImageHashes, hash_image_file
 
 parent_dir = Path(__file__).parent
 
 logger = logging.getLogger("DublicateChecker")
 
+def to_db_hash(img_hash: Optional[int]) -> Optional[int]:
+    """Converts unsigned 64 bit hash into sqlite's signed integer"""
+    if img_hash is None:
+        return None
+    return img_hash - (1 << 64) if img_hash >= (1 << 63) else img_hash
+
+def from_db_hash(db_hash: Optional[int]) -> Optional[int]:
+    if db_hash is None:
+        return None
+    return db_hash + (1 << 64) if db_hash < 0 else db_hash
+
+def format_hash(img_hash: int) -> str:
+    return f"{img_hash:016x}"
+
+@dataclass(frozen=True)
+class HashMatch:
+    """Stored hash that is close enough to a checked one"""
+    img_hash: int
+    distance: int
+    source_link: Optional[str]
+    # row of the stored image, None in remembered verdicts
+    image_id: Optional[int] = None
+
+@dataclass(frozen=True)
+class UrlVerdict:
+    """Result of the first check of a media url"""
+    hashes: ImageHashes
+    # None if the image was new
+    match: Optional[HashMatch]
+
 class DublicateChecker:
-    def __init__(self, config_file: str = 'dublicate_checker_conf.json') -> None:
-        with open(config_dir.joinpath(config_file), 'r', encoding = 'utf-8') as f:
+    # schema version stored in PRAGMA user_version
+    schema_version = 3
+
+    def __init__(
+        self,
+        config_file: str = 'dublicate_checker_conf.json',
+        db_file: str = 'image_hashes.db'
+    ) -> None:
+        """Loads configuration, database is opened on the first use.
+
+        Args:
+            config_file (str, optional): file name relative to config_dir. Defaults to 'dublicate_checker_conf.json'.
+            db_file (str, optional): file name relative to data_dir. Defaults to 'image_hashes.db'.
+        """
+        with open(ensure_dir(config_dir).joinpath(config_file), 'r', encoding = 'utf-8') as f:
             self.config = load(f)
         
         self.allowed_formats = tuple(self.config['allowed_formats'])
+        # bigger images are not downloaded at all
+        self.max_image_bytes = self.config.get('max_image_bytes')
+        # hashes that differ in up to this many bits are dublicates
+        self.max_hamming_distance = self.config.get('max_hamming_distance', 0)
+        if not isinstance(self.max_hamming_distance, int) or not 0 <= self.max_hamming_distance < 64:
+            raise ValueError(f"Invalid max_hamming_distance value")
+        # dHash and pHash of an aHash match must be this close too, if they are known
+        self.max_confirm_distance = self.config.get('max_confirm_distance', 10)
+        if not isinstance(self.max_confirm_distance, int) or not 0 <= self.max_confirm_distance < 64:
+            raise ValueError(f"Invalid max_confirm_distance value")
+        # hashes that don't fit into the index are only matched exactly by the db
+        self.max_indexed_hashes = self.config.get('index_memory_budget', 64_000_000) // bytes_per_hash
 
-        self.__db_file = data_dir.joinpath('image_hashes.db')
+        self.__db_file = data_dir.joinpath(db_file)
+        self.__snapshot_file = self.__db_file.with_name(f'{self.__db_file.stem}.index.npz')
         self.__init_script = parent_dir.joinpath('init.sql')
-        self.__tmp_dir = parent_dir.joinpath('tmp')
 
-        self.con = sqlite3.connect(self.__db_file)
-        self._init_db()
-        logger.info(f'Connected to {self.__db_file}')
-        
-        if not self.__tmp_dir.is_dir():
-            self.__tmp_dir.mkdir()
-        for f in self.__tmp_dir.iterdir():
-            f.unlink()
+        self.__con: Optional[sqlite3.Connection] = None
+        self.__index: Optional[HashIndex] = None
+        # whether every stored hash is in the index
+        self.__index_complete = True
 
-    def hash_exists(self, hash_str: str) -> bool:
-        cur = self.con.cursor()
-        cur.execute("""
-            SELECT 1 FROM img_hashes WHERE img_hash = ?
-        """, (hash_str, ))
-        result = cur.fetchall()
-        logger.debug(f"Hash {hash_str} returned {result}")
-        if len(result) != 0:
-            cur.execute("""
-                UPDATE img_hashes
-                SET matches = matches + 1
-                WHERE img_hash = ?
-            """, (hash_str, ))
-            self.con.commit()
-        return len(result) != 0
-
-    def add_hash(self, hash_str: str, source_url: str = None) -> None:
-        cur = self.con.cursor()
-        cur.execute("""
-            INSERT OR IGNORE INTO img_hashes(img_hash, source_link)
-            VALUES(?,?)
-        """, (hash_str, source_url))
-        self.con.commit()
-        logger.info(f"Added hash {hash_str}")
+    @property
+    def con(self) -> sqlite3.Connection:
+        """Database connection, it is opened on the first use"""
+        if self.__con is None:
+            ensure_dir(data_dir)
+            self.__con = sqlite3.connect(self.__db_file)
+            self._init_db()
+            logger.info(f'Connected to {self.__db_file}')
+        return self.__con
+
+    @property
+    def index(self) -> HashIndex:
+        """Near dublicate index of stored hashes.
+
+        It is loaded from the snapshot file on the first use, or built from
+        the db if the snapshot is missing or outdated.
+        """
+        if self.__index is None:
+            stamp = self.__db_stamp()
+            expected_size = min(stamp['count'], self.max_indexed_hashes)
+            self.__index_complete = stamp['count'] <= self.max_indexed_hashes
+            self.__index = self.__load_snapshot(stamp, expected_size)
+            if self.__index is None:
+                rows = self.con.execute("""
+                    SELECT DISTINCT img_hash FROM image_hashes LIMIT ?
+                """, (expected_size, )).fetchall()
+                self.__index = HashIndex(
+                    max_distance=self.max_hamming_distance,
+                    hashes=(from_db_hash(img_hash) for img_hash, in rows)
+                )
+                logger.info(f"Indexed {len(self.__index)} hashes")
+                self.save_index_snapshot()
+            if not self.__index_complete:
+                logger.warning(
+                    f"Only {len(self.__index)} of {stamp['count']} hashes fit into index_memory_budget, "
+                    "the rest are only matched exactly"
+                )
+        return self.__index
+
+    def save_index_snapshot(self) -> None:
+        """Saves the index so the next start doesn't build it from the db"""
+        if self.__index is None:
+            return
+        tmp_file = self.__snapshot_file.with_name(f'{self.__snapshot_file.stem}.tmp.npz')
+        self.__index.save(tmp_file, **self.__db_stamp())
+        os.replace(tmp_file, self.__snapshot_file)
+        logger.debug(f"Saved index of {len(self.__index)} hashes ({self.__index.nbytes} bytes) to {self.__snapshot_file}")
+
+    def __load_snapshot(self, stamp: Dict[str, int], expected_size: int) -> Optional[HashIndex]:
+        if not self.__snapshot_file.is_file():
+            return None
+        try:
+            index, metadata = HashIndex.load(self.__snapshot_file, self.max_hamming_distance)
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Can't load index snapshot {self.__snapshot_file}. {e}")
+            return None
+        # the snapshot is outdated if hashes were changed without saving it
+        if metadata != stamp or len(index) != expected_size:
+            logger.info(f"Index snapshot {self.__snapshot_file} is outdated")
+            return None
+        logger.info(f"Loaded index of {len(index)} hashes from {self.__snapshot_file}")
+        return index
+
+    def __db_stamp(self) -> Dict[str, int]:
+        """Count and checksums of distinct stored aHashes, they change when hashes are added or replaced"""
+        count, low_sum, high_sum = self.con.execute("""
+            SELECT COUNT(*),
+                COALESCE(SUM(img_hash & 4294967295), 0),
+                COALESCE(SUM((img_hash >> 32) & 4294967295), 0)
+            FROM (SELECT DISTINCT img_hash FROM image_hashes)
+        """).fetchone()
+        return {'count': count, 'low_sum': low_sum, 'high_sum': high_sum}
+
+    def find_dublicate(self, hashes: ImageHashes) -> Optional[HashMatch]:
+        """Finds the closest stored image within max_hamming_distance.
+
+        Candidates are found by aHash and confirmed with dHash and pHash
+        when both images have them.
+
+        Args:
+            hashes (ImageHashes): image's hashes
+
+        Returns:
+            Optional[HashMatch]: closest stored image or None if the image is new
+        """
+        for match_hash, distance in self.index.within(hashes.ahash):
+            match = self.__confirmed_match(hashes, match_hash, distance)
+            if match is not None:
+                return match
+        if not self.__index_complete:
+            return self.__confirmed_match(hashes, hashes.ahash, 0)
+        # the image is new for sure, db isn't queried
+        return None
+
+    def __confirmed_match(self, hashes: ImageHashes, match_hash: int, distance: int) -> Optional[HashMatch]:
+        """Returns the first image stored with match_hash aHash that is confirmed by dHash and pHash"""
+        rows = self.con.execute("""
+            SELECT id, dhash, phash, source_link FROM image_hashes WHERE img_hash = ? ORDER BY id
+        """, (to_db_hash(match_hash), )).fetchall()
+        for image_id, dhash, phash, source_link in rows:
+            if self.__confirm(hashes.dhash, from_db_hash(dhash)) and self.__confirm(hashes.phash, from_db_hash(phash)):
+                return HashMatch(
+                    img_hash=match_hash,
+                    distance=distance,
+                    source_link=source_link,
+                    image_id=image_id
+                )
+        if rows:
+            logger.debug(f"Hash {format_hash(hashes.ahash)} is close to {format_hash(match_hash)} by aHash only")
+        return None
+
+    def __confirm(self, img_hash: Optional[int], stored_hash: Optional[int]) -> bool:
+        if img_hash is None or stored_hash is None:
+            return True
+        return (img_hash ^ stored_hash).bit_count() <= self.max_confirm_distance
+
+    def check_and_add_many(
+        self,
+        hashes: Iterable[Tuple[ImageHashes, Optional[str]]],
+        digests: Sequence[Optional[str]] = ()
+    ) -> List[Optional[HashMatch]]:
+        """Checks images for dublicates in order and adds new ones in a single transaction.
+
+        An image is also a dublicate of a close image earlier in the same batch.
 
-    def get_hash_from_url(self, photo_url: str) -> str:
-        file_name = self._download_photo(photo_url)
-        file_hash = self._get_hash(file_name)
-        file_name.unlink(missing_ok=True)
-        return file_hash
+        Verdicts are remembered by source link, see `remembered_verdicts`.
 
-    def _get_hash(self, photo_path: Path) -> str:
-        return str(imagehash.average_hash(Image.open(photo_path), hash_size=8))
+        Args:
+            hashes (Iterable[Tuple[ImageHashes, Optional[str]]]): images' hashes with their source links
+            digests (Sequence[Optional[str]], optional): platform digests of the images in the same order,
+                see `match_digests`. Defaults to ().
 
-    def _download_photo(self, photo_url: str) -> Path:
+        Returns:
+            List[Optional[HashMatch]]: match of every image, None if image is new and was added
+        """
+        matches: List[Optional[HashMatch]] = []
+        with self.con:
+            for img_hashes, source_link in hashes:
+                match = self.find_dublicate(img_hashes)
+                if match is not None:
+                    self.__count_match(match)
+                    image_id = match.image_id
+                else:
+                    image_id = self.__insert(img_hashes, source_link)
+                if source_link is not None:
+                    self.__remember(source_link, UrlVerdict(img_hashes, match))
+                digest = digests[len(matches)] if len(matches) < len(digests) else None
+                if digest is not None:
+                    self.con.execute("""
+                        INSERT OR IGNORE INTO image_digests(digest, image_id) VALUES(?,?)
+                    """, (digest, image_id))
+                matches.append(match)
+        return matches
+
+    def match_digests(self, digests: Iterable[str]) -> Dict[str, HashMatch]:
+        """Finds stored images by platform digests and counts the matches.
+
+        Digests are exact, so a dublicate is found without downloading and
+        hashing the image. They are stored by `check_and_add_many`.
+
+        Args:
+            digests (Iterable[str]): digests given by the platform
+
+        Returns:
+            Dict[str, HashMatch]: matches of known digests by digest
+        """
+        matches: Dict[str, HashMatch] = {}
+        for digest in digests:
+            row = self.con.execute("""
+                SELECT image_hashes.id, image_hashes.img_hash, image_hashes.source_link
+                FROM image_digests JOIN image_hashes ON image_hashes.id = image_digests.image_id
+                WHERE digest = ?
+            """, (digest, )).fetchone()
+            if row is not None:
+                matches[digest] = HashMatch(
+                    img_hash=from_db_hash(row[1]), distance=0, source_link=row[2], image_id=row[0]
+                )
+        if matches:
+            with self.con:
+                for match in matches.values():
+                    self.__count_match(match)
+        return matches
+
+    def remembered_verdicts(self, urls: Iterable[str]) -> Dict[str, UrlVerdict]:
+        """Returns verdicts of urls that were checked before.
+
+        A known url is a dublicate whatever its first verdict was: an image
+        that was new then was added and posted, so it isn't downloaded and
+        hashed again just to match its own hash.
+
+        Args:
+            urls (Iterable[str]): media urls, query args are ignored
+
+        Returns:
+            Dict[str, UrlVerdict]: verdicts of known urls by url
+        """
+        verdicts: Dict[str, UrlVerdict] = {}
+        for url in urls:
+            row = self.con.execute("""
+                SELECT img_hash, dhash, phash, match_hash, match_distance, match_source_link
+                FROM url_verdicts WHERE url = ?
+            """, (strip_args_from_url(url), )).fetchone()
+            if row is None:
+                continue
+            img_hash, dhash, phash, match_hash, match_distance, match_source_link = row
+            verdicts[url] = UrlVerdict(
+                hashes=ImageHashes(from_db_hash(img_hash), from_db_hash(dhash), from_db_hash(phash)),
+                match=HashMatch(
+                    img_hash=from_db_hash(match_hash),
+                    distance=match_distance,
+                    source_link=match_source_link
+                ) if match_hash is not None else None
+            )
+        return verdicts
+
+    def __remember(self, url: str, verdict: UrlVerdict) -> None:
+        match = verdict.match
+        self.con.execute("""
+            INSERT OR IGNORE INTO url_verdicts(
+                url, img_hash, dhash, phash,
+                match_hash, match_distance, match_source_link, checked_at
+            )
+            VALUES(?,?,?,?,?,?,?,?)
+        """, (
+            strip_args_from_url(url), to_db_hash(verdict.hashes.ahash),
+            to_db_hash(verdict.hashes.dhash), to_db_hash(verdict.hashes.phash),
+            to_db_hash(match.img_hash) if match else None,
+            match.distance if match else None,
+            match.source_link if match else None,
+            time()
+        ))
+
+    def match_hash(self, hashes: ImageHashes) -> Optional[HashMatch]:
+        """Finds a dublicate of the image and counts the match"""
+        match = self.find_dublicate(hashes)
+        logger.debug(f"Hash {format_hash(hashes.ahash)} matched {match}")
+        if match is not None:
+            with self.con:
+                self.__count_match(match)
+        return match
+
+    def hash_exists(self, hashes: ImageHashes) -> bool:
+        return self.match_hash(hashes) is not None
+
+    def add_hash(self, hashes: ImageHashes, source_url: str = None) -> None:
+        with self.con:
+            self.__insert(hashes, source_url)
+        logger.info(f"Added hash {format_hash(hashes.ahash)}")
+
+    def replace_hash(self, image_id: int, hashes: ImageHashes) -> None:
+        """Replaces hashes of a stored image, keeping its source link and matches.
+
+        If another image is stored with the same aHash, dHash and pHash,
+        the two rows are merged.
+
+        Args:
+            image_id (int): id of the stored image
+            hashes (ImageHashes): new hashes of the same image
+        """
+        new_hashes = (to_db_hash(hashes.ahash), to_db_hash(hashes.dhash), to_db_hash(hashes.phash))
+        with self.con:
+            row = self.con.execute("""
+                SELECT matches FROM image_hashes WHERE id = ?
+            """, (image_id, )).fetchone()
+            if row is None:
+                return
+            same = self.con.execute("""
+                SELECT id FROM image_hashes
+                WHERE img_hash = ? AND dhash IS ? AND phash IS ? AND id != ?
+                ORDER BY id
+            """, (*new_hashes, image_id)).fetchone()
+            if same is not None:
+                self.con.execute("""
+                    UPDATE image_hashes SET matches = matches + ? + 1 WHERE id = ?
+                """, (row[0], same[0]))
+                self.con.execute("""
+                    UPDATE image_digests SET image_id = ? WHERE image_id = ?
+                """, (same[0], image_id))
+                self.con.execute("""
+                    DELETE FROM image_hashes WHERE id = ?
+                """, (image_id, ))
+            else:
+                self.con.execute("""
+                    UPDATE image_hashes
+                    SET img_hash = ?, dhash = ?, phash = ?
+                    WHERE id = ?
+                """, (*new_hashes, image_id))
+        # index is rebuilt on the next use
+        self.__index = None
+
+    def __count_match(self, match: HashMatch) -> None:
+        self.con.execute("""
+            UPDATE image_hashes
+            SET matches = matches + 1
+            WHERE id = ?
+        """, (match.image_id, ))
+
+    def __insert(self, hashes: ImageHashes, source_link: Optional[str]) -> int:
+        """Stores the image and returns its id"""
+        image_id = self.con.execute("""
+            INSERT INTO image_hashes(img_hash, dhash, phash, source_link)
+            VALUES(?,?,?,?)
+        """, (
+            to_db_hash(hashes.ahash), to_db_hash(hashes.dhash),
+            to_db_hash(hashes.phash), source_link
+        )).lastrowid
+        # images with the same aHash share one index entry
+        if hashes.ahash not in self.index:
+            if len(self.index) < self.max_indexed_hashes:
+                self.index.add(hashes.ahash)
+            else:
+                self.__index_complete = False
+        return image_id
+
+    def get_hash_from_url(self, photo_url: str) -> ImageHashes:
+        """Downloads photo into memory and hashes it.
+
+        Raises:
+            ValueError: if photo has unsupported format or can't be downloaded
+            DownloadTooLargeError: if photo is bigger than max_image_bytes
+
+        Returns:
+            ImageHashes: photo's hashes
+        """
         stripped_url = strip_args_from_url(photo_url)
-        img_format = None
-        for format in self.allowed_formats:
-            if stripped_url.endswith(format):
-                img_format = format
-                break
-        if img_format is None:
+        if not stripped_url.endswith(self.allowed_formats):
             raise ValueError(f"photo_url must have allowed type. photo_url: {photo_url}")
-        file_name = self.__tmp_dir.joinpath(f"{token_hex()}{img_format}")
-        download_photo(photo_url, file_name)
-        return file_name
+        with download_photo_to_memory(photo_url, max_bytes=self.max_image_bytes) as buffer:
+            return hash_image_file(buffer)
 
     def _init_db(self) -> None:
+        # WAL needs a single fsync per transaction and lets readers work during writes
+        self.con.execute("PRAGMA journal_mode = WAL")
+        self.con.execute("PRAGMA synchronous = NORMAL")
+        self.con.execute("PRAGMA temp_store = MEMORY")
         with open(self.__init_script, 'r', encoding='utf-8') as f:
             raw_sql = f.read()
         cur = self.con.cursor()
         cur.executescript(raw_sql)
-        
\ No newline at end of file
+        version = self.con.execute("PRAGMA user_version").fetchone()[0]
+        if version < 1:
+            self._migrate_text_hashes()
+        if version < 2:
+            self._add_hash_columns()
+        if version < 3:
+            self._key_by_image_id(raw_sql)
+        self.con.execute(f"PRAGMA user_version = {self.schema_version}")
+
+    def _migrate_text_hashes(self) -> None:
+        """Moves hex hashes of the old img_hashes table into image_hashes"""
+        old_table = self.con.execute("""
+            SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'img_hashes'
+        """).fetchone()
+        if old_table is None:
+            return
+        rows = self.con.execute("SELECT img_hash, source_link, matches FROM img_hashes").fetchall()
+        with self.con:
+            self.con.executemany("""
+                INSERT OR IGNORE INTO image_hashes(img_hash, source_link, matches)
+                VALUES(?,?,?)
+            """, ((to_db_hash(int(img_hash, 16)), source_link, matches)
+                  for img_hash, source_link, matches in rows))
+            self.con.execute("DROP TABLE img_hashes")
+        logger.info(f"Migrated {len(rows)} hashes to integer hashes")
+
+    def _add_hash_columns(self) -> None:
+        """Adds dHash and pHash columns to databases that only have aHash"""
+        columns = {row[1] for row in self.con.execute("PRAGMA table_info(image_hashes)")}
+        with self.con:
+            for column in ('dhash', 'phash'):
+                if column not in columns:
+                    self.con.execute(f"ALTER TABLE image_hashes ADD COLUMN {column} INTEGER")
+
+    def _key_by_image_id(self, init_sql: str) -> None:
+        """Moves images of the old table keyed by aHash into the table keyed by id,
+        digests are pointed to the new ids"""
+        columns = {row[1] for row in self.con.execute("PRAGMA table_info(image_hashes)")}
+        if 'id' in columns:
+            return
+        digest_columns = {row[1] for row in self.con.execute("PRAGMA table_info(image_digests)")}
+        self.con.execute("ALTER TABLE image_hashes RENAME TO image_hashes_by_hash")
+        # the index was created on the old table by init.sql, it is recreated on the new one
+        self.con.execute("DROP INDEX IF EXISTS image_hashes_img_hash")
+        if 'img_hash' in digest_columns:
+            self.con.execute("ALTER TABLE image_digests RENAME TO image_digests_by_hash")
+        self.con.commit()
+        self.con.executescript(init_sql)
+        with self.con:
+            count = self.con.execute("""
+                INSERT INTO image_hashes(img_hash, dhash, phash, source_link, matches)
+                SELECT img_hash, dhash, phash, source_link, matches FROM image_hashes_by_hash
+                ORDER BY rowid
+            """).rowcount
+            if 'img_hash' in digest_columns:
+                self.con.execute("""
+                    INSERT OR IGNORE INTO image_digests(digest, image_id)
+                    SELECT digest, image_hashes.id
+                    FROM image_digests_by_hash JOIN image_hashes USING (img_hash)
+                """)
+                self.con.execute("DROP TABLE image_digests_by_hash")
+            self.con.execute("DROP TABLE image_hashes_by_hash")
+        logger.info(f"Migrated {count} hashes to images keyed by id")
@@ -0,0 +1,187 @@
+from typing import Iterable, List, Optional, Set, Tuple, TYPE_CHECKING
+from itertools import combinations
+from pathlib import Path
+
+if TYPE_CHECKING:
+    import numpy
+
+hash_bits = 64
+chunk_count = 4
+chunk_bits = hash_bits // chunk_count
+chunk_mask = (1 << chunk_bits) - 1
+bucket_count = chunk_count << chunk_bits
+# every hash is stored once per chunk position
+bytes_per_hash = chunk_count * 8
+
+class HashIndex:
+    """Multi-index hashing of 64 bit image hashes for Hamming distance search.
+
+    Every hash is split into 4 chunks of 16 bits and each chunk position
+    has its own table from chunk value to hashes. If two hashes differ in
+    at most `max_distance` bits, at least one pair of their chunks differs
+    in at most max_distance // 4 bits, so a search only looks into buckets
+    of chunk values that close to the query's chunks instead of scanning
+    every hash.
+
+    All buckets are kept in a single NumPy array sorted by (chunk position,
+    chunk value) with an array of bucket offsets into it, 32 bytes per
+    hash, so a million hashes take 32 MB and can be saved to and loaded
+    from a snapshot file as is. New hashes are kept in a small set and
+    merged into the array in batches.
+    """
+    # added hashes are merged into the array when there are this many
+    merge_threshold = 1024
+
+    def __init__(self, max_distance: int = 0, hashes: Iterable[int] = ()) -> None:
+        import numpy
+        if not 0 <= max_distance < hash_bits:
+            raise ValueError(f"max_distance must be in [0, {hash_bits}), got {max_distance}")
+        self.max_distance = max_distance
+        # buckets to look into are query's chunks xor-ed with these masks
+        chunk_masks = numpy.array([
+            sum(1 << bit for bit in bits)
+            for flipped in range(max_distance // chunk_count + 1)
+            for bits in combinations(range(chunk_bits), flipped)
+        ], dtype=numpy.int64)
+        self.__chunk_masks = numpy.tile(chunk_masks, chunk_count)
+        self.__bucket_starts = numpy.repeat(numpy.arange(chunk_count, dtype=numpy.int64) << chunk_bits, len(chunk_masks))
+        self.__shifts = numpy.repeat(numpy.arange(chunk_count, dtype=numpy.uint64) * numpy.uint64(chunk_bits), len(chunk_masks))
+        self.__recent: Set[int] = set()
+        hashes = numpy.unique(numpy.fromiter(hashes, dtype=numpy.uint64))
+        keys = self.__keys(hashes)
+        order = numpy.argsort(keys, kind='stable')
+        self.__table = numpy.tile(hashes, chunk_count)[order]
+        self.__offsets = numpy.zeros(bucket_count + 1, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(keys, minlength=bucket_count), out=self.__offsets[1:])
+
+    def add(self, img_hash: int) -> None:
+        if img_hash in self:
+            return
+        self.__recent.add(img_hash)
+        if len(self.__recent) >= self.merge_threshold:
+            self.__merge()
+
+    def nearest(self, img_hash: int) -> Optional[Tuple[int, int]]:
+        """Finds the closest hash within max_distance.
+
+        Args:
+            img_hash (int): hash to look for
+
+        Returns:
+            Optional[Tuple[int, int]]: closest hash and its distance or None if there is none
+        """
+        if img_hash in self:
+            return img_hash, 0
+        found = self.within(img_hash)
+        return found[0] if found else None
+
+    def within(self, img_hash: int) -> List[Tuple[int, int]]:
+        """Finds all hashes within max_distance.
+
+        Args:
+            img_hash (int): hash to look for
+
+        Returns:
+            List[Tuple[int, int]]: hashes and their distances, the closest first
+        """
+        import numpy
+        query = numpy.uint64(img_hash)
+        chunks = ((query >> self.__shifts) & numpy.uint64(chunk_mask)).astype(numpy.int64)
+        buckets = self.__bucket_starts + (chunks ^ self.__chunk_masks)
+        starts = self.__offsets[buckets]
+        lengths = self.__offsets[buckets + 1] - starts
+        # positions of all buckets' hashes without a python loop over buckets
+        positions = numpy.arange(lengths.sum()) + numpy.repeat(starts - (numpy.cumsum(lengths) - lengths), lengths)
+        candidates = self.__table[positions]
+        close = candidates[numpy.bitwise_count(candidates ^ query) <= self.max_distance]
+        # a hash is in every bucket where its chunk is close enough
+        found: List[Tuple[int, int]] = [
+            (candidate, (candidate ^ img_hash).bit_count()) for candidate in set(close.tolist())
+        ]
+        for candidate in self.__recent:
+            distance = (candidate ^ img_hash).bit_count()
+            if distance <= self.max_distance:
+                found.append((candidate, distance))
+        found.sort(key=lambda x: x[1])
+        return found
+
+    @property
+    def nbytes(self) -> int:
+        """Memory taken by the arrays, hashes that are not merged yet are not counted"""
+        return self.__table.nbytes + self.__offsets.nbytes
+
+    def save(self, file: Path, **metadata: int) -> None:
+        """Saves the index into a .npz file.
+
+        Args:
+            file (Path): snapshot file
+            **metadata (int): values that are loaded back with the index
+        """
+        import numpy
+        self.__merge()
+        numpy.savez(
+            file,
+            table=self.__table,
+            offsets=self.__offsets,
+            **{f'meta_{key}': numpy.int64(value) for key, value in metadata.items()}
+        )
+
+    @classmethod
+    def load(cls, file: Path, max_distance: int = 0) -> Tuple['HashIndex', dict]:
+        """Loads an index saved with `save`.
+
+        Args:
+            file (Path): snapshot file
+            max_distance (int, optional): max distance of the loaded index. Defaults to 0.
+
+        Returns:
+            Tuple[HashIndex, dict]: the index and the metadata it was saved with
+        """
+        import numpy
+        index = cls(max_distance)
+        with numpy.load(file, allow_pickle=False) as snapshot:
+            index.__table = snapshot['table']
+            index.__offsets = snapshot['offsets']
+            metadata = {
+                name[len('meta_'):]: int(snapshot[name])
+                for name in snapshot.files if name.startswith('meta_')
+            }
+        if len(index.__offsets) != bucket_count + 1 or len(index.__table) % chunk_count:
+            raise ValueError(f"{file} is not a hash index snapshot")
+        return index, metadata
+
+    def __contains__(self, img_hash: int) -> bool:
+        import numpy
+        if img_hash in self.__recent:
+            return True
+        # bucket of the first chunk
+        chunk = img_hash & chunk_mask
+        bucket = self.__table[self.__offsets[chunk]:self.__offsets[chunk + 1]]
+        return bool((bucket == numpy.uint64(img_hash)).any())
+
+    def __len__(self) -> int:
+        return len(self.__table) // chunk_count + len(self.__recent)
+
+    @staticmethod
+    def __keys(hashes: 'numpy.ndarray') -> 'numpy.ndarray':
+        """Buckets of hashes in every chunk position, position by position"""
+        import numpy
+        return numpy.concatenate([
+            (i << chunk_bits) + ((hashes >> numpy.uint64(i * chunk_bits)) & numpy.uint64(chunk_mask)).astype(numpy.int64)
+            for i in range(chunk_count)
+        ])
+
+    def __merge(self) -> None:
+        """Inserts recently added hashes into their buckets"""
+        import numpy
+        if not self.__recent:
+            return
+        recent = numpy.array(list(self.__recent), dtype=numpy.uint64)
+        keys = self.__keys(recent)
+        # hashes inserted at the same position keep their order,
+        # it happens for buckets with empty buckets between them
+        order = numpy.argsort(keys, kind='stable')
+        keys = keys[order]
+        self.__table = numpy.insert(self.__table, self.__offsets[keys + 1], numpy.tile(recent, chunk_count)[order])
+        self.__offsets[1:] += numpy.cumsum(numpy.bincount(keys, minlength=bucket_count))
+        self.__recent.clear()
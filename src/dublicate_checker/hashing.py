@@ -0,0 +1,81 @@
+from typing import BinaryIO, Optional, TYPE_CHECKING
+from dataclasses import dataclass
+from functools import lru_cache
+
+if TYPE_CHECKING:
+    # PIL and numpy are imported when the first image is hashed
+    from PIL import Image
+    import numpy
+
+hash_size = 8
+# pHash is taken from the low frequencies of a 32x32 image
+phash_image_size = hash_size * 4
+# jpeg is decoded right at a reduced scale that is still bigger than this
+draft_size = (phash_image_size * 2, phash_image_size * 2)
+
+@dataclass(frozen=True)
+class ImageHashes:
+    """64 bit perceptual hashes of an image.
+
+    `ahash` is the main one, it is comparable with imagehash.average_hash
+    of the old hashes. dHash and pHash are unknown for migrated hashes.
+    """
+    ahash: int
+    dhash: Optional[int] = None
+    phash: Optional[int] = None
+
+def hash_image(img: 'Image.Image') -> ImageHashes:
+    """Computes aHash, dHash and pHash of an image from a single decode.
+
+    JPEG images are decoded by Pillow in draft mode, which scales them
+    down by up to 8 times while decoding, so hashing cost barely depends
+    on image resolution.
+
+    Args:
+        img (Image.Image): opened, not yet loaded image
+
+    Returns:
+        ImageHashes: image's hashes
+    """
+    from PIL import Image
+    import numpy
+    img.draft('L', draft_size)
+    gray = img.convert('L')
+    def pixels(width: int, height: int) -> 'numpy.ndarray':
+        return numpy.asarray(gray.resize((width, height), Image.Resampling.LANCZOS), dtype=numpy.float64)
+    small = pixels(hash_size, hash_size)
+    ahash = small > small.mean()
+    wide = pixels(hash_size + 1, hash_size)
+    dhash = wide[:, 1:] > wide[:, :-1]
+    dct_matrix = _dct_matrix(phash_image_size)
+    dct = dct_matrix @ pixels(phash_image_size, phash_image_size) @ dct_matrix.T
+    low_frequencies = dct[:hash_size, :hash_size]
+    phash = low_frequencies > numpy.median(low_frequencies)
+    return ImageHashes(
+        ahash=_bits_to_int(ahash),
+        dhash=_bits_to_int(dhash),
+        phash=_bits_to_int(phash)
+    )
+
+def hash_image_file(file: BinaryIO) -> ImageHashes:
+    from PIL import Image
+    with Image.open(file) as img:
+        return hash_image(img)
+
+@lru_cache(maxsize=None)
+def _dct_matrix(n: int) -> 'numpy.ndarray':
+    """DCT-II matrix, scaling is left out since bits only compare coefficients"""
+    import numpy
+    k = numpy.arange(n).reshape(-1, 1)
+    i = numpy.arange(n).reshape(1, -1)
+    return numpy.cos(numpy.pi * k * (2 * i + 1) / (2 * n))
+
+def _bits_to_int(bits: 'numpy.ndarray') -> int:
+    """Packs bits row by row, the first bit is the most significant like in imagehash"""
+    import numpy
+    return int.from_bytes(numpy.packbits(bits.flatten()).tobytes(), 'big')
+
+def hash_image_bytes(data: bytes) -> ImageHashes:
+    """hash_image_file for worker processes, bytes are cheap to pass between processes"""
+    from io import BytesIO
+    return hash_image_file(BytesIO(data))
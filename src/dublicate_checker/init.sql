@@ -1,5 +1,32 @@
-CREATE TABLE IF NOT EXISTS img_hashes (
-	img_hash TEXT PRIMARY KEY,
+CREATE TABLE IF NOT EXISTS image_hashes (
+	id INTEGER PRIMARY KEY,
+	-- 64 bit hashes stored as signed integers, img_hash is the aHash.
+	-- Images with the same aHash but different dHash or pHash are separate rows
+	img_hash INTEGER NOT NULL,
+	dhash INTEGER,
+	phash INTEGER,
 	source_link TEXT,
     matches INT DEFAULT 0 NOT NULL
-);
\ No newline at end of file
+);
+
+CREATE INDEX IF NOT EXISTS image_hashes_img_hash ON image_hashes(img_hash);
+
+CREATE TABLE IF NOT EXISTS url_verdicts (
+	-- media url without query args, it is downloaded and hashed only once
+	url TEXT PRIMARY KEY,
+	img_hash INTEGER NOT NULL,
+	dhash INTEGER,
+	phash INTEGER,
+	-- stored image the url was a dublicate of, NULL if it was new
+	match_hash INTEGER,
+	match_distance INT,
+	match_source_link TEXT,
+	checked_at REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS image_digests (
+	-- digest of the file given by the platform, like 'md5:<hex>'
+	digest TEXT PRIMARY KEY,
+	-- id of the stored image with this content
+	image_id INTEGER NOT NULL
+);
@@ -0,0 +1,75 @@
+"""Rehashes stored images from their preview thumbnails.
+
+Dublicate check hashes Danbooru's 180x180 previews instead of samples,
+and hashes of the same image taken from different resolutions can be
+a few bits apart. This migration downloads the preview of every stored
+image whose source link is a Danbooru sample or original and replaces
+its hashes, so old images are compared with new ones on equal terms.
+Images without a preview keep their hashes.
+
+Stop the bot and run from the repo's root:
+    python3 -m src.dublicate_checker.rehash
+"""
+from typing import Callable, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+import logging
+
+from src.request_utils import download_photo_to_memory, CircuitOpenError, MAX_CONCURRENT_REQUESTS
+from src.parse import DanbooruParser
+from .checker import DublicateChecker, format_hash
+from .hashing import ImageHashes, hash_image_file
+
+logger = logging.getLogger("DublicateChecker")
+
+def rehash_previews(
+    checker: DublicateChecker,
+    preview_url: Callable[[str], Optional[str]] = DanbooruParser.preview_url,
+    workers: int = MAX_CONCURRENT_REQUESTS
+) -> int:
+    """Replaces hashes of stored images with hashes of their previews.
+
+    Args:
+        checker (DublicateChecker): checker with the hash database
+        preview_url (Callable[[str], Optional[str]], optional): derives preview url from a source link.
+            Defaults to DanbooruParser.preview_url.
+        workers (int, optional): concurrent downloads. Defaults to MAX_CONCURRENT_REQUESTS.
+
+    Returns:
+        int: number of rehashed images
+    """
+    rows = checker.con.execute("""
+        SELECT id, source_link FROM image_hashes WHERE source_link IS NOT NULL
+    """).fetchall()
+    previews = [
+        (image_id, url)
+        for image_id, url in ((image_id, preview_url(link)) for image_id, link in rows)
+        if url is not None
+    ]
+    logger.info(f"Rehashing {len(previews)} of {len(rows)} stored images")
+    rehashed = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for image_id, url, hashes in pool.map(lambda x: _hash_preview(checker, *x), previews):
+            if hashes is None:
+                continue
+            checker.replace_hash(image_id, hashes)
+            rehashed += 1
+            logger.debug(f"Rehashed image {image_id} to {format_hash(hashes.ahash)} from {url}")
+    logger.info(f"Rehashed {rehashed} images")
+    return rehashed
+
+def _hash_preview(
+    checker: DublicateChecker, image_id: int, url: str
+) -> Tuple[int, str, Optional[ImageHashes]]:
+    try:
+        with download_photo_to_memory(url, max_bytes=checker.max_image_bytes) as buffer:
+            return image_id, url, hash_image_file(buffer)
+    # requests' exceptions and unreadable images are OSErrors
+    except (CircuitOpenError, ValueError, OSError) as e:
+        logger.warning(f"Keeping hashes of image {image_id}, preview failed. {e}")
+        return image_id, url, None
+
+if __name__ == '__main__':
+    logging.basicConfig(format='[%(asctime)s] [%(levelname)s %(name)s] %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S',
+                        level=logging.INFO)
+    rehash_previews(DublicateChecker())
@@ -1 +1,3 @@
-from .post_manager import PostManager
\ No newline at end of file
+from .post_manager import PostManager
+from .source_index import SourceIndex, source_identity
+from .event_queue import EventQueue
\ No newline at end of file
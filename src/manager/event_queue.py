@@ -0,0 +1,77 @@
+from typing import Generic, Iterator, List, Optional, Tuple, TypeVar
+from threading import Condition
+from itertools import count
+import datetime as dt
+import heapq
+
+T = TypeVar('T')
+
+class EventQueue(Generic[T]):
+    """Thread-safe priority queue of events ordered by their due time.
+
+    Events are pushed and popped in O(log n). `wait` sleeps until the
+    earliest event is due and is woken up early when an event is pushed
+    or `wake` is called, so nothing is polled.
+    """
+    def __init__(self) -> None:
+        # sequence number keeps events of the same time in push order
+        # and events themselves are never compared
+        self.__heap: List[Tuple[dt.datetime, int, T]] = []
+        self.__seq = count()
+        self.__cond = Condition()
+
+    def push(self, due: dt.datetime, event: T) -> None:
+        with self.__cond:
+            heapq.heappush(self.__heap, (due, next(self.__seq), event))
+            self.__cond.notify_all()
+
+    def pop_due(self, now: Optional[dt.datetime] = None) -> List[Tuple[dt.datetime, T]]:
+        """Pops all events that are due.
+
+        Args:
+            now (Optional[dt.datetime], optional): current time. Defaults to dt.datetime.now().
+
+        Returns:
+            List[Tuple[dt.datetime, T]]: due events with their due time, the earliest first
+        """
+        now = now or dt.datetime.now()
+        due_events = []
+        with self.__cond:
+            while self.__heap and self.__heap[0][0] <= now:
+                due, _, event = heapq.heappop(self.__heap)
+                due_events.append((due, event))
+        return due_events
+
+    def next_due(self) -> Optional[dt.datetime]:
+        with self.__cond:
+            return self.__heap[0][0] if self.__heap else None
+
+    def wait(self, max_timeout: Optional[float] = None) -> None:
+        """Sleeps until the earliest event is due, an event is pushed or `wake` is called.
+
+        Args:
+            max_timeout (Optional[float], optional): max seconds to sleep. Defaults to None (no limit).
+        """
+        with self.__cond:
+            timeout = max_timeout
+            if self.__heap:
+                till_due = (self.__heap[0][0] - dt.datetime.now()).total_seconds()
+                if till_due <= 0:
+                    return
+                timeout = till_due if timeout is None else min(timeout, till_due)
+            self.__cond.wait(timeout)
+
+    def wake(self) -> None:
+        """Wakes up waiting threads"""
+        with self.__cond:
+            self.__cond.notify_all()
+
+    def __iter__(self) -> Iterator[Tuple[dt.datetime, T]]:
+        """Iterates over a snapshot of queued events in no particular order"""
+        with self.__cond:
+            events = [(due, event) for due, _, event in self.__heap]
+        return iter(events)
+
+    def __len__(self) -> int:
+        with self.__cond:
+            return len(self.__heap)
@@ -1,8 +1,12 @@
-from typing import List, Set, Tuple, Dict, Any
+from typing import List, Tuple, Dict, Any, Deque, Iterator, Optional, Union
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import deque
+from dataclasses import dataclass
+from queue import Queue, Full, Empty
+from threading import Event
 from json import dump, load
 from random import randint
 from pprint import pformat
-from pathlib import Path
 import datetime as dt
 import logging
 import pytgbot
@@ -10,29 +14,65 @@ import json
 import time
 import os
 
-from src.dublicate_checker import DublicateChecker
-from src.parse import BaseParser, Post
-from src.request_utils import strip_args_from_url
-from src.config import log_dir, config_dir, data_dir
+from src.dublicate_checker import DublicateChecker, DedupeStage
+from src.parse import BaseParser, Post, ScrapeTimeoutError
+from src.request_utils import get_http_cache, CircuitOpenError
+from src.config import log_dir, config_dir, data_dir, ensure_dir
 import src.tg_bot as tg_bot
+from .source_index import SourceIndex, source_identity
+from .event_queue import EventQueue
 
 logger = logging.getLogger("PostManager")
 log_file = log_dir.joinpath("postmanager.log")
-fh = logging.FileHandler(log_file)
+# log file is opened on the first record
+fh = logging.FileHandler(log_file, delay=True)
 fh.setLevel(logging.DEBUG)
 ff = logging.Formatter('[%(asctime)s] %(levelname)s %(message)s', '%Y-%m-%d %H:%M:%S')
 fh.setFormatter(ff)
 logger.addHandler(fh)
 
+@dataclass(frozen=True)
+class ParserRun:
+    """Stats of a single scrape_posts run"""
+    parser_name: str
+    posts: int
+    duration: float
+    timed_out: bool = False
+    error: Optional[str] = None
+
+    def __str__(self) -> str:
+        result = f"{self.parser_name}: {self.posts} posts in {self.duration:.1f} sec"
+        if self.timed_out:
+            result += ", timed out"
+        if self.error is not None:
+            result += f", failed: {self.error}"
+        return result
+
+@dataclass(frozen=True)
+class ScrapedPost:
+    """Post scraped by a parser with parser's progress right after it"""
+    parser: BaseParser
+    post: Post
+    progress: Any
+
+@dataclass(frozen=True)
+class UpdateEvent:
+    """Scheduled update, `slot` is the index of its update time"""
+    slot: int
+
 class PostManager:
     time_format = '%Y-%m-%d %H:%M'
+    # max posts scraped ahead of the dublicate check
+    max_queued_posts = 20
 
     def __init__(
         self, 
         config_file: str = 'scheduler_conf.json',
-        schedule_file: str = 'schedule.json'
+        schedule_file: str = 'schedule.json',
+        source_index_file: str = 'source_index.db'
     ) -> None:
-        with open(config_dir.joinpath(config_file), 'r', encoding = 'utf-8') as f:
+        ensure_dir(log_dir)
+        with open(ensure_dir(config_dir).joinpath(config_file), 'r', encoding = 'utf-8') as f:
             self.config = load(f)
         # initializing
         self.__update_time = [self.form_today_timestamp(t) 
@@ -44,14 +84,29 @@ class PostManager:
                 self.__update_time[i] += dt.timedelta(days=1)
 
         self.do_run = True
+        # posting is retried after this many seconds if telegram is unavailable
         self.__check_interval = self.config['check_interval']
+        self.__parser_timeout = self.config.get('parser_timeout', 3600)
 
         self.__parsers: List[BaseParser] = []
-        self.post_schedule: Set[Tuple[dt.datetime, Post]] = set()
-        self.__schedule_file = data_dir.joinpath(schedule_file)
+        # scheduled posts and updates by their time
+        self.schedule: EventQueue[Union[Post, UpdateEvent]] = EventQueue()
+        # posts scheduled during an update, they are put to the schedule
+        # in order once the update is done
+        self.__incoming: List[Tuple[dt.datetime, Post]] = []
+        for slot, update_time in enumerate(self.__update_time):
+            self.schedule.push(update_time, UpdateEvent(slot))
+        self.__schedule_file = ensure_dir(data_dir).joinpath(schedule_file)
+        # incoming posts are appended here instead of rewriting the whole schedule
+        # for each of them, the journal is merged into the schedule file when it is saved
+        self.__journal_file = self.__schedule_file.with_name(self.__schedule_file.name + '.journal')
         self.__load_schedule_data()
 
         self.dub_checker = DublicateChecker()
+        # artworks of scheduled posts are always recorded, so skipping can be enabled any time
+        self.source_index = SourceIndex(data_dir.joinpath(source_index_file))
+        # posts of already scheduled artworks are skipped before dublicate check
+        self.__skip_known_sources_enabled = self.config.get('skip_known_sources', False)
 
         logger.info(f"Initialization done.\n{str(self)}")
 
@@ -59,134 +114,224 @@ class PostManager:
         if len(self.__parsers) == 0:
             raise Exception('PostManager has no parsers added. Use PostManager.add_parser() to add parsers.')
         while self.do_run:
-            logger.debug(f"Checking if something to do...")
-            self.__check_post_schedule()
-            self.__check_update_schedule()
-            time.sleep(self.__check_interval)
+            due_events = self.schedule.pop_due()
+            due_posts = [(post_time, event) for post_time, event in due_events if isinstance(event, Post)]
+            if due_posts:
+                self.__post(due_posts)
+            for _, event in due_events:
+                if isinstance(event, UpdateEvent):
+                    self.__update(event)
+            # sleeping till the next post or update, scheduling new posts wakes it up
+            self.schedule.wait()
+
+    def stop(self) -> None:
+        """Stops main_loop after the current event"""
+        self.do_run = False
+        self.schedule.wake()
 
     def add_parser(self, parser: BaseParser) -> None:
         if not isinstance(parser, BaseParser):
             raise ValueError('parser must be inherited from BaseParser')
         self.__parsers.append(parser)
 
-    def __check_update_schedule(self) -> None:
-        if self.__is_time_for_update():
-            logger.info(f"Updating!")
-            new_posts = self.gather_new_posts()
-            logger.info("Gathered {p} posts with {i} images in total".format(
-                p=len(new_posts),
-                i=sum(len(p.media_urls) for p in new_posts) if new_posts else 0
-            ))
-            self.__schedule_posts(new_posts)
-
-    def gather_new_posts(self) -> List[Post]:
-        posts: List[Post] = []
+    def __update(self, event: UpdateEvent) -> None:
+        # next update is scheduled first, posts are scheduled till then
+        cur_time = dt.datetime.now()
+        while self.__update_time[event.slot] <= cur_time:
+            self.__update_time[event.slot] += dt.timedelta(days=1)
+        self.schedule.push(self.__update_time[event.slot], event)
+        logger.info(f"Updating!")
+        post_count, img_count = 0, 0
+        try:
+            for post in self.gather_new_posts():
+                # post is saved before the parser's progress
+                self.__schedule_incoming(post)
+                post_count += 1
+                img_count += len(post.media_urls)
+        finally:
+            self.__flush_incoming()
+        logger.info(f"Gathered {post_count} posts with {img_count} images in total")
+        http_cache = get_http_cache()
+        if http_cache is not None:
+            logger.info(f"Http cache stats: {http_cache.stats()}")
+
+    def gather_new_posts(self) -> Iterator[Post]:
+        """Gathers new posts from all parsers running them concurrently.
+
+        Parsers stream posts, so dublicates are filtered while parsers are
+        still scraping. A failing or timed out parser does not affect the
+        others. Parser's progress is saved when the caller asks for the
+        next post, so the caller must have saved the posts it got by then:
+        those are not scraped again and the rest are, even after a crash.
+
+        Yields:
+            Post: new post without dublicates
+        """
+        if len(self.__parsers) == 0:
+            return
+        scraped: Queue[ScrapedPost] = Queue(maxsize=self.max_queued_posts)
+        stop = Event()
+        # posts in the dublicate check, it yields every post it gets in the same order
+        checking: Deque[ScrapedPost] = deque()
+        def to_check(scraped_posts: Iterator[ScrapedPost]) -> Iterator[Post]:
+            for scraped_post in scraped_posts:
+                checking.append(scraped_post)
+                yield scraped_post.post
+        with ThreadPoolExecutor(max_workers=len(self.__parsers)) as pool:
+            runs: List[Future] = [pool.submit(self.__run_parser, parser, scraped, stop)
+                                  for parser in self.__parsers]
+            try:
+                with DedupeStage(self.dub_checker, hash_workers=self.dub_checker.config.get('hash_workers', 0)) as dedupe:
+                    scraped_posts = self.__skip_known_sources(self.__drain(scraped, runs))
+                    for post in dedupe.filter_posts(to_check(scraped_posts)):
+                        scraped_post = checking.popleft()
+                        if len(post.media_urls) > 0:
+                            yield post
+                        scraped_post.parser.save_progress(scraped_post.progress)
+            finally:
+                # stopping parsers if dublicate check has failed
+                stop.set()
+        for run in runs:
+            logger.info(f"Parser run {run.result()}")
+        # all scraped posts are processed, including skipped ones after the last checked post
         for parser in self.__parsers:
-            posts.extend(parser.scrape_posts())
-        return posts
+            parser.save_progress(parser.scrape_progress)
 
-    def __check_post_schedule(self) -> None:
-        logger.debug(f"Checking post schedule...")
-        cur_time = dt.datetime.now()
-        failed: Set[Tuple[dt.datetime, Post]] = set()
-        posted: Set[Tuple[dt.datetime, Post]] = set()
-        for post_time, post in self.post_schedule:
-            if post_time < cur_time:
-                logger.info(f"Posting {post}")
-                try:
-                    tg_bot.send_media(
-                        media = post.media_urls,
-                        caption = post.form_caption()
-                    )
-                    posted.add((post_time, post))
-                except pytgbot.exceptions.TgApiServerException:
-                    logger.warning(f'Failed to post {post}')
-                    failed.add((post_time, post))
+    def __skip_known_sources(self, scraped_posts: Iterator[ScrapedPost]) -> Iterator[ScrapedPost]:
+        """Skips posts of artworks that were scheduled before or earlier in this update"""
+        if not self.__skip_known_sources_enabled:
+            yield from scraped_posts
+            return
+        seen = set()
+        for scraped_post in scraped_posts:
+            source_link = scraped_post.post.source_link
+            identity = source_identity(source_link)
+            if identity is not None and (identity in seen or self.source_index.contains(source_link)):
+                logger.info(f"Skipping post of a known artwork {identity}: {source_link}")
+                continue
+            if identity is not None:
+                seen.add(identity)
+            yield scraped_post
+
+    @staticmethod
+    def __drain(scraped: Queue, runs: List[Future]) -> Iterator[ScrapedPost]:
+        """Yields scraped posts until all parsers are done"""
+        while True:
+            try:
+                yield scraped.get(timeout=1)
+            except Empty:
+                # parsers can't put anything after they are done
+                if all(run.done() for run in runs) and scraped.empty():
+                    return
+
+    def __run_parser(self, parser: BaseParser, scraped: Queue, stop: Event) -> ParserRun:
+        """Puts posts of a single parser to the queue until it is done, failed or timed out"""
+        parser_name = type(parser).__name__
+        started = time.monotonic()
+        deadline = started + self.__parser_timeout
+        post_count, timed_out, error = 0, False, None
+        posts = parser.scrape_posts(deadline=deadline)
+        try:
+            for post in posts:
+                scraped_post = ScrapedPost(parser, post, parser.scrape_progress)
+                while not stop.is_set():
+                    try:
+                        scraped.put(scraped_post, timeout=1)
+                        post_count += 1
+                        break
+                    except Full:
+                        continue
+                if stop.is_set():
+                    break
+                # parser checks the deadline while it requests pages,
+                # this stops it if its posts have waited in the queue that long
+                if time.monotonic() > deadline:
+                    raise ScrapeTimeoutError("Scrape deadline has passed")
+        except ScrapeTimeoutError:
+            timed_out = True
+            logger.error(f"{parser_name} timed out after {self.__parser_timeout} sec")
+        except CircuitOpenError as e:
+            # the site is down, keeping what is gathered and waiting for the next update
+            error = str(e)
+            logger.error(f"{parser_name} update stopped. {e}")
+        except Exception as e:
+            error = str(e)
+            logger.exception(f"{parser_name} failed")
+        finally:
+            posts.close()
+        return ParserRun(
+            parser_name=parser_name,
+            posts=post_count,
+            duration=time.monotonic() - started,
+            timed_out=timed_out,
+            error=error
+        )
+
+    def __post(self, due_posts: List[Tuple[dt.datetime, Post]]) -> None:
+        """Posts due posts popped from the schedule"""
+        failed: List[Post] = []
+        posted = 0
+        for i, (post_time, post) in enumerate(due_posts):
+            logger.info(f"Posting {post}")
+            try:
+                tg_bot.send_media(
+                    media = post.media_urls,
+                    caption = post.form_caption()
+                )
+                posted += 1
+            except pytgbot.exceptions.TgApiServerException:
+                logger.warning(f'Failed to post {post}')
+                failed.append(post)
+            except CircuitOpenError as e:
+                # telegram is down, remaining posts are retried after check_interval
+                logger.error(f'Posting paused. {e}')
+                retry_time = dt.datetime.now() + dt.timedelta(seconds=self.__check_interval)
+                for _, paused_post in due_posts[i:]:
+                    self.schedule.push(retry_time, paused_post)
+                break
         if len(failed) > 0:
             logger.warning(f'Failed to post {len(failed)} posts. Rescheduling them')
-            self.post_schedule.difference_update(failed)
-            self.__schedule_posts([x[1] for x in failed])
-        if len(posted) > 0:
-            logger.info(f'Posted {len(posted)} posts')
-            self.post_schedule.difference_update(posted)
-        if len(failed) > 0 or len(posted) > 0:
-            self.__save_schedule_data()
+            self.__schedule_posts(failed)
+        if posted > 0:
+            logger.info(f'Posted {posted} posts')
+        self.__save_schedule_data()
     
-    @staticmethod
-    def __random_ordered_timestamps(
-        n: int,
-        delta: dt.timedelta
-    ) -> List[dt.datetime]:
-        now = dt.datetime.now()
-        def random_timestamp() -> dt.datetime:
-            return now + dt.timedelta(seconds=randint(0, delta.seconds))
-        return sorted(random_timestamp() for _ in range(n))
-
-    def __schedule_posts(self, posts: List[Post]) -> None:
-        if len(posts) == 0: return
+    def __random_post_time(self) -> dt.datetime:
+        """Random time till the next update"""
         till_update = self.get_time_till_next_update()
         # I do not want to post anything past 23:59
         max_post_time = dt.datetime.combine(dt.date.today(), dt.time(23, 59))
         till_max_post_time = max_post_time - dt.datetime.now()
-        # Generating posting time for each post and sorting it to keep original post order
-        post_timestamps = self.__random_ordered_timestamps(
-            n=len(posts),
-            delta=min(till_update, till_max_post_time)
-        )
+        delta = min(till_update, till_max_post_time)
+        return dt.datetime.now() + dt.timedelta(seconds=randint(0, delta.seconds))
+
+    def __schedule_incoming(self, post: Post) -> None:
+        """Schedules a post of a running update and appends it to the schedule journal"""
+        post_time = self.__random_post_time()
+        self.__incoming.append((post_time, post))
+        with open(self.__journal_file, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(self.__scheduled_to_dict(post_time, post)) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.source_index.add_many([post.source_link])
+
+    def __flush_incoming(self) -> None:
+        """Puts incoming posts to the schedule. Their times are sorted to keep original post order"""
+        if len(self.__incoming) == 0: return
+        post_timestamps = sorted(timestamp for timestamp, _ in self.__incoming)
         new_post_count, new_img_count = 0, 0
-        for post, timestamp in zip(posts, post_timestamps):
-            post = self.filter_dublicates(post)
-            if len(post.media_urls) == 0:
-                continue
-            self.post_schedule.add((
-                timestamp,
-                post
-            ))
+        for (_, post), timestamp in zip(self.__incoming, post_timestamps):
+            self.schedule.push(timestamp, post)
             new_post_count += 1
             new_img_count += len(post.media_urls)
             logger.info(f"Post {post} scheduled at {timestamp.strftime(self.time_format)}")
         logger.info(f"Scheduled {new_post_count} new posts with {new_img_count} images in total")
+        self.__incoming = []
         self.__save_schedule_data()
 
-    def filter_dublicates(self, post: Post) -> Post:
-        dublicates = []
-        new_hashes: List[Tuple[str, str]] = []
-        # calculating hashes and checking if exists
-        for url in post.media_urls:
-            stripped_url = strip_args_from_url(url)
-            if not stripped_url.endswith(self.dub_checker.allowed_formats):
-                continue
-            photo_hash = self.dub_checker.get_hash_from_url(url)
-            if self.dub_checker.hash_exists(photo_hash):
-                logger.info(f"Got dublicate. Hash: {photo_hash}; Url: {url}")
-                dublicates.append(url)
-            else:
-                logger.info(f"Not a dublicate. Hash: {photo_hash}; Url: {url}")
-                new_hashes.append((url, photo_hash))
-        # adding new hashes to the db
-        for url, photo_hash in new_hashes:
-            self.dub_checker.add_hash(photo_hash, url)
-        # appending filtered posts
-        if len(dublicates) == 0:
-            return post
-        else:
-            return Post(
-                media_urls=tuple(url for url in post.media_urls if not url in dublicates),
-                author_name=post.author_name,
-                source_link=post.source_link,
-                tags=post.tags
-            )
-        
-    def __is_time_for_update(self) -> bool:
-        logger.debug(f"Checking if its update time...")
-        cur_time = dt.datetime.now()
-        for i in range(len(self.__update_time)):
-            if self.__update_time[i] < cur_time:
-                # this way it will trigger next time only on the next day
-                self.__update_time[i] += dt.timedelta(days=1)
-                return True
-        logger.debug(f"It is not time for update now.")
-        return False
+    def __schedule_posts(self, posts: List[Post]) -> None:
+        self.__incoming.extend((self.__random_post_time(), post) for post in posts)
+        self.__flush_incoming()
 
     def get_time_till_next_update(self) -> dt.timedelta:
         cur_time = dt.datetime.now()
@@ -202,44 +347,82 @@ class PostManager:
         date = dt.date.today()
         return dt.datetime.combine(date, time)
 
+    @property
+    def post_schedule(self) -> List[Tuple[dt.datetime, Post]]:
+        """Scheduled posts with their time in no particular order, posts of a running update included"""
+        return [(post_time, event) for post_time, event in self.schedule if isinstance(event, Post)] + self.__incoming
+
+    def __scheduled_to_dict(self, timestamp: dt.datetime, post: Post) -> Dict[str, Any]:
+        return {
+            'timestamp': timestamp.strftime(self.time_format),
+            'post': {
+                'media_urls': list(post.media_urls),
+                'author_name': post.author_name,
+                'source_link': post.source_link,
+                'tags': list(post.tags),
+                'preview_urls': list(post.preview_urls) if post.preview_urls is not None else None,
+                'digests': list(post.digests) if post.digests is not None else None
+            }
+        }
+
+    def __scheduled_from_dict(self, scheduled: Dict[str, Any]) -> Tuple[dt.datetime, Post]:
+        return (
+            dt.datetime.strptime(scheduled['timestamp'], self.time_format),
+            Post(
+                media_urls=tuple(scheduled['post']['media_urls']),
+                author_name=scheduled['post']['author_name'],
+                source_link=scheduled['post']['source_link'],
+                tags=tuple(scheduled['post']['tags']),
+                # schedules saved before previews were added don't have them
+                preview_urls=tuple(scheduled['post']['preview_urls'])
+                    if scheduled['post'].get('preview_urls') is not None else None,
+                digests=tuple(scheduled['post']['digests'])
+                    if scheduled['post'].get('digests') is not None else None
+            )
+        )
+
     def __load_schedule_data(self) -> None:
-        if not self.__schedule_file.is_file():
-            self.post_schedule = set()
+        schedule_list: List[Tuple[dt.datetime, Post]] = []
+        if self.__schedule_file.is_file():
+            with open(self.__schedule_file, 'r', encoding='utf-8') as f:
+                schedule_list = [self.__scheduled_from_dict(scheduled) for scheduled in load(f)]
+        for post_time, post in set(schedule_list):
+            self.schedule.push(post_time, post)
+        logger.info(f"Loaded {len(schedule_list)} posts from {self.__schedule_file}")
+        if not self.__journal_file.is_file():
             return
-        
-        with open(self.__schedule_file, 'r', encoding='utf-8') as f:
-            schedule_list: List[Dict[str, Any]] = load(f)
-        
-        for i in range(len(schedule_list)):
-            schedule_list[i] = (
-                dt.datetime.strptime(schedule_list[i]['timestamp'], self.time_format),
-                Post(
-                    media_urls=tuple(schedule_list[i]['post']['media_urls']),
-                    author_name=schedule_list[i]['post']['author_name'],
-                    source_link=schedule_list[i]['post']['source_link'],
-                    tags=tuple(schedule_list[i]['post']['tags'])
-                )
-            )
-        self.post_schedule = set(schedule_list)
-        logger.info(f"Loaded {len(self.post_schedule)} posts from {self.__schedule_file}")
-        
+        # posts of an interrupted update, the file may also have them if it was saved right before
+        scheduled_posts = {post for _, post in schedule_list}
+        journal_list: List[Tuple[dt.datetime, Post]] = []
+        with open(self.__journal_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    journal_list.append(self.__scheduled_from_dict(json.loads(line)))
+                except ValueError:
+                    # the last line is cut if the process was killed while writing it
+                    logger.warning(f"Skipping broken line of {self.__journal_file}")
+        for post_time, post in journal_list:
+            if post not in scheduled_posts:
+                scheduled_posts.add(post)
+                self.schedule.push(post_time, post)
+        logger.info(f"Loaded {len(journal_list)} posts from {self.__journal_file}")
+        self.__save_schedule_data()
+
     def __save_schedule_data(self) -> None:
-        if not self.__schedule_file.is_file():
-            self.__schedule_file.touch()
-        schedule_list = list(self.post_schedule)
-        for i in range(len(schedule_list)):
-            timestamp, post = schedule_list[i][0], schedule_list[i][1]
-            schedule_list[i] = {
-                'timestamp': timestamp.strftime(self.time_format),
-                'post': {
-                    'media_urls': list(post.media_urls),
-                    'author_name': post.author_name,
-                    'source_link': post.source_link,
-                    'tags': list(post.tags)
-                }
-            }
-        with open(self.__schedule_file, 'w', encoding='utf-8') as f:
+        """Saves the schedule and clears the journal. File is replaced atomically
+        and synced to disk, so it is never left half written"""
+        schedule_list = [
+            self.__scheduled_to_dict(timestamp, post)
+            for timestamp, post in sorted(self.post_schedule, key=lambda x: x[0])
+        ]
+        tmp_file = self.__schedule_file.with_name(self.__schedule_file.name + '.tmp')
+        with open(tmp_file, 'w', encoding='utf-8') as f:
             dump(schedule_list, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.__schedule_file)
+        # the file has every journaled post now
+        self.__journal_file.unlink(missing_ok=True)
         logger.debug(f"Saved {len(schedule_list)} posts to {self.__schedule_file}")
 
     def __repr__(self) -> str:
@@ -0,0 +1,96 @@
+from typing import Iterable, Optional, Tuple
+from pathlib import Path
+from time import time
+import urllib.parse as url_parse
+import logging
+import sqlite3
+import re
+
+logger = logging.getLogger("SourceIndex")
+
+# (platform, url host regex, url path regex with the artwork id and optional page groups)
+source_patterns = (
+    ('pixiv', re.compile(r'(www\.)?pixiv\.net'), re.compile(r'^(/[a-z]{2})?/(artworks|i)/(?P<id>\d+)')),
+    ('pixiv', re.compile(r'i\.pximg\.net'), re.compile(r'/(?P<id>\d+)_p(?P<page>\d+)')),
+    ('twitter', re.compile(r'((www|mobile)\.)?(twitter|x|fxtwitter|vxtwitter|fixupx)\.com'),
+     re.compile(r'^/(\w+|i/web)/status(es)?/(?P<id>\d+)(/(photo|video)/(?P<page>\d+))?')),
+    ('artstation', re.compile(r'(www\.)?artstation\.com'), re.compile(r'^/artwork/(?P<id>\w+)')),
+    ('artstation', re.compile(r'[\w-]+\.artstation\.com'), re.compile(r'^/projects/(?P<id>\w+)')),
+)
+
+def source_identity(source_link: Optional[str]) -> Optional[Tuple[str, str]]:
+    """Finds the original artwork of a source link.
+
+    Different links to the same artwork, like twitter.com and x.com links,
+    give the same identity. Links to a single page of a multi-page artwork,
+    like pixiv's `_p1` images or twitter's `/photo/2`, keep the page in the
+    id, so other pages of the artwork aren't skipped as its dublicates.
+
+    Args:
+        source_link (Optional[str]): post's source link
+
+    Returns:
+        Optional[Tuple[str, str]]: platform and artwork id (like '123:1' with a page)
+            or None if the link is unknown
+    """
+    if not source_link:
+        return None
+    parsed = url_parse.urlparse(source_link)
+    host = parsed.netloc.lower()
+    for platform, host_re, path_re in source_patterns:
+        if not host_re.fullmatch(host):
+            continue
+        match = path_re.search(parsed.path)
+        if match:
+            page = match.groupdict().get('page')
+            return platform, match.group('id') if page is None else f"{match.group('id')}:{page}"
+    # old pixiv links have the id in the query
+    if host.endswith('pixiv.net') and parsed.path == '/member_illust.php':
+        illust_id = url_parse.parse_qs(parsed.query).get('illust_id')
+        if illust_id and illust_id[0].isdigit():
+            return 'pixiv', illust_id[0]
+    return None
+
+class SourceIndex:
+    """Persistent set of original artworks of scheduled posts.
+
+    Posts of the same artwork re-hosted by different sites are skipped
+    before any of their images are downloaded.
+    """
+    def __init__(self, db_file: Path) -> None:
+        self.con = sqlite3.connect(db_file)
+        self.con.execute("""
+            CREATE TABLE IF NOT EXISTS sources (
+                platform TEXT NOT NULL,
+                artwork_id TEXT NOT NULL,
+                source_link TEXT NOT NULL,
+                added_at REAL NOT NULL,
+                PRIMARY KEY (platform, artwork_id)
+            )
+        """)
+        self.con.commit()
+        count = self.con.execute("SELECT COUNT(*) FROM sources").fetchone()[0]
+        logger.info(f"Loaded source index {db_file} ({count} artworks)")
+
+    def contains(self, source_link: Optional[str]) -> bool:
+        """Whether a post of the same artwork was scheduled before"""
+        identity = source_identity(source_link)
+        if identity is None:
+            return False
+        return self.con.execute("""
+            SELECT 1 FROM sources WHERE platform = ? AND artwork_id = ?
+        """, identity).fetchone() is not None
+
+    def add_many(self, source_links: Iterable[Optional[str]]) -> None:
+        """Adds artworks of scheduled posts, unknown links are ignored"""
+        now = time()
+        rows = []
+        for source_link in source_links:
+            identity = source_identity(source_link)
+            if identity is not None:
+                rows.append((*identity, source_link, now))
+        with self.con:
+            self.con.executemany("""
+                INSERT OR IGNORE INTO sources(platform, artwork_id, source_link, added_at)
+                VALUES(?,?,?,?)
+            """, rows)
@@ -1,4 +1,5 @@
 from .post import Post
-from .base_parser import BaseParser
+from .base_parser import BaseParser, ScrapeTimeoutError
 
-from .danbooru import DanbooruParser, BlacklistedTag
\ No newline at end of file
+from .danbooru import DanbooruParser, BlacklistedTag, PostPreview
+from .blacklist import Blacklist, BlacklistRule
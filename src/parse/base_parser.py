@@ -1,14 +1,69 @@
-from typing import Generator
+from typing import (
+    Any, Deque, Generator, Callable, Iterable,
+    Iterator, Optional, Tuple, TypeVar
+)
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from collections import deque
 from pathlib import Path
+from time import monotonic
 import logging
+import os
 from json import load, dump
 
 from . import Post
-from src.config import config_dir, data_dir
+from .post_store import PostStore
+from src.config import config_dir, data_dir, ensure_dir
+from src.request_utils import MAX_CONCURRENT_REQUESTS
+
+T = TypeVar('T')
 
 logger = logging.getLogger("BaseParser")
 
+class ScrapeTimeoutError(TimeoutError):
+    """Raised when scraping runs past its deadline"""
+
+def check_deadline(deadline: Optional[float]) -> None:
+    """Raises ScrapeTimeoutError if deadline (time.monotonic() value) has passed"""
+    if deadline is not None and monotonic() >= deadline:
+        raise ScrapeTimeoutError("Scrape deadline has passed")
+
+class Watermark:
+    """Largest post id such that all gathered posts up to it are processed.
+
+    Posts are processed out of order (siblings wait for each other),
+    so the watermark only moves when the smallest unprocessed id is done.
+    Saving it as the last post id lets the next run resume without
+    losing unprocessed posts.
+    """
+    def __init__(self, ids: Iterable[int], start: int) -> None:
+        self.value = start
+        self.__ids = sorted(ids)
+        self.__done = set()
+        self.__pos = 0
+
+    def done(self, ids: Iterable[int]) -> bool:
+        """Marks ids as processed.
+
+        Returns:
+            bool: True if the watermark has moved
+        """
+        self.__done.update(ids)
+        moved = False
+        while self.__pos < len(self.__ids) and self.__ids[self.__pos] in self.__done:
+            self.value = max(self.value, self.__ids[self.__pos])
+            self.__pos += 1
+            moved = True
+        return moved
+
 class BaseParser:
+    # posts of all parsers are stored in the same db keyed by parser's class name
+    post_store_file = "post_store.db"
+    # must be increased when parser starts to retrieve posts differently,
+    # so posts stored by the old version are parsed again
+    parser_version = 1
+    # progress of the running scrape_posts, see save_progress
+    scrape_progress: Any = None
+
     def __init__(self, 
                  config_file: str, 
                  data_file: str,
@@ -20,8 +75,8 @@ class BaseParser:
             data_file (str): file name relative to data_dir
             default_data (dict, optional): default data to write to file if not exists. Defaults to None.
         """            
-        self.config_file_path = config_dir.joinpath(config_file)
-        self.data_file_path = data_dir.joinpath(data_file)
+        self.config_file_path = ensure_dir(config_dir).joinpath(config_file)
+        self.data_file_path = ensure_dir(data_dir).joinpath(data_file)
 
         self.config = self.load_json(
             file=self.config_file_path
@@ -32,6 +87,12 @@ class BaseParser:
             default_data=default_data
         )
 
+        self.post_store = PostStore(
+            db_file=data_dir.joinpath(self.post_store_file),
+            ttl=self.config.get('post_store_ttl_days', 30) * 24 * 60 * 60,
+            max_posts=self.config.get('post_store_max_posts', 50000)
+        )
+
     def load_json(self,
                   file: Path,
                   default_data: dict = None) -> dict | list:
@@ -63,14 +124,19 @@ class BaseParser:
     
     @staticmethod
     def _write_json(file: Path, data: dict):
-        """Writes dict into json file
+        """Writes dict into json file. File is replaced atomically,
+        so it is never left half written
 
         Args:
             file (Path): file path
             data (dict): data dict
         """
-        with open(file, 'w', encoding='utf-8') as f:
+        tmp_file = file.with_name(file.name + '.tmp')
+        with open(tmp_file, 'w', encoding='utf-8') as f:
             dump(data, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, file)
 
     def save_config(self):
         """Saves current config file at self.config_file_path"""
@@ -80,8 +146,89 @@ class BaseParser:
         """Saves data file at self.data_file_path"""
         self._write_json(self.data_file_path, self.file_data)
 
+    def fetch_stored(self, post_id: int, fetch: Callable[[], Tuple[Post, Optional[int]]]) -> Tuple[Post, Optional[int]]:
+        """Returns post and its parent id from post store or fetches and stores them.
+
+        Args:
+            post_id (int): post's id
+            fetch (Callable[[], Tuple[Post, Optional[int]]]): function that fetches the post if it is not stored
+
+        Returns:
+            Tuple[Post, Optional[int]]: post and its parent id
+        """
+        source = type(self).__name__
+        stored = self.post_store.get(source, post_id, self.parser_version)
+        if stored is not None:
+            return stored
+        post, parent_id = fetch()
+        self.post_store.put(source, post_id, post, parent_id, self.parser_version)
+        return post, parent_id
+
+    @staticmethod
+    def fetch_many(
+        urls: Iterable[str],
+        fetch: Callable[[str], T],
+        max_workers: int = MAX_CONCURRENT_REQUESTS,
+        deadline: Optional[float] = None
+    ) -> Iterator[T]:
+        """Calls fetch for every url concurrently in a bounded thread pool.
+
+        fetch is expected to request the url with request_utils functions
+        and parse the response. Per host rate limits are shared between
+        the workers, so concurrency overlaps latency and parsing without
+        raising request rate. Only up to 2 * max_workers urls are fetched
+        ahead of the consumer, so a slow consumer holds fetching back
+        instead of piling results up in memory.
+
+        Args:
+            urls (Iterable[str]): urls to fetch
+            fetch (Callable[[str], T]): function that fetches and parses a single url
+            max_workers (int, optional): max concurrent fetches. Defaults to MAX_CONCURRENT_REQUESTS.
+            deadline (Optional[float], optional): time.monotonic() value after which waiting
+                for a fetch raises ScrapeTimeoutError. Defaults to None (no limit).
+
+        Returns:
+            Iterator[T]: fetch results in the same order as urls
+        """
+        def result(future: Future) -> T:
+            timeout = None if deadline is None else max(deadline - monotonic(), 0)
+            if not wait([future], timeout=timeout).done:
+                raise ScrapeTimeoutError("Fetch is not done by the scrape deadline")
+            return future.result()
+
+        pending: Deque[Future] = deque()
+        pool = ThreadPoolExecutor(max_workers=max_workers)
+        timed_out = False
+        try:
+            for url in urls:
+                check_deadline(deadline)
+                pending.append(pool.submit(fetch, url))
+                if len(pending) >= 2 * max_workers:
+                    yield result(pending.popleft())
+            while pending:
+                yield result(pending.popleft())
+        except ScrapeTimeoutError:
+            timed_out = True
+            raise
+        finally:
+            # consumer may stop early, not fetching the rest.
+            # Fetches running past the deadline are left to finish on their own
+            pool.shutdown(wait=not timed_out, cancel_futures=True)
+
     def scrape_posts(
         self,
-        max_pages: int = 3
+        max_pages: int = 3,
+        deadline: Optional[float] = None
     ) -> Generator[Post, None, None]:
+        """Yields new posts. Progress is not saved by the generator: after
+        every yielded post `scrape_progress` covers all posts yielded so far,
+        and the caller passes it to `save_progress` once it has stored them.
+        Requests are not waited for past `deadline` (time.monotonic() value),
+        ScrapeTimeoutError is raised instead.
+        """
         raise NotImplementedError()
+
+    def save_progress(self, progress: Any) -> None:
+        """Saves `scrape_progress` of a run, so the next scrape_posts starts after it.
+        Parsers that don't resume do nothing
+        """
@@ -0,0 +1,195 @@
+from typing import (
+    Dict, FrozenSet, Iterable, List,
+    Optional, Tuple, Union
+)
+from dataclasses import dataclass
+import re
+
+# rating names to danbooru's one letter ratings
+ratings = {
+    'general': 'g', 'sensitive': 's',
+    'questionable': 'q', 'explicit': 'e'
+}
+score_re = re.compile(r'(<=|>=|<|>)?(-?\d+)?(\.\.)?(-?\d+)?')
+
+@dataclass(frozen=True)
+class BlacklistRule:
+    """Single blacklist entry in danbooru's blacklist syntax.
+
+    `tag1 tag2` - all tags must be present,
+    `-tag` - tag must be absent,
+    `~tag1 ~tag2` - at least one of the tags must be present,
+    `rating:q,e` - post has one of the ratings,
+    `score:<0`, `score:>=10`, `score:5..20` - post's score is in range.
+    Metatags may be negated with `-` as well.
+    """
+    required: FrozenSet[str] = frozenset()
+    excluded: FrozenSet[str] = frozenset()
+    any_of: FrozenSet[str] = frozenset()
+    # rating set or None if rule doesn't check rating
+    ratings: Optional[FrozenSet[str]] = None
+    excluded_ratings: Optional[FrozenSet[str]] = None
+    # inclusive (min, max) score range, None is unbounded
+    score: Optional[Tuple[Optional[int], Optional[int]]] = None
+    excluded_score: Optional[Tuple[Optional[int], Optional[int]]] = None
+
+    @classmethod
+    def parse(cls, rule: Union[str, list]) -> 'BlacklistRule':
+        """Parses a rule from config.
+
+        Args:
+            rule (Union[str, list]): rule string or [tag, [exc1, exc2, ...]] list
+                which means `tag -exc1 -exc2 ...`
+
+        Raises:
+            ValueError: if rule is invalid
+
+        Returns:
+            BlacklistRule: parsed rule
+        """
+        if isinstance(rule, list):
+            if len(rule) != 2 or not isinstance(rule[0], str):
+                raise ValueError(f"List rule must be [tag, [exceptions]], got {rule}")
+            rule = ' '.join([rule[0], *(f'-{exc}' for exc in rule[1])])
+        if not isinstance(rule, str):
+            raise ValueError(f"Rule must be str or list, got {rule}({type(rule)})")
+        fields: Dict[str, set] = {'required': set(), 'excluded': set(), 'any_of': set()}
+        metatags: Dict[str, object] = {}
+        for token in rule.lower().split():
+            negated = token.startswith('-') and len(token) > 1
+            optional = token.startswith('~') and len(token) > 1
+            name = token[1:] if negated or optional else token
+            if name.startswith('rating:'):
+                key = 'excluded_ratings' if negated else 'ratings'
+                metatags[key] = cls.__parse_ratings(name[len('rating:'):])
+            elif name.startswith('score:'):
+                key = 'excluded_score' if negated else 'score'
+                metatags[key] = cls.__parse_score(name[len('score:'):])
+            elif negated:
+                fields['excluded'].add(name)
+            elif optional:
+                fields['any_of'].add(name)
+            else:
+                fields['required'].add(name)
+        if not any(fields.values()) and not metatags:
+            raise ValueError(f"Empty blacklist rule: {rule!r}")
+        return cls(**{k: frozenset(v) for k, v in fields.items()}, **metatags)
+
+    def matches(
+        self,
+        tags: FrozenSet[str],
+        rating: Optional[str] = None,
+        score: Optional[int] = None
+    ) -> bool:
+        """Checks if post matches the rule. Metatags of unknown rating or score never match"""
+        if not self.required.issubset(tags):
+            return False
+        if not self.excluded.isdisjoint(tags):
+            return False
+        if self.any_of and self.any_of.isdisjoint(tags):
+            return False
+        if self.ratings is not None and (rating is None or rating not in self.ratings):
+            return False
+        if self.excluded_ratings is not None and (rating is None or rating in self.excluded_ratings):
+            return False
+        if self.score is not None and (score is None or not self.__in_range(score, self.score)):
+            return False
+        if self.excluded_score is not None and (score is None or self.__in_range(score, self.excluded_score)):
+            return False
+        return True
+
+    def trigger_tags(self) -> FrozenSet[str]:
+        """Tags at least one of which must be present for the rule to match.
+        Empty if rule may match a post without any specific tag"""
+        if self.required:
+            # any required tag will do, taking the longest one as the least common guess
+            return frozenset([max(sorted(self.required), key=len)])
+        return self.any_of
+
+    @staticmethod
+    def __parse_ratings(value: str) -> FrozenSet[str]:
+        parsed = set()
+        for rating in value.split(','):
+            rating = ratings.get(rating, rating)
+            if rating not in ratings.values():
+                raise ValueError(f"Unknown rating: {rating}")
+            parsed.add(rating)
+        return frozenset(parsed)
+
+    @staticmethod
+    def __parse_score(value: str) -> Tuple[Optional[int], Optional[int]]:
+        match = score_re.fullmatch(value)
+        if not value or match is None:
+            raise ValueError(f"Invalid score: {value}")
+        op, first, dots, second = match.groups()
+        first = int(first) if first is not None else None
+        second = int(second) if second is not None else None
+        if op and (dots or first is None):
+            raise ValueError(f"Invalid score: {value}")
+        if op == '<': return None, first - 1
+        if op == '<=': return None, first
+        if op == '>': return first + 1, None
+        if op == '>=': return first, None
+        if dots: return first, second
+        return first, first
+
+    @staticmethod
+    def __in_range(score: int, score_range: Tuple[Optional[int], Optional[int]]) -> bool:
+        low, high = score_range
+        return (low is None or low <= score) and (high is None or score <= high)
+
+class Blacklist:
+    """Blacklist rules compiled into an inverted index.
+
+    Rules are indexed by a tag that must be present for them to match,
+    so checking a post only evaluates rules triggered by its own tags
+    and costs O(post tags) instead of O(rules).
+    """
+    def __init__(self, rules: Iterable[BlacklistRule] = ()) -> None:
+        self.rules: List[BlacklistRule] = []
+        self.__index: Dict[str, List[BlacklistRule]] = {}
+        # rules without trigger tags are checked for every post
+        self.__unindexed: List[BlacklistRule] = []
+        for rule in rules:
+            self.add(rule)
+
+    @classmethod
+    def compile(cls, config_rules: Iterable[Union[str, list]]) -> 'Blacklist':
+        return cls(BlacklistRule.parse(rule) for rule in config_rules)
+
+    def add(self, rule: BlacklistRule) -> None:
+        self.rules.append(rule)
+        trigger_tags = rule.trigger_tags()
+        if not trigger_tags:
+            self.__unindexed.append(rule)
+        for tag in trigger_tags:
+            self.__index.setdefault(tag, []).append(rule)
+
+    def matches(
+        self,
+        tags: Iterable[str],
+        rating: Optional[str] = None,
+        score: Optional[int] = None
+    ) -> bool:
+        """Checks if a post is blacklisted.
+
+        Args:
+            tags (Iterable[str]): post's tags
+            rating (Optional[str], optional): post's one letter rating. Defaults to None (unknown).
+            score (Optional[int], optional): post's score. Defaults to None (unknown).
+
+        Returns:
+            bool: True if at least one rule matches the post
+        """
+        tags = frozenset(tags)
+        for rule in self.__unindexed:
+            if rule.matches(tags, rating, score):
+                return True
+        for tag in tags:
+            for rule in self.__index.get(tag, ()):
+                if rule.matches(tags, rating, score):
+                    return True
+        return False
+
+    def __len__(self) -> int:
+        return len(self.rules)
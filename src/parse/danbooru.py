@@ -1,21 +1,45 @@
 from typing import (
-    List, Union, Generator, 
-    Tuple, Set, Iterable
+    List, Union, Generator, Iterator,
+    Tuple, Set, Iterable, Dict, Optional, TYPE_CHECKING
 )
-from collections import OrderedDict
+from dataclasses import dataclass
 from functools import lru_cache
-from bs4 import BeautifulSoup
-from json import load, dump
-from pathlib import Path
+from importlib.util import find_spec
 import urllib.parse as url_parse
 import logging
 import re
 
-from src.request_utils import get_html
+from src.request_utils import get_html, get_json
 from . import Post, BaseParser
+from .base_parser import Watermark, check_deadline
+from .blacklist import Blacklist
+
+if TYPE_CHECKING:
+    # bs4 is only imported when html is parsed, json backend doesn't need it
+    from bs4 import BeautifulSoup, SoupStrainer
 
 logger = logging.getLogger("DanbooruParser")
 
+# lxml is a lot faster than the builtin parser, but it is optional
+soup_features = "lxml" if find_spec("lxml") else "html.parser"
+body_tag_re = re.compile(r'<body\b[^>]*>', re.IGNORECASE)
+# md5 of the file is the last part of sample and original urls
+media_md5_re = re.compile(r'/(?:sample|original)/[0-9a-f]{2}/[0-9a-f]{2}/[^/]*?([0-9a-f]{32})\.\w+$')
+
+# only these nodes are parsed from the pages
+@lru_cache(maxsize=None)
+def search_page_strainer() -> 'SoupStrainer':
+    from bs4 import SoupStrainer
+    # SoupStrainer does not match a single class of multi-class elements by itself
+    return SoupStrainer(
+        "article", class_=lambda c: c is not None and "post-preview" in c.split()
+    )
+
+@lru_cache(maxsize=None)
+def post_page_strainer() -> 'SoupStrainer':
+    from bs4 import SoupStrainer
+    return SoupStrainer(id=["image", "tag-list", "post-info-source"])
+
 class BlacklistedTag:
     def __init__(self, tag: str, exception_tags: Iterable[str] = None) -> None:
         if not isinstance(tag, str):
@@ -53,9 +77,28 @@ class BlacklistedTag:
     def __str__(self) -> str:
         return f"{self.tag}{list(self.exception_tags)}"
 
+@dataclass(frozen=True)
+class PostPreview:
+    """Post data known from a search page before fetching the post itself"""
+    post_id: int
+    url: str
+    # None if search page did not tell
+    tags: Optional[Tuple[str]] = None
+    parent_id: Optional[int] = None
+    rating: Optional[str] = None
+    score: Optional[int] = None
+
 class DanbooruParser(BaseParser):
     url = "https://danbooru.donmai.us"
     search_url = "https://danbooru.donmai.us/posts"
+    api_url = "https://danbooru.donmai.us/posts.json"
+    # max posts per page allowed by danbooru api
+    api_page_limit = 200
+    # 180x180 thumbnails are enough for 8x8 and 32x32 hashes
+    preview_url_template = "https://cdn.donmai.us/180x180/{0}/{1}/{2}.jpg"
+    # posts have preview urls since version 2 and digests since version 3
+    parser_version = 3
+    backends = ('html', 'json')
     _default_data = {
         'last_post_id': -1
     }
@@ -79,58 +122,126 @@ class DanbooruParser(BaseParser):
             self.tags = self.config['tags']
         else:
             raise ValueError(f"Config contained no tags: {self.config_file_path}")
+        # max_tags_per_query
+        self.max_tags_per_query = self.config.get('max_tags_per_query', 2)
+        if not isinstance(self.max_tags_per_query, int) or self.max_tags_per_query < 1:
+            raise ValueError(f"Invalid max_tags_per_query value")
+        self.queries = self.merge_tag_queries(self.tags, self.max_tags_per_query)
+        # backend
+        self.backend = self.config.get('backend', 'html')
+        if self.backend not in self.backends:
+            raise ValueError(f"Invalid backend value {self.backend}, must be one of {self.backends}")
+        self.api_url = self.config.get('api_url', self.api_url)
         # blacklisted_tags
-        if 'blacklisted_tags' in self.config and self.config['blacklisted_tags']:
-            self.blacklisted_tags = [BlacklistedTag.fromauto(tag) 
-                                    for tag in self.config['blacklisted_tags']]
-        else:
-            self.blacklisted_tags = []
+        self.blacklist = Blacklist.compile(self.config.get('blacklisted_tags') or [])
         logger.debug(self.tags)
-        logger.debug(self.blacklisted_tags)
+        logger.debug(self.queries)
+        logger.debug(f"{len(self.blacklist)} blacklist rules")
         logger.debug(self.file_data)
         logger.info('Initialization done')
     
     def scrape_posts(
-        self, max_posts_total: Union[int, None] = None
+        self, max_posts_total: Union[int, None] = None, deadline: Optional[float] = None
     ) -> Generator[Post, None, None]:
-        # gathering new post urls
-        new_posts_urls = self.gather_latest_posts_urls(
-            min_post_id=self.file_data['last_post_id']
-        )
-        # we also sort posts by ids so all urls are chrolonogical
-        new_posts_urls.sort(key=self.id_from_url)
+        """Yields new posts with merged siblings as soon as all siblings are parsed.
+
+        `scrape_progress` is the largest id such that every post up to it
+        is yielded or skipped, it is moved before a post is yielded. Saving
+        it with `save_progress` once the yielded posts are stored lets an
+        interrupted scrape resume from there.
+
+        Args:
+            max_posts_total (Union[int, None], optional): max posts to process. Defaults to None.
+            deadline (Optional[float], optional): time.monotonic() value after which
+                ScrapeTimeoutError is raised instead of requesting more pages. Defaults to None.
+
+        Yields:
+            Post: merged post
+        """
+        min_post_id = self.file_data['last_post_id']
+        self.scrape_progress = min_post_id
+        if self.backend == 'json':
+            # api returns whole posts with search results
+            new_posts = self.gather_latest_posts_json(min_post_id=min_post_id, deadline=deadline)
+        else:
+            # search pages only return previews, posts are fetched later
+            new_posts = [(preview, None) for preview in
+                         self.gather_latest_previews(min_post_id=min_post_id, deadline=deadline)]
+        # we also sort posts by ids so all posts are chrolonogical
+        new_posts.sort(key=lambda x: x[0].post_id)
         if isinstance(max_posts_total, int):
-            new_posts_urls = new_posts_urls[:max_posts_total]
-        logger.info(f"Gathered {len(new_posts_urls)} post urls")
-        # parsing post urls
-        posts: OrderedDict[int, List[Post]] = OrderedDict()
-        for post_url in new_posts_urls:
-            post, parent_id = self.parse_post_page(post_url)
+            new_posts = new_posts[:max_posts_total]
+        logger.info(f"Gathered {len(new_posts)} posts")
+        watermark = Watermark((preview.post_id for preview, _ in new_posts), start=min_post_id)
+        # previews already tell the tags, so blacklisted posts are not fetched
+        allowed_posts = []
+        # previews also tell parent ids, so sibling groups are known before fetching
+        group_post_ids: Dict[int, List[int]] = {}
+        for preview, post in new_posts:
+            if self.is_preview_blacklisted(preview):
+                logger.info(f"Post is blacklisted: {preview.url}")
+                watermark.done([preview.post_id])
+            else:
+                allowed_posts.append((preview, post))
+                group_post_ids.setdefault(self.group_id(preview), []).append(preview.post_id)
+        self.scrape_progress = watermark.value
+        remaining = {group_id: len(ids) for group_id, ids in group_post_ids.items()}
+        groups: Dict[int, List[Post]] = {}
+        parsed_posts = self.__parse_posts(allowed_posts, deadline)
+        for (preview, _), post in zip(allowed_posts, parsed_posts):
+            group_id = self.group_id(preview)
             if self.is_post_blacklisted(post):
                 logger.info(f"Post is blacklisted: {post}")
+            else:
+                groups.setdefault(group_id, []).append(post)
+            remaining[group_id] -= 1
+            if remaining[group_id] > 0:
                 continue
-            if parent_id in posts: posts[parent_id].append(post)
-            else: posts[parent_id] = [post]
-        # merging sibling posts
-        merged_posts = [self.merge_posts(posts[p_id]) for p_id in posts.keys()]
-        # updating max met post id
-        if new_posts_urls:
-            max_post_id = max(map(self.id_from_url, new_posts_urls))
-            if max_post_id > self.file_data['last_post_id']:
-                self.file_data['last_post_id'] = max_post_id
-                self.save_data()
-        # parser interface requires the parser to be a generator
-        for post in merged_posts:
-            # if at least one valid url
-            if len([url for url in post.media_urls if url]):
-                yield post
+            # progress covers the group before it is yielded, so it is
+            # never behind posts the caller has got
+            watermark.done(group_post_ids.pop(group_id))
+            self.scrape_progress = watermark.value
+            siblings = groups.pop(group_id, None)
+            if siblings:
+                # merging sibling posts
+                merged_post = self.merge_posts(siblings)
+                # if at least one valid url
+                if len([url for url in merged_post.media_urls if url]):
+                    yield merged_post
+
+    def save_progress(self, progress: int) -> None:
+        """Saves last post id, so the next scrape starts after it"""
+        if progress is not None and progress > self.file_data['last_post_id']:
+            self.file_data['last_post_id'] = progress
+            self.save_data()
+
+    def __parse_posts(
+        self, new_posts: List[Tuple[PostPreview, Optional[Post]]], deadline: Optional[float]
+    ) -> Iterator[Post]:
+        if self.backend == 'json':
+            yield from (post for _, post in new_posts)
+            return
+        logger.info(f"Fetching {len(new_posts)} posts")
+        for post, _ in self.fetch_many([preview.url for preview, _ in new_posts], self.fetch_post_page, deadline=deadline):
+            yield post
+        logger.info(f"Post store stats: {self.post_store.stats()}")
+
+    @staticmethod
+    def group_id(preview: PostPreview) -> int:
+        """Id of the parent post that groups siblings together"""
+        return preview.parent_id or preview.post_id
+
+    def fetch_post_page(self, url: str) -> Tuple[Post, Union[int, None]]:
+        """Returns post from post store or parses its page"""
+        return self.fetch_stored(self.id_from_url(url), lambda: self.parse_post_page(url))
 
     def is_post_blacklisted(self, post: Post) -> bool:
-        tags = set(post.tags)
-        for bl_tag in self.blacklisted_tags:
-            if not bl_tag.check(tags):
-                return True
-        return False
+        return self.blacklist.matches(post.tags)
+
+    def is_preview_blacklisted(self, preview: PostPreview) -> bool:
+        if preview.tags is None:
+            return False
+        return self.blacklist.matches(preview.tags, preview.rating, preview.score)
 
     @staticmethod
     def merge_posts(posts: List[Post]) -> Post:
@@ -141,77 +252,248 @@ class DanbooruParser(BaseParser):
             author_name=siblings[0].author_name,
             source_link=siblings[0].source_link,
             # we say that post's tags are tags that are present in ALL siblings
-            tags=tuple(set.intersection(*[set(p.tags) for p in siblings]))
+            tags=tuple(set.intersection(*[set(p.tags) for p in siblings])),
+            preview_urls=tuple(p.preview_urls[0] if p.preview_urls else None for p in siblings),
+            digests=tuple(p.digests[0] if p.digests else None for p in siblings)
         )
 
-    def gather_latest_posts_urls(
-        self, min_post_id: int = -1
-    ) -> List[str]:
-        new_posts_urls = []
-        for tag in self.tags:
-            posts_urls = self.gather_latest_posts_urls_by_tags(
-                tags=tag,
-                min_post_id=min_post_id
+    @staticmethod
+    def merge_tag_queries(tags: List[str], max_tags_per_query: int) -> List[str]:
+        """Merges single tags into OR queries like `~tag1 ~tag2`.
+
+        Entries with several tags or with operators and metatags can't be
+        OR-ed with others, so they are kept as separate queries.
+
+        Args:
+            tags (List[str]): configured tags
+            max_tags_per_query (int): max tags in a single search query
+
+        Returns:
+            List[str]: search queries
+        """
+        queries: List[str] = []
+        single_tags: Dict[str, None] = {}
+        for tag in tags:
+            if re.fullmatch(r'[^\s~\-:*][^\s:*]*', tag):
+                single_tags[tag] = None
+            elif tag not in queries:
+                queries.append(tag)
+        single_tags = list(single_tags)
+        for i in range(0, len(single_tags), max_tags_per_query):
+            chunk = single_tags[i:i + max_tags_per_query]
+            queries.append(chunk[0] if len(chunk) == 1 else ' '.join(f'~{t}' for t in chunk))
+        return queries
+
+    def query_max_pages(self, query: str) -> int:
+        """Page budget of a search query. OR queries get max_pages for each of
+        their tags, so a busy tag can't use up the pages of the rarer ones"""
+        return self.max_pages * max(1, sum(1 for tag in query.split() if tag.startswith('~')))
+
+    def gather_latest_previews(
+        self, min_post_id: int = -1, deadline: Optional[float] = None
+    ) -> List[PostPreview]:
+        # post id -> preview, dict keeps insertion order
+        new_previews: Dict[int, PostPreview] = {}
+        for query in self.queries:
+            previews = self.gather_latest_previews_by_tags(
+                tags=query,
+                min_post_id=min_post_id,
+                deadline=deadline
             )
-            for url in posts_urls:
-                if not url in new_posts_urls:
-                    new_posts_urls.append(url)
-        return new_posts_urls
-
-    def gather_latest_posts_urls_by_tags(
-        self, tags: str, min_post_id: int = -1
-    ) -> List[str]:
-        new_posts_urls = []
-        for page in range(1, self.max_pages + 1):
+            for preview in previews:
+                new_previews.setdefault(preview.post_id, preview)
+        return list(new_previews.values())
+
+    def gather_latest_previews_by_tags(
+        self, tags: str, min_post_id: int = -1, deadline: Optional[float] = None
+    ) -> List[PostPreview]:
+        new_previews = []
+        for page in range(1, self.query_max_pages(tags) + 1):
+            check_deadline(deadline)
             url = DanbooruParser.add_query_arg_to_url(
                 DanbooruParser.search_url, 
                 {"page": page, "tags": tags}
             )
-            posts_urls = DanbooruParser.parse_search_page(url)
+            previews = DanbooruParser.parse_search_page(url)
             met_old_post = False
-            for url in posts_urls:
-                if DanbooruParser.id_from_url(url) <= min_post_id:
+            for preview in previews:
+                if preview.post_id <= min_post_id:
                     met_old_post = True
                 else:
-                    new_posts_urls.append(url)
+                    new_previews.append(preview)
             if met_old_post:
                 break
-        return new_posts_urls
+        return new_previews
+
+    def gather_latest_posts_json(
+        self, min_post_id: int = -1, deadline: Optional[float] = None
+    ) -> List[Tuple[PostPreview, Post]]:
+        """Gathers new posts of all tags with danbooru json api.
+
+        Args:
+            min_post_id (int, optional): only posts with greater ids are gathered. Defaults to -1.
+            deadline (Optional[float], optional): time.monotonic() value after which
+                ScrapeTimeoutError is raised instead of requesting more pages. Defaults to None.
+
+        Returns:
+            List[Tuple[PostPreview, Post]]: preview and post for each new post
+        """
+        new_posts: Dict[int, Tuple[PostPreview, Post]] = {}
+        for query in self.queries:
+            for page in range(1, self.query_max_pages(query) + 1):
+                check_deadline(deadline)
+                url = DanbooruParser.add_query_arg_to_url(
+                    self.api_url,
+                    {"page": page, "tags": query, "limit": self.api_page_limit}
+                )
+                page_posts = get_json(url)
+                met_old_post = False
+                for post_json in page_posts:
+                    post_id = post_json['id']
+                    if post_id <= min_post_id:
+                        met_old_post = True
+                    elif post_id not in new_posts:
+                        new_posts[post_id] = self.parse_post_json(post_json)
+                if met_old_post or len(page_posts) < self.api_page_limit:
+                    break
+        return list(new_posts.values())
+
+    @staticmethod
+    def parse_post_json(post_json: dict) -> Tuple[PostPreview, Post]:
+        """Converts danbooru api post into a PostPreview and a Post.
+
+        Args:
+            post_json (dict): post object from posts.json
+
+        Returns:
+            Tuple[PostPreview, Post]: post's preview and the post
+        """
+        tags = tuple(post_json.get('tag_string', '').split())
+        artists = post_json.get('tag_string_artist', '').split()
+        source = post_json.get('source') or None
+        preview = PostPreview(
+            post_id = post_json['id'],
+            url = f"{DanbooruParser.search_url}/{post_json['id']}",
+            tags = tags,
+            parent_id = post_json.get('parent_id'),
+            rating = post_json.get('rating'),
+            score = post_json.get('score')
+        )
+        media_url = post_json.get('large_file_url') or post_json.get('file_url')
+        return preview, Post(
+            # large_file_url is the sample shown on the post page
+            media_urls = tuple([media_url]),
+            author_name = artists[0] if artists else None,
+            source_link = source if source and source.startswith('http') else None,
+            tags = tags,
+            preview_urls = tuple([post_json.get('preview_file_url') or DanbooruParser.preview_url(media_url)]),
+            digests = tuple([DanbooruParser.digest(post_json.get('md5') or DanbooruParser.media_md5(media_url))])
+        )
+
+    @staticmethod
+    def parse_search_page(url: str) -> List[PostPreview]:
+        return DanbooruParser.parse_search_html(get_html(url))
+
+    @staticmethod
+    def parse_search_html(html: str) -> List[PostPreview]:
+        from bs4 import BeautifulSoup
+        bs = BeautifulSoup(html, features=soup_features, parse_only=search_page_strainer())
+        return DanbooruParser.previews_from_search_soup(bs)
 
     @staticmethod
-    def parse_search_page(url: str) -> List[str]:
-        html = get_html(url)
-        bs = BeautifulSoup(html, features="html.parser")
-        urls = bs.find_all("a", class_="post-preview-link")
-        urls = map(lambda x: DanbooruParser.url + x.get('href'), urls)
-        urls = map(DanbooruParser.strip_args_from_url, urls)
-        return list(urls)
+    def previews_from_search_soup(bs: 'BeautifulSoup') -> List[PostPreview]:
+        previews = []
+        for article in bs.find_all("article", class_="post-preview"):
+            link = article.find("a", class_="post-preview-link")
+            if link is None:
+                continue
+            url = DanbooruParser.strip_args_from_url(DanbooruParser.url + link.get('href'))
+            post_id = article.get('data-id')
+            tags = article.get('data-tags')
+            parent_id = article.get('data-parent-id')
+            score = article.get('data-score')
+            previews.append(PostPreview(
+                post_id = int(post_id) if post_id else DanbooruParser.id_from_url(url),
+                url = url,
+                tags = tuple(tags.split()) if tags is not None else None,
+                parent_id = int(parent_id) if parent_id else None,
+                rating = article.get('data-rating'),
+                score = int(score) if score and score.lstrip('-').isdigit() else None
+            ))
+        return previews
 
     @staticmethod
-    @lru_cache(maxsize=200)
     def parse_post_page(url: str) -> Tuple[Post, Union[int, None]]:
-        html = get_html(url)
-        bs = BeautifulSoup(html, features="html.parser")
+        return DanbooruParser.parse_post_html(get_html(url))
+
+    @staticmethod
+    def parse_post_html(html: str) -> Tuple[Post, Union[int, None]]:
+        # building a tree only of the nodes we read, it is several times faster
+        # than parsing the whole page. Body is added separately with its
+        # attributes only, otherwise it would bring the whole page with it
+        from bs4 import BeautifulSoup
+        bs = BeautifulSoup(html, features=soup_features, parse_only=post_page_strainer())
+        body = body_tag_re.search(html)
+        if body:
+            bs.insert(0, BeautifulSoup(body.group(0), features="html.parser").body)
+        return DanbooruParser.post_from_soup(bs)
+
+    @staticmethod
+    def post_from_soup(bs: 'BeautifulSoup') -> Tuple[Post, Union[int, None]]:
+        media_url = DanbooruParser.__retrieve_media_url(bs)
         return Post(
-            media_urls = tuple([DanbooruParser.__retrieve_media_url(bs)]),
+            media_urls = tuple([media_url]),
             author_name = DanbooruParser.__retrieve_author_name(bs),
             source_link = DanbooruParser.__retrieve_source_link(bs),
-            tags = tuple(DanbooruParser.__retrieve_tags(bs))
+            tags = tuple(DanbooruParser.__retrieve_tags(bs)),
+            preview_urls = tuple([DanbooruParser.preview_url(media_url)]),
+            digests = tuple([DanbooruParser.digest(DanbooruParser.media_md5(media_url))])
         ), DanbooruParser.__retrieve_parent_id(bs)
 
     @staticmethod
-    def __retrieve_parent_id(bs: BeautifulSoup) -> int:
+    def preview_url(media_url: Optional[str]) -> Optional[str]:
+        """Derives url of the 180x180 thumbnail from a sample or original url.
+
+        Args:
+            media_url (Optional[str]): cdn url of the image
+
+        Returns:
+            Optional[str]: thumbnail url or None if there is no md5 in the url
+        """
+        md5 = DanbooruParser.media_md5(media_url)
+        if md5 is None:
+            return None
+        return DanbooruParser.preview_url_template.format(md5[:2], md5[2:4], md5)
+
+    @staticmethod
+    def media_md5(media_url: Optional[str]) -> Optional[str]:
+        """Returns md5 of the original file from a sample or original url, None if there is none"""
+        if not media_url:
+            return None
+        match = media_md5_re.search(DanbooruParser.strip_args_from_url(media_url))
+        return match.group(1) if match else None
+
+    @staticmethod
+    def digest(md5: Optional[str]) -> Optional[str]:
+        return f"md5:{md5}" if md5 else None
+
+    @staticmethod
+    def __retrieve_parent_id(bs: 'BeautifulSoup') -> Union[int, None]:
         body = bs.find('body')
+        if body is None:
+            return None
         # if its a child post (has a parent)
         parent_id = body.get('data-post-parent-id')
-        if parent_id != 'null':
-            return parent_id
-        # else if parent_id is null
-        # if it has no parent and it is not a parent
-        return body.get('data-post-id')
+        # else if it has no parent, post's own id
+        if parent_id in (None, 'null'):
+            parent_id = body.get('data-post-id')
+        # attributes are missing if page markup has changed, grouping uses search preview's parent id
+        if parent_id is None or not parent_id.isdigit():
+            return None
+        return int(parent_id)
 
     @staticmethod
-    def __retrieve_media_url(bs: BeautifulSoup) -> Union[str, None]:
+    def __retrieve_media_url(bs: 'BeautifulSoup') -> Union[str, None]:
         img_url = bs.find("img", id="image")
         if img_url: return img_url.get('src')
         vid_url = bs.find("video", id="image")
@@ -219,14 +501,14 @@ class DanbooruParser(BaseParser):
         return None
     
     @staticmethod
-    def __retrieve_author_name(bs: BeautifulSoup) -> Union[str, None]:
+    def __retrieve_author_name(bs: 'BeautifulSoup') -> Union[str, None]:
         ul = bs.find('ul', class_='artist-tag-list')
         if ul is None: return None
         name = ul.find('a', class_='search-tag').text
         return name.replace(' ', '_')
     
     @staticmethod
-    def __retrieve_source_link(bs: BeautifulSoup) -> Union[str, None]:
+    def __retrieve_source_link(bs: 'BeautifulSoup') -> Union[str, None]:
         li = bs.find('li', id='post-info-source')
         if li is None: return None
         a = li.find('a')
@@ -234,7 +516,7 @@ class DanbooruParser(BaseParser):
         return a.get('href')
     
     @staticmethod
-    def __retrieve_tags(bs: BeautifulSoup) -> List[str]:
+    def __retrieve_tags(bs: 'BeautifulSoup') -> List[str]:
         def has_tag_name(bs_tag):
             return bs_tag.name == 'li' and bs_tag.has_attr('data-tag-name')
         tag_box = bs.find('section', id='tag-list')
@@ -1,5 +1,5 @@
-from typing import Tuple, Optional
-from dataclasses import dataclass
+from typing import Iterable, Tuple, Optional
+from dataclasses import dataclass, replace
 
 md_special_char = ['_', ')', '(', '-', '.', '=', '!']
 
@@ -9,6 +9,31 @@ class Post:
     author_name: Optional[str] = None
     source_link: Optional[str] = None
     tags: Optional[Tuple[str]] = None
+    # low resolution copies of media_urls (same order) that are safe to hash
+    # for dublicate check, None if parser doesn't know them
+    preview_urls: Optional[Tuple[Optional[str]]] = None
+    # digests of media files (same order) given by the platform, like 'md5:<hex>'.
+    # Dublicate check matches them before downloading anything
+    digests: Optional[Tuple[Optional[str]]] = None
+
+    def hash_urls(self) -> Tuple[str]:
+        """Urls to hash for every media url, previews where possible"""
+        if self.preview_urls is None:
+            return self.media_urls
+        return tuple(preview or url for url, preview in zip(self.media_urls, self.preview_urls))
+
+    def without_media(self, urls: Iterable[str]) -> 'Post':
+        """Returns the post without some of its media urls, their previews and digests"""
+        urls = set(urls)
+        kept = [i for i, url in enumerate(self.media_urls) if url not in urls]
+        def keep(values: Optional[tuple]) -> Optional[tuple]:
+            return tuple(values[i] for i in kept) if values is not None else None
+        return replace(
+            self,
+            media_urls=keep(self.media_urls),
+            preview_urls=keep(self.preview_urls),
+            digests=keep(self.digests)
+        )
 
     def form_caption(self) -> str:
         def escape_md(s: str) -> str:
@@ -0,0 +1,143 @@
+from typing import Dict, Optional, Tuple, Union
+from threading import Lock
+from pathlib import Path
+from time import time
+import logging
+import sqlite3
+import json
+
+from .post import Post
+
+logger = logging.getLogger("PostStore")
+
+class PostStore:
+    """Persistent storage of parsed posts metadata keyed by (source, post_id).
+
+    Parsers read posts from here instead of fetching them again. Entries
+    expire after `ttl` seconds, entries parsed by another parser version
+    are ignored, and least recently used entries are evicted when there
+    are more than `max_posts` of them.
+    """
+    def __init__(self, db_file: Path, ttl: float, max_posts: int) -> None:
+        self.ttl = ttl
+        self.max_posts = max_posts
+        self.hits = 0
+        self.misses = 0
+        self.__lock = Lock()
+        self.con = sqlite3.connect(db_file, check_same_thread=False)
+        self.con.execute("""
+            CREATE TABLE IF NOT EXISTS posts (
+                source TEXT NOT NULL,
+                post_id INT NOT NULL,
+                media_urls TEXT NOT NULL,
+                author_name TEXT,
+                source_link TEXT,
+                tags TEXT,
+                parent_id INT,
+                parser_version INT NOT NULL,
+                fetched_at REAL NOT NULL,
+                last_access REAL NOT NULL,
+                preview_urls TEXT,
+                digests TEXT,
+                PRIMARY KEY (source, post_id)
+            )
+        """)
+        columns = {row[1] for row in self.con.execute("PRAGMA table_info(posts)")}
+        for column in ('preview_urls', 'digests'):
+            if column not in columns:
+                self.con.execute(f"ALTER TABLE posts ADD COLUMN {column} TEXT")
+        self.con.execute("""
+            CREATE INDEX IF NOT EXISTS posts_last_access ON posts(last_access)
+        """)
+        # expired posts are deleted on every put
+        self.con.execute("""
+            CREATE INDEX IF NOT EXISTS posts_fetched_at ON posts(fetched_at)
+        """)
+        self.con.commit()
+        self.__count = self.con.execute("SELECT COUNT(*) FROM posts").fetchone()[0]
+        logger.info(f"Loaded post store {db_file} ({self.__count} posts)")
+
+    def get(
+        self, source: str, post_id: int, parser_version: int
+    ) -> Optional[Tuple[Post, Optional[int]]]:
+        """Returns stored post and its parent id or None if it's missing, expired or outdated"""
+        with self.__lock:
+            row = self.con.execute("""
+                SELECT media_urls, author_name, source_link, tags, parent_id, preview_urls, digests
+                FROM posts
+                WHERE source = ? AND post_id = ? AND parser_version = ? AND fetched_at > ?
+            """, (source, post_id, parser_version, time() - self.ttl)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.con.execute("""
+                UPDATE posts SET last_access = ? WHERE source = ? AND post_id = ?
+            """, (time(), source, post_id))
+            self.con.commit()
+        media_urls, author_name, source_link, tags, parent_id, preview_urls, digests = row
+        return Post(
+            media_urls=tuple(json.loads(media_urls)),
+            author_name=author_name,
+            source_link=source_link,
+            tags=tuple(json.loads(tags)) if tags is not None else None,
+            preview_urls=tuple(json.loads(preview_urls)) if preview_urls is not None else None,
+            digests=tuple(json.loads(digests)) if digests is not None else None
+        ), parent_id
+
+    def put(
+        self,
+        source: str,
+        post_id: int,
+        post: Post,
+        parent_id: Optional[int],
+        parser_version: int
+    ) -> None:
+        now = time()
+        with self.__lock:
+            exists = self.con.execute("""
+                SELECT 1 FROM posts WHERE source = ? AND post_id = ?
+            """, (source, post_id)).fetchone()
+            self.con.execute("""
+                INSERT OR REPLACE INTO posts(
+                    source, post_id, media_urls, author_name, source_link,
+                    tags, parent_id, parser_version, fetched_at, last_access,
+                    preview_urls, digests
+                )
+                VALUES(?,?,?,?,?,?,?,?,?,?,?,?)
+            """, (
+                source, post_id, json.dumps(list(post.media_urls)),
+                post.author_name, post.source_link,
+                json.dumps(list(post.tags)) if post.tags is not None else None,
+                parent_id, parser_version, now, now,
+                json.dumps(list(post.preview_urls)) if post.preview_urls is not None else None,
+                json.dumps(list(post.digests)) if post.digests is not None else None
+            ))
+            if not exists:
+                self.__count += 1
+            self.__evict()
+            self.con.commit()
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        requests = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / requests, 3) if requests else 0,
+            'posts': self.__count
+        }
+
+    def __evict(self) -> None:
+        expired = self.con.execute("""
+            DELETE FROM posts WHERE fetched_at <= ?
+        """, (time() - self.ttl, )).rowcount
+        self.__count -= expired
+        if self.__count <= self.max_posts:
+            return
+        evicted = self.con.execute("""
+            DELETE FROM posts WHERE rowid IN (
+                SELECT rowid FROM posts ORDER BY last_access LIMIT ?
+            )
+        """, (self.__count - self.max_posts, )).rowcount
+        self.__count -= evicted
+        logger.debug(f"Evicted {expired} expired and {evicted} least recently used posts")
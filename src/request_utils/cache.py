@@ -0,0 +1,164 @@
+from typing import Dict, Optional, Mapping
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from threading import Lock
+from pathlib import Path
+from time import time
+import logging
+import sqlite3
+import re
+
+logger = logging.getLogger("HttpCache")
+
+@dataclass(frozen=True)
+class CacheEntry:
+    body: str
+    etag: Optional[str]
+    last_modified: Optional[str]
+    expires: float
+
+    def is_fresh(self) -> bool:
+        return time() < self.expires
+
+    def validators(self) -> Dict[str, str]:
+        """Headers that make a conditional request for this entry"""
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+class HttpCache:
+    """Persistent response cache for conditional GET requests.
+
+    Stores response bodies with their ETag and Last-Modified headers in sqlite.
+    Entries are served without a request while Cache-Control max-age allows it
+    and revalidated with If-None-Match/If-Modified-Since afterwards. When the
+    total size of stored bodies exceeds `max_bytes`, least recently used
+    entries are evicted.
+    """
+    def __init__(self, db_file: Path, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.__lock = Lock()
+        self.con = sqlite3.connect(db_file, check_same_thread=False)
+        self.con.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                url TEXT PRIMARY KEY,
+                body TEXT NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                expires REAL NOT NULL,
+                size INT NOT NULL,
+                last_access REAL NOT NULL
+            )
+        """)
+        self.con.execute("""
+            CREATE INDEX IF NOT EXISTS responses_last_access ON responses(last_access)
+        """)
+        self.con.commit()
+        self.__total_bytes = self.con.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+        logger.info(f"Loaded http cache {db_file} ({self.__total_bytes} bytes)")
+
+    def get(self, url: str) -> Optional[CacheEntry]:
+        with self.__lock:
+            row = self.con.execute("""
+                SELECT body, etag, last_modified, expires FROM responses WHERE url = ?
+            """, (url, )).fetchone()
+            if row is None:
+                return None
+            self.con.execute("""
+                UPDATE responses SET last_access = ? WHERE url = ?
+            """, (time(), url))
+            self.con.commit()
+        return CacheEntry(*row)
+
+    def store(self, url: str, body: str, headers: Mapping[str, str]) -> None:
+        """Stores a 200 response if it can be reused or revalidated later"""
+        max_age = self.parse_max_age(headers)
+        if max_age is None:
+            logger.debug(f"Not caching {url}: no-store")
+            return
+        etag, last_modified = headers.get('ETag'), headers.get('Last-Modified')
+        if max_age == 0 and not etag and not last_modified:
+            logger.debug(f"Not caching {url}: no validators")
+            return
+        size = len(body.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        now = time()
+        with self.__lock:
+            old_size = self.con.execute(
+                "SELECT size FROM responses WHERE url = ?", (url, )
+            ).fetchone()
+            self.con.execute("""
+                INSERT OR REPLACE INTO responses(url, body, etag, last_modified, expires, size, last_access)
+                VALUES(?,?,?,?,?,?,?)
+            """, (url, body, etag, last_modified, now + max_age, size, now))
+            self.__total_bytes += size - (old_size[0] if old_size else 0)
+            self.__evict()
+            self.con.commit()
+
+    def refresh(self, url: str, headers: Mapping[str, str]) -> None:
+        """Updates expiration time of an entry after a 304 response"""
+        max_age = self.parse_max_age(headers) or 0
+        with self.__lock:
+            self.con.execute("""
+                UPDATE responses SET expires = ? WHERE url = ?
+            """, (time() + max_age, url))
+            self.con.commit()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'revalidations': self.revalidations,
+            'bytes': self.__total_bytes
+        }
+
+    def __evict(self) -> None:
+        while self.__total_bytes > self.max_bytes:
+            row = self.con.execute("""
+                SELECT url, size FROM responses ORDER BY last_access LIMIT 1
+            """).fetchone()
+            if row is None:
+                self.__total_bytes = 0
+                return
+            self.con.execute("DELETE FROM responses WHERE url = ?", (row[0], ))
+            self.__total_bytes -= row[1]
+            logger.debug(f"Evicted {row[0]} ({row[1]} bytes)")
+
+    @staticmethod
+    def parse_max_age(headers: Mapping[str, str]) -> Optional[int]:
+        """Returns how long a response stays fresh in seconds or None if it must not be stored.
+
+        Args:
+            headers (Mapping[str, str]): response headers
+
+        Returns:
+            Optional[int]: freshness lifetime, 0 if it must be revalidated every time
+        """
+        cache_control = headers.get('Cache-Control', '').lower()
+        if 'no-store' in cache_control:
+            return None
+        if 'no-cache' in cache_control:
+            return 0
+        match = re.search(r'max-age=(\d+)', cache_control)
+        if match:
+            age = headers.get('Age', '0')
+            age = int(age) if age.isdigit() else 0
+            return max(int(match.group(1)) - age, 0)
+        expires = headers.get('Expires')
+        date = headers.get('Date')
+        if expires and date:
+            try:
+                lifetime = parsedate_to_datetime(expires) - parsedate_to_datetime(date)
+                return max(int(lifetime.total_seconds()), 0)
+            except (TypeError, ValueError):
+                return 0
+        return 0
@@ -0,0 +1,112 @@
+from typing import Dict, Optional
+from threading import Lock
+from time import monotonic, sleep
+import urllib.parse as url_parse
+import asyncio
+import logging
+
+logger = logging.getLogger("RequestUtils")
+
+class TokenBucket:
+    """Thread-safe token bucket.
+
+    Holds up to `burst` tokens and refills them at `rate` tokens per second.
+    Every request takes one token. When there are no tokens left the caller
+    reserves the next one and waits until it is refilled, so concurrent
+    callers are served in order and the configured rate is never exceeded.
+    """
+    def __init__(self, rate: float, burst: int = 1) -> None:
+        if rate <= 0:
+            raise ValueError(f"rate must be positive, got {rate}")
+        if burst < 1:
+            raise ValueError(f"burst must be at least 1, got {burst}")
+        self.rate = rate
+        self.burst = burst
+        self.__tokens = float(burst)
+        self.__last_refill = monotonic()
+        self.__lock = Lock()
+
+    def reserve(self) -> float:
+        """Takes a token and returns how long to wait before using it.
+
+        Returns:
+            float: seconds to wait, 0 if a token was available
+        """
+        with self.__lock:
+            now = monotonic()
+            self.__tokens = min(
+                self.burst,
+                self.__tokens + (now - self.__last_refill) * self.rate
+            )
+            self.__last_refill = now
+            self.__tokens -= 1
+            if self.__tokens >= 0:
+                return 0
+            return -self.__tokens / self.rate
+
+    def acquire(self) -> None:
+        """Blocks current thread until a token is available"""
+        to_sleep = self.reserve()
+        if to_sleep > 0:
+            logger.debug(f"Sleeping for {to_sleep:.2f} sec")
+            sleep(to_sleep)
+
+    async def acquire_async(self) -> None:
+        """Suspends current coroutine until a token is available"""
+        to_sleep = self.reserve()
+        if to_sleep > 0:
+            logger.debug(f"Sleeping for {to_sleep:.2f} sec")
+            await asyncio.sleep(to_sleep)
+
+class HostRateLimiter:
+    """Keeps a separate TokenBucket for every host.
+
+    Hosts without their own limits share the default rate and burst,
+    but each of them still gets its own bucket.
+    """
+    def __init__(self, default_rate: float, default_burst: int = 1) -> None:
+        self.default_rate = default_rate
+        self.default_burst = default_burst
+        self.__buckets: Dict[str, TokenBucket] = {}
+        self.__lock = Lock()
+
+    def configure(self, host: str, rate: float, burst: int = 1) -> None:
+        """Sets host's own rate limit.
+
+        Args:
+            host (str): host name, e.g. cdn.donmai.us
+            rate (float): allowed requests per second
+            burst (int, optional): requests allowed at once after being idle. Defaults to 1.
+        """
+        with self.__lock:
+            self.__buckets[host] = TokenBucket(rate, burst)
+        logger.info(f"Rate limit for {host}: {rate} req/sec, burst {burst}")
+
+    def bucket(self, url: str) -> TokenBucket:
+        host = url_parse.urlparse(url).netloc
+        with self.__lock:
+            if host not in self.__buckets:
+                self.__buckets[host] = TokenBucket(self.default_rate, self.default_burst)
+            return self.__buckets[host]
+
+    def acquire(self, url: str) -> None:
+        self.bucket(url).acquire()
+
+    async def acquire_async(self, url: str) -> None:
+        await self.bucket(url).acquire_async()
+
+    def load_config(self, config: Dict[str, Dict[str, float]]) -> None:
+        """Configures hosts from a dict like {host: {"rate": 0.5, "burst": 2}}.
+
+        Either `rate` (requests per second) or `delay` (seconds between requests)
+        must be set for every host.
+        """
+        for host, limits in config.items():
+            if host.startswith('_'):
+                continue
+            rate: Optional[float] = limits.get('rate')
+            if rate is None and limits.get('delay'):
+                rate = 1 / limits['delay']
+            if not rate:
+                raise ValueError(f"Rate limit of {host} must have positive 'rate' or 'delay'")
+            self.configure(host, rate, int(limits.get('burst', 1)))
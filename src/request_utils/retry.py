@@ -0,0 +1,177 @@
+from typing import Callable, Dict, Optional, Tuple, TypeVar
+from email.utils import parsedate_to_datetime
+from threading import Lock
+from time import monotonic, sleep, time
+import requests
+import logging
+import random
+
+logger = logging.getLogger("RequestUtils")
+
+T = TypeVar('T')
+# returns (is error retryable, seconds the server asked to wait,
+# does error mean that the host itself is failing)
+Classifier = Callable[[Exception], Tuple[bool, Optional[float], bool]]
+
+class HTTPStatusError(requests.exceptions.HTTPError):
+    """Raised for responses with a non successful status code"""
+    def __init__(self, response: requests.Response) -> None:
+        super().__init__(f"Got status code {response.status_code}; url {response.url}", response=response)
+        self.status_code = response.status_code
+        self.retry_after = parse_retry_after(response.headers.get('Retry-After'))
+
+class CircuitOpenError(Exception):
+    """Raised instead of sending a request to a host that keeps failing"""
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parses Retry-After header that is either seconds or an http date"""
+    if not value:
+        return None
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+def raise_for_status(response: requests.Response) -> None:
+    # 304 is a successful answer to a conditional request
+    if not response.ok and response.status_code != 304:
+        raise HTTPStatusError(response)
+
+def classify_status_code(status_code: int) -> bool:
+    """Returns if status code means that request may succeed if retried"""
+    return status_code == 429 or status_code >= 500
+
+def classify_request_error(e: Exception) -> Tuple[bool, Optional[float], bool]:
+    """Connection problems, 429 and 5xx responses are retryable host failures, other errors are not"""
+    if isinstance(e, HTTPStatusError):
+        retryable = classify_status_code(e.status_code)
+        return retryable, e.retry_after, retryable
+    if isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True, None, True
+    return False, None, False
+
+class CircuitBreaker:
+    """Stops requests to a host after `threshold` retryable failures in a row.
+
+    When the breaker of a host is open, calls fail with CircuitOpenError
+    without sending anything. After `cooldown` seconds a single trial call
+    is let through: success closes the breaker, failure opens it again.
+    """
+    def __init__(self, threshold: int = 5, cooldown: float = 300) -> None:
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.__failures: Dict[str, int] = {}
+        self.__opened_at: Dict[str, float] = {}
+        self.__lock = Lock()
+
+    def check(self, key: str) -> None:
+        """Raises CircuitOpenError if requests to key are not allowed now"""
+        with self.__lock:
+            opened_at = self.__opened_at.get(key)
+            if opened_at is None:
+                return
+            remaining = self.cooldown - (monotonic() - opened_at)
+            if remaining > 0:
+                raise CircuitOpenError(f"Circuit for {key} is open for {remaining:.0f} more sec")
+            # letting one trial call through, others keep failing until it finishes
+            self.__opened_at[key] = monotonic()
+
+    def record_success(self, key: str) -> None:
+        with self.__lock:
+            if key in self.__opened_at:
+                logger.info(f"Circuit for {key} is closed")
+            self.__failures.pop(key, None)
+            self.__opened_at.pop(key, None)
+
+    def record_failure(self, key: str) -> None:
+        with self.__lock:
+            self.__failures[key] = self.__failures.get(key, 0) + 1
+            if self.__failures[key] >= self.threshold:
+                if key not in self.__opened_at:
+                    logger.error(f"Circuit for {key} is open after {self.__failures[key]} failures")
+                self.__opened_at[key] = monotonic()
+
+class RetryPolicy:
+    """Retries calls with capped exponential backoff and full jitter.
+
+    Errors are classified by `classify`: non retryable errors are raised
+    right away, retryable ones are retried up to `max_retries` times waiting
+    at least as long as the server asked (Retry-After). Host failures are
+    reported to the circuit breaker shared by all copies of the policy.
+    """
+    def __init__(
+        self,
+        max_retries: int = 5,
+        base_delay: float = 2,
+        max_delay: float = 60,
+        breaker: Optional[CircuitBreaker] = None,
+        classify: Classifier = classify_request_error
+    ) -> None:
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.classify = classify
+
+    def copy(self, max_retries: Optional[int] = None, classify: Optional[Classifier] = None) -> 'RetryPolicy':
+        """Returns a policy with the same backoff settings and circuit breaker"""
+        return RetryPolicy(
+            max_retries=self.max_retries if max_retries is None else max_retries,
+            base_delay=self.base_delay,
+            max_delay=self.max_delay,
+            breaker=self.breaker,
+            classify=classify or self.classify
+        )
+
+    def backoff(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """Returns how long to wait before retry number `attempt` (starting from 0)"""
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def call(self, key: str, func: Callable[..., T], *args, **kwargs) -> T:
+        """Calls func with retries.
+
+        Args:
+            key (str): circuit breaker key, usually request's host
+            func (Callable[..., T]): function to call
+
+        Raises:
+            CircuitOpenError: if key's circuit is open
+            Exception: last func's exception if it is not retryable or retries are exhausted
+
+        Returns:
+            T: func's return value
+        """
+        attempt = 0
+        while True:
+            self.breaker.check(key)
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                retryable, retry_after, host_failure = self.classify(e)
+                if host_failure:
+                    self.breaker.record_failure(key)
+                else:
+                    # host has answered, it is the request that is wrong
+                    self.breaker.record_success(key)
+                if not retryable:
+                    raise
+                if attempt >= self.max_retries:
+                    logger.error(f"{func.__name__} failed after {attempt + 1} attempts: {e}")
+                    raise
+                to_sleep = self.backoff(attempt, retry_after)
+                if to_sleep > self.max_delay:
+                    logger.error(f"{func.__name__} was asked to retry in {to_sleep:.0f} sec which is too long: {e}")
+                    raise
+                attempt += 1
+                logger.warning(
+                    f"{func.__name__} failed: {e}. Retry {attempt} of {self.max_retries} in {to_sleep:.2f} sec"
+                )
+                sleep(to_sleep)
+            else:
+                self.breaker.record_success(key)
+                return result
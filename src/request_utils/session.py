@@ -0,0 +1,82 @@
+from typing import Dict, Tuple, Optional
+from requests.adapters import HTTPAdapter
+from threading import Lock
+from time import monotonic
+import urllib.parse as url_parse
+import requests
+import logging
+
+logger = logging.getLogger("RequestUtils")
+
+class SessionPool:
+    """Keeps one keep-alive requests.Session per host.
+
+    Every session shares the same default headers and proxies. Connections
+    are reused between requests to the same host, so a page or an image
+    only pays for the TCP+TLS handshake once per pool. Sessions that were
+    idle for longer than `idle_timeout` seconds are closed and recreated
+    on the next request instead of reusing half-dead connections.
+    Requests without their own timeout time out after `timeout` seconds
+    of connecting or waiting for data, so a dead connection can't hang.
+    """
+    def __init__(
+        self,
+        pool_size: int = 10,
+        idle_timeout: float = 60,
+        headers: Optional[Dict[str, str]] = None,
+        proxies: Optional[Dict[str, str]] = None,
+        timeout: Optional[float] = None
+    ) -> None:
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.headers = dict(headers) if headers else {}
+        self.proxies = dict(proxies) if proxies else {}
+        self.__sessions: Dict[str, Tuple[requests.Session, float]] = {}
+        self.__lock = Lock()
+
+    def get_session(self, url: str) -> requests.Session:
+        """Returns a session for url's host, creating it if needed.
+
+        Args:
+            url (str): any url of the target host
+
+        Returns:
+            requests.Session: pooled session of the host
+        """
+        host = url_parse.urlparse(url).netloc
+        now = monotonic()
+        with self.__lock:
+            session, last_used = self.__sessions.get(host, (None, now))
+            if session is not None and now - last_used > self.idle_timeout:
+                logger.debug(f"Session for {host} was idle for {now - last_used:.0f} sec. Reopening")
+                session.close()
+                session = None
+            if session is None:
+                session = self.__new_session()
+                logger.debug(f"Opened new session for {host}")
+            self.__sessions[host] = (session, now)
+        return session
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault('timeout', self.timeout)
+        return self.get_session(url).request(method, url, **kwargs)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request('GET', url, **kwargs)
+
+    def close(self) -> None:
+        """Closes all pooled sessions"""
+        with self.__lock:
+            for session, _ in self.__sessions.values():
+                session.close()
+            self.__sessions.clear()
+
+    def __new_session(self) -> requests.Session:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.headers.update(self.headers)
+        session.proxies.update(self.proxies)
+        return session
@@ -1,15 +1,25 @@
 from dotenv import load_dotenv, find_dotenv
-from secrets import token_hex
-from time import time, sleep
-from typing import Iterable
+from typing import BinaryIO, Optional, Union
+from json import load, loads
 from functools import wraps
 from pathlib import Path
+from threading import Lock
+from io import BytesIO
 import urllib.parse as url_parse
 import requests
 import logging
 import os
 import re
 
+from .session import SessionPool
+from .ratelimit import HostRateLimiter
+from .cache import HttpCache
+from .retry import (
+    RetryPolicy, CircuitBreaker, CircuitOpenError,
+    raise_for_status, classify_request_error, classify_status_code
+)
+from src.config import config_dir, data_dir, ensure_dir
+
 logger = logging.getLogger("RequestUtils")
 
 ################
@@ -38,52 +48,138 @@ if not MAX_REQUEST_RETRIES.isdigit():
 else:
     MAX_REQUEST_RETRIES = int(MAX_REQUEST_RETRIES)
 logger.info(f"MAX_REQUEST_RETRIES={MAX_REQUEST_RETRIES}")
+# RETRY_BASE_DELAY
+RETRY_BASE_DELAY = os.getenv('RETRY_BASE_DELAY', '2')
+if not RETRY_BASE_DELAY.isdigit():
+    RETRY_BASE_DELAY = 2
+else:
+    RETRY_BASE_DELAY = float(RETRY_BASE_DELAY)
+logger.info(f"RETRY_BASE_DELAY={RETRY_BASE_DELAY}")
+# RETRY_MAX_DELAY
+RETRY_MAX_DELAY = os.getenv('RETRY_MAX_DELAY', '60')
+if not RETRY_MAX_DELAY.isdigit():
+    RETRY_MAX_DELAY = 60
+else:
+    RETRY_MAX_DELAY = float(RETRY_MAX_DELAY)
+logger.info(f"RETRY_MAX_DELAY={RETRY_MAX_DELAY}")
+# CIRCUIT_BREAKER_THRESHOLD
+CIRCUIT_BREAKER_THRESHOLD = os.getenv('CIRCUIT_BREAKER_THRESHOLD', '5')
+if not CIRCUIT_BREAKER_THRESHOLD.isdigit() or int(CIRCUIT_BREAKER_THRESHOLD) < 1:
+    CIRCUIT_BREAKER_THRESHOLD = 5
+else:
+    CIRCUIT_BREAKER_THRESHOLD = int(CIRCUIT_BREAKER_THRESHOLD)
+logger.info(f"CIRCUIT_BREAKER_THRESHOLD={CIRCUIT_BREAKER_THRESHOLD}")
+# CIRCUIT_BREAKER_COOLDOWN
+CIRCUIT_BREAKER_COOLDOWN = os.getenv('CIRCUIT_BREAKER_COOLDOWN', '600')
+if not CIRCUIT_BREAKER_COOLDOWN.isdigit():
+    CIRCUIT_BREAKER_COOLDOWN = 600
+else:
+    CIRCUIT_BREAKER_COOLDOWN = float(CIRCUIT_BREAKER_COOLDOWN)
+logger.info(f"CIRCUIT_BREAKER_COOLDOWN={CIRCUIT_BREAKER_COOLDOWN}")
+# REQUEST_POOL_SIZE
+REQUEST_POOL_SIZE = os.getenv('REQUEST_POOL_SIZE', '10')
+if not REQUEST_POOL_SIZE.isdigit() or int(REQUEST_POOL_SIZE) < 1:
+    REQUEST_POOL_SIZE = 10
+else:
+    REQUEST_POOL_SIZE = int(REQUEST_POOL_SIZE)
+logger.info(f"REQUEST_POOL_SIZE={REQUEST_POOL_SIZE}")
+# REQUEST_POOL_IDLE_TIMEOUT
+REQUEST_POOL_IDLE_TIMEOUT = os.getenv('REQUEST_POOL_IDLE_TIMEOUT', '60')
+if not REQUEST_POOL_IDLE_TIMEOUT.isdigit():
+    REQUEST_POOL_IDLE_TIMEOUT = 60
+else:
+    REQUEST_POOL_IDLE_TIMEOUT = float(REQUEST_POOL_IDLE_TIMEOUT)
+logger.info(f"REQUEST_POOL_IDLE_TIMEOUT={REQUEST_POOL_IDLE_TIMEOUT}")
+# REQUEST_TIMEOUT
+REQUEST_TIMEOUT = os.getenv('REQUEST_TIMEOUT', '30')
+if not REQUEST_TIMEOUT.isdigit() or int(REQUEST_TIMEOUT) < 1:
+    REQUEST_TIMEOUT = 30
+else:
+    REQUEST_TIMEOUT = float(REQUEST_TIMEOUT)
+logger.info(f"REQUEST_TIMEOUT={REQUEST_TIMEOUT}")
+# MAX_CONCURRENT_REQUESTS
+MAX_CONCURRENT_REQUESTS = os.getenv('MAX_CONCURRENT_REQUESTS', '4')
+if not MAX_CONCURRENT_REQUESTS.isdigit() or int(MAX_CONCURRENT_REQUESTS) < 1:
+    MAX_CONCURRENT_REQUESTS = 4
+else:
+    MAX_CONCURRENT_REQUESTS = int(MAX_CONCURRENT_REQUESTS)
+logger.info(f"MAX_CONCURRENT_REQUESTS={MAX_CONCURRENT_REQUESTS}")
+# HTTP_CACHE_MAX_BYTES
+HTTP_CACHE_MAX_BYTES = os.getenv('HTTP_CACHE_MAX_BYTES', '50000000')
+if not HTTP_CACHE_MAX_BYTES.isdigit():
+    HTTP_CACHE_MAX_BYTES = 50_000_000
+else:
+    HTTP_CACHE_MAX_BYTES = int(HTTP_CACHE_MAX_BYTES)
+logger.info(f"HTTP_CACHE_MAX_BYTES={HTTP_CACHE_MAX_BYTES}")
 
-last_request = time()
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
 headers = {
     'User-Agent': "python-requests",
     'Accept': 'text/html',
 }
+session_pool = SessionPool(
+    pool_size=REQUEST_POOL_SIZE,
+    idle_timeout=REQUEST_POOL_IDLE_TIMEOUT,
+    headers=headers,
+    proxies={'https': USE_PROXY} if USE_PROXY else None,
+    timeout=REQUEST_TIMEOUT
+)
+# hosts without their own limits are requested not sooner than REQUEST_DELAY
+# seconds after the previous request to the same host
+rate_limiter = HostRateLimiter(default_rate=1 / max(REQUEST_DELAY, 0.001))
+rate_limits_file = config_dir.joinpath('rate_limits.json')
+if rate_limits_file.is_file():
+    with open(rate_limits_file, 'r', encoding='utf-8') as f:
+        rate_limiter.load_config(load(f))
+# one policy and circuit breaker for every request, posting included
+retry_policy = RetryPolicy(
+    max_retries=MAX_REQUEST_RETRIES,
+    base_delay=RETRY_BASE_DELAY,
+    max_delay=RETRY_MAX_DELAY,
+    breaker=CircuitBreaker(
+        threshold=CIRCUIT_BREAKER_THRESHOLD,
+        cooldown=CIRCUIT_BREAKER_COOLDOWN
+    )
+)
+# response cache is opened on the first request, so importing the module doesn't create data dir
+__http_cache: Optional[HttpCache] = None
+__http_cache_lock = Lock()
+
+def get_http_cache() -> Optional[HttpCache]:
+    """Returns the response cache opening it on the first call.
+    None if HTTP_CACHE_MAX_BYTES is 0, which disables the cache
+    """
+    global __http_cache
+    if HTTP_CACHE_MAX_BYTES <= 0:
+        return None
+    with __http_cache_lock:
+        if __http_cache is None:
+            __http_cache = HttpCache(
+                db_file=ensure_dir(data_dir).joinpath('http_cache.db'),
+                max_bytes=HTTP_CACHE_MAX_BYTES
+            )
+    return __http_cache
 
 ################
 #  DECORATORS  #
 ################
 
-def delayed(f):
-    """Halts request until delay has passed globaly. NOT MULTITHREAD SAFE"""
+def rate_limited(f):
+    """Halts request until url's host rate limit allows it. Url must be the first argument"""
     @wraps(f)
-    def wrapper(*args, **kwargs):
-        global last_request
-        now = time()
-        if now - last_request < REQUEST_DELAY:
-            to_sleep = REQUEST_DELAY - now + last_request
-            logger.debug(f"Sleeping for {to_sleep:.2f} sec")
-            sleep(to_sleep)
-        ret = f(*args, **kwargs)
-        last_request = time()
-        return ret
+    def wrapper(url: str, *args, **kwargs):
+        rate_limiter.acquire(url)
+        return f(url, *args, **kwargs)
     return wrapper
 
-def retry(times, exceptions):
-    """
-    Credit: https://stackoverflow.com/questions/50246304/using-python-decorators-to-retry-request
-    """
+def retry(policy: RetryPolicy):
+    """Retries request with policy. Url must be the first argument, its host is the circuit breaker key"""
     def decorator(func):
         @wraps(func)
-        def newfn(*args, **kwargs):
-            attempt = 0
-            while attempt < times:
-                try:
-                    return func(*args, **kwargs)
-                except exceptions:
-                    logger.error(
-                        'Exception thrown when attempting to run %s, attempt '
-                        '%d of %d' % (func, attempt, times)
-                    )
-                    attempt += 1
-                    sleep(10)
-            return func(*args, **kwargs)
-        return newfn
+        def wrapper(url: str, *args, **kwargs):
+            host = url_parse.urlparse(url).netloc
+            return policy.call(host, func, url, *args, **kwargs)
+        return wrapper
     return decorator
 
 #################
@@ -103,25 +199,80 @@ def strip_args_from_url(url: str) -> str:
 #   REQUESTS   #
 ################
 
-@retry(MAX_REQUEST_RETRIES, requests.exceptions.ConnectionError)
-@delayed
 def get_html(url: str) -> str:
-    logger.info(f"Getting {url}. Proxy: {USE_PROXY}")
-    if USE_PROXY:
-        r = requests.get(url, proxies={'https':USE_PROXY}, headers=headers)
-    else:
-        r = requests.get(url, headers=headers)
+    return _get_text(url)
+
+def get_json(url: str) -> Union[dict, list]:
+    return loads(_get_text(url, {'Accept': 'application/json'}))
+
+def _get_text(url: str, extra_headers: dict = None) -> str:
+    extra_headers = dict(extra_headers) if extra_headers else {}
+    http_cache = get_http_cache()
+    if http_cache is None:
+        return _request_text(url, extra_headers).text
+    cached = http_cache.get(url)
+    if cached is not None and cached.is_fresh():
+        http_cache.hits += 1
+        logger.info(f"Getting {url} from cache")
+        return cached.body
+    if cached is not None:
+        extra_headers.update(cached.validators())
+    r = _request_text(url, extra_headers)
+    if r.status_code == 304 and cached is not None:
+        http_cache.revalidations += 1
+        http_cache.refresh(url, r.headers)
+        return cached.body
+    http_cache.misses += 1
+    if r.status_code == 200:
+        http_cache.store(url, r.text, r.headers)
     return r.text
 
-@retry(MAX_REQUEST_RETRIES, requests.exceptions.ConnectionError)
-@delayed
-def download_photo(photo_url: str, save_path: Path) -> None:   
+@retry(retry_policy)
+@rate_limited
+def _request_text(url: str, extra_headers: dict = None) -> requests.Response:
+    logger.info(f"Getting {url}. Proxy: {USE_PROXY}")
+    r = session_pool.get(url, headers=extra_headers)
+    raise_for_status(r)
+    return r
+
+class DownloadTooLargeError(ValueError):
+    """Raised when a download exceeds its max_bytes limit"""
+
+def _stream_download(photo_url: str, handler: BinaryIO, max_bytes: int = None) -> None:
     logger.debug(f"Dowloading {photo_url}. Proxy: {USE_PROXY}")
-    if USE_PROXY:
-        r = requests.get(photo_url, proxies={'https':USE_PROXY}, headers=headers)
-    else:
-        r = requests.get(photo_url, headers=headers)
-    if not r.ok:
-        raise ValueError(f"Cant download photo. code {r.status_code}; url {photo_url}")
+    with session_pool.get(photo_url, stream=True) as r:
+        raise_for_status(r)
+        content_length = r.headers.get('Content-Length', '')
+        if max_bytes and content_length.isdigit() and int(content_length) > max_bytes:
+            raise DownloadTooLargeError(f"Photo is {content_length} bytes, max is {max_bytes}; url {photo_url}")
+        downloaded = 0
+        for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            downloaded += len(chunk)
+            # Content-Length may be missing or wrong, so checking the real size too
+            if max_bytes and downloaded > max_bytes:
+                raise DownloadTooLargeError(f"Photo is over {max_bytes} bytes; url {photo_url}")
+            handler.write(chunk)
+
+@retry(retry_policy)
+@rate_limited
+def download_photo(photo_url: str, save_path: Path, max_bytes: int = None) -> None:
     with open(save_path, 'wb') as handler:
-        handler.write(r.content)
+        _stream_download(photo_url, handler, max_bytes)
+
+@retry(retry_policy)
+@rate_limited
+def download_photo_to_memory(photo_url: str, max_bytes: int = None) -> BytesIO:
+    """Downloads photo into an in-memory buffer without touching the disk.
+
+    Args:
+        photo_url (str): photo url
+        max_bytes (int, optional): download is aborted with DownloadTooLargeError
+            as soon as it exceeds this size. Defaults to None (no limit).
+
+    Returns:
+        BytesIO: buffer with the photo, positioned at the start
+    """
+    buffer = BytesIO()
+    _stream_download(photo_url, buffer, max_bytes)
+    buffer.seek(0)
+    return buffer
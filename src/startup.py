@@ -0,0 +1,24 @@
+from typing import Iterator, List, Tuple
+from contextlib import contextmanager
+from time import perf_counter
+
+class StartupTimer:
+    """Measures how long import and initialization phases of the process take"""
+    def __init__(self) -> None:
+        self.phases: List[Tuple[str, float]] = []
+        self.__started = perf_counter()
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, perf_counter() - started))
+
+    def report(self) -> str:
+        lines = [f"{name}: {duration * 1000:.0f} ms" for name, duration in self.phases]
+        lines.append(f"total: {(perf_counter() - self.__started) * 1000:.0f} ms")
+        return "Startup time\n" + '\n'.join(lines)
+
+startup_timer = StartupTimer()
@@ -1,34 +1,57 @@
-from requests.exceptions import ConnectionError
 from dotenv import load_dotenv, find_dotenv
 from random import randint
-from typing import List, Union, Tuple
-from time import sleep
+from typing import List, Union, Tuple, Optional
+from threading import Lock
 from pytgbot.api_types.sendable.input_media import InputMediaPhoto, InputMediaVideo, InputMedia
 import logging
 import pytgbot
 import os
 
-from src.request_utils import add_query_arg_to_url, strip_args_from_url
+from src.request_utils import (
+    add_query_arg_to_url, strip_args_from_url,
+    retry_policy, classify_request_error, classify_status_code
+)
+from src.config import log_dir, ensure_dir
 
 logger = logging.getLogger("TelegramBot")
 
-log_file = "log/bot.log"
-os.makedirs(os.path.dirname(log_file), exist_ok=True)
-fh = logging.FileHandler(log_file)
+log_file = log_dir.joinpath("bot.log")
+# log file is opened on the first record, log dir is created on the first post
+fh = logging.FileHandler(log_file, delay=True)
 fh.setLevel(logging.DEBUG)
 logger.addHandler(fh)
 
-load_dotenv(find_dotenv('secret.env', raise_error_if_not_found=True))
-
-__bot = pytgbot.Bot(os.getenv('TG_TOKEN'))
-__channel_id = os.getenv('CHANNEL_ID')
+# bot is created on the first post, so importing the module
+# neither reads secrets nor sets up the api client
+__bot: Optional[pytgbot.Bot] = None
+__channel_id: Optional[str] = None
+__bot_lock = Lock()
 
 photo_formats = (".jpg", ".jpeg", ".png")
 #video_formats = (".mp4", ".mkv", ".gif")
 video_formats = (".gif",)
 
+# circuit breaker key of the telegram api
+tg_api_host = "api.telegram.org"
+
+def __get_bot() -> pytgbot.Bot:
+    """Returns the bot creating it on the first call.
+
+    Raises:
+        IOError: if secret.env is missing
+    """
+    global __bot, __channel_id
+    with __bot_lock:
+        if __bot is None:
+            load_dotenv(find_dotenv('secret.env', raise_error_if_not_found=True))
+            __channel_id = os.getenv('CHANNEL_ID')
+            __bot = pytgbot.Bot(os.getenv('TG_TOKEN'))
+            logger.info("Telegram bot created")
+    return __bot
+
 def __send_photo(photo_url: str, caption: str) -> None:
-    __bot.send_photo(
+    bot = __get_bot()
+    bot.send_photo(
         __channel_id,
         photo=photo_url,
         caption=caption,
@@ -36,7 +59,8 @@ def __send_photo(photo_url: str, caption: str) -> None:
     )
 
 def __send_video(video_url: str, caption: str) -> None:
-    __bot.send_video(
+    bot = __get_bot()
+    bot.send_video(
         __channel_id,
         video=video_url,
         caption=caption,
@@ -48,6 +72,21 @@ def __add_random_argument(url: str) -> str:
     # https://stackoverflow.com/questions/49645510/telegram-bot-send-photo-by-url-returns-bad-request-wrong-file-identifier-http/62672868#62672868
     return add_query_arg_to_url(url, {'random': randint(0, 10_000)})
 
+def __tg_retry_after(e: pytgbot.exceptions.TgApiServerException) -> Optional[float]:
+    # telegram tells how long to wait in "parameters" of 429 responses
+    try:
+        return float(e.response.json()['parameters']['retry_after'])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+
+def __classify_tg_error(e: Exception) -> Tuple[bool, Optional[float], bool]:
+    # telegram fails to fetch media by url from time to time (400 included),
+    # so every api error is worth retrying, but only 429 and 5xx mean that the api is down
+    if isinstance(e, pytgbot.exceptions.TgApiServerException):
+        host_failure = isinstance(e.error_code, int) and classify_status_code(e.error_code)
+        return True, __tg_retry_after(e), host_failure
+    return classify_request_error(e)
+
 def send_single_media(media_url: str, caption: str, max_retries: int = 5) -> None:
     if media_url.endswith(photo_formats): handler = __send_photo
     elif media_url.endswith(video_formats): handler = __send_video
@@ -55,19 +94,18 @@ def send_single_media(media_url: str, caption: str, max_retries: int = 5) -> Non
         logger.error(f"send_single_media unsupported format: {media_url}")
         return
     
-    for i in range(max_retries):
-        try:
-            handler(
-                __add_random_argument(media_url),
-                caption=caption
-            )
-            break
-        except (pytgbot.exceptions.TgApiServerException, ConnectionError) as e:
-            if i + 1 == max_retries:
-                logger.error(f"send_single_media Handler: {handler.__name__}\nException: {e}\nmedia_url:{media_url}")
-                raise
-            else:
-                sleep(2)
+    def send_single():
+        handler(
+            __add_random_argument(media_url),
+            caption=caption
+        )
+    try:
+        retry_policy.copy(max_retries=max_retries - 1, classify=__classify_tg_error).call(
+            tg_api_host, send_single
+        )
+    except Exception as e:
+        logger.error(f"send_single_media Handler: {handler.__name__}\nException: {e}\nmedia_url:{media_url}")
+        raise
 
 def __send_media_group(media_urls: List[str], caption: str, max_retries: int = 5) -> None:
     # converting everything in InputMedia objects since
@@ -94,28 +132,29 @@ def __send_media_group(media_urls: List[str], caption: str, max_retries: int = 5
     converted_media[0].caption = caption
     converted_media[0].parse_mode = "MarkdownV2"
 
-    __bot.send_media_group(
+    bot = __get_bot()
+    bot.send_media_group(
         __channel_id,
         media=converted_media
     )
 
 def send_several_media(media: List[str], caption: str, max_retries: int = 5) -> None:
-    for i in range(max_retries):
-        try:
-            __send_media_group(
-                [ __add_random_argument(url) for url in media ],
-                caption=caption,
-                max_retries=max_retries
-            )
-            break
-        except (pytgbot.exceptions.TgApiServerException, ConnectionError) as e:
-            if i + 1 == max_retries:
-                logger.error(f"send_several_media Exception: {e}\nmedia:{media}")
-                raise
-            else:
-                sleep(2)
+    def send_group():
+        __send_media_group(
+            [ __add_random_argument(url) for url in media ],
+            caption=caption,
+            max_retries=max_retries
+        )
+    try:
+        retry_policy.copy(max_retries=max_retries - 1, classify=__classify_tg_error).call(
+            tg_api_host, send_group
+        )
+    except Exception as e:
+        logger.error(f"send_several_media Exception: {e}\nmedia:{media}")
+        raise
 
 def send_media(media: Union[str, Tuple[str], List[str]], caption: str, max_retries: int = 5) -> None:
+    ensure_dir(log_dir)
     if isinstance(media, (tuple, list)) and len(media) == 1:
         media = media[0]
 
@@ -1,2 +1,7 @@
 from .parsers import *
-from .test_dublicate_checker import *
\ No newline at end of file
+from .test_dublicate_checker import *
+from .test_request_utils import *
+from .test_hash_index import *
+from .test_source_index import *
+from .test_event_queue import *
+from .test_post_manager import *
@@ -1 +1,5 @@
-from .test_danbooru import TestDanbooruParser
\ No newline at end of file
+from .test_danbooru import TestDanbooruParser
+from .test_danbooru_api import TestDanbooruJsonApi
+from .test_danbooru_html import TestDanbooruHtml
+from .test_blacklist import TestBlacklist
+from .test_post_store import TestPostStore
\ No newline at end of file
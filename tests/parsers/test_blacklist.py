@@ -0,0 +1,44 @@
+import unittest
+
+from src.parse import Blacklist, BlacklistRule
+
+class TestBlacklist(unittest.TestCase):
+    def test_legacy_rules(self) -> None:
+        bl = Blacklist.compile(['2girls', ['1girl', ['signalis', 'scenery']]])
+        self.assertTrue(bl.matches(['2girls', 'signalis']))
+        self.assertTrue(bl.matches(['1girl', 'solo']))
+        self.assertFalse(bl.matches(['1girl', 'signalis']))
+        self.assertFalse(bl.matches(['1boy']))
+
+    def test_boolean_expressions(self) -> None:
+        bl = Blacklist.compile(['1girl solo -signalis', '~gore ~guro'])
+        self.assertTrue(bl.matches(['1girl', 'solo']))
+        self.assertFalse(bl.matches(['1girl']))
+        self.assertFalse(bl.matches(['1girl', 'solo', 'signalis']))
+        self.assertTrue(bl.matches(['guro', 'signalis']))
+        self.assertFalse(bl.matches(['scenery']))
+
+    def test_metatags(self) -> None:
+        bl = Blacklist.compile(['rating:q,explicit', 'score:<0', 'comic -score:>=100'])
+        self.assertTrue(bl.matches(['scenery'], rating='e', score=5))
+        self.assertFalse(bl.matches(['scenery'], rating='g', score=5))
+        self.assertTrue(bl.matches(['scenery'], rating='g', score=-1))
+        self.assertTrue(bl.matches(['comic'], rating='g', score=99))
+        self.assertFalse(bl.matches(['comic'], rating='g', score=100))
+        # unknown rating and score never match
+        self.assertFalse(bl.matches(['scenery']))
+
+    def test_score_ranges(self) -> None:
+        self.assertEqual(BlacklistRule.parse('score:5..10').score, (5, 10))
+        self.assertEqual(BlacklistRule.parse('score:..10').score, (None, 10))
+        self.assertEqual(BlacklistRule.parse('score:>5').score, (6, None))
+        self.assertEqual(BlacklistRule.parse('score:7').score, (7, 7))
+        for invalid in ('score:', 'score:>..5', 'score:1..x', 'rating:x', '', ['a']):
+            with self.assertRaises(ValueError):
+                BlacklistRule.parse(invalid)
+
+    def test_many_rules(self) -> None:
+        bl = Blacklist.compile([f'tag_{i} -exc_{i}' for i in range(5000)])
+        self.assertTrue(bl.matches(['tag_4999', 'exc_1']))
+        self.assertFalse(bl.matches(['tag_4999', 'exc_4999']))
+        self.assertFalse(bl.matches(['tag_5000']))
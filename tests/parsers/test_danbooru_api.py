@@ -0,0 +1,167 @@
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from threading import Thread
+from pathlib import Path
+from typing import List
+import urllib.parse as url_parse
+import unittest
+import json
+import os
+
+from src.parse import DanbooruParser
+from src.config import config_dir, data_dir
+from src.request_utils import rate_limiter
+
+fixtures_dir = Path(__file__).parent.joinpath('fixtures')
+
+class DanbooruStandIn(BaseHTTPRequestHandler):
+    """Serves recorded posts.json filtered by requested tags"""
+    posts: List[dict] = []
+    requests: List[dict] = []
+
+    def do_GET(self):
+        url = url_parse.urlparse(self.path)
+        query = url_parse.parse_qs(url.query)
+        type(self).requests.append(query)
+        if url.path != '/posts.json':
+            self.send_error(404)
+            return
+        tags = query.get('tags', [''])[0].split()
+        required = [t for t in tags if not t.startswith('~')]
+        any_of = [t[1:] for t in tags if t.startswith('~')]
+        page = int(query.get('page', ['1'])[0])
+        limit = int(query.get('limit', ['200'])[0])
+        posts = [p for p in self.posts
+                 if all(t in p['tag_string'].split() for t in required)
+                 and (not any_of or any(t in p['tag_string'].split() for t in any_of))]
+        posts = posts[(page - 1) * limit:page * limit]
+        body = json.dumps(posts).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class TestDanbooruJsonApi(unittest.TestCase):
+    _dummy_config = 'dummy_api_config.json'
+    _dummy_data = 'dummy_api_data.json'
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        with open(fixtures_dir.joinpath('danbooru_posts.json'), 'r', encoding='utf-8') as f:
+            DanbooruStandIn.posts = json.load(f)
+        cls.server = HTTPServer(('127.0.0.1', 0), DanbooruStandIn)
+        cls.host = f'127.0.0.1:{cls.server.server_port}'
+        rate_limiter.configure(cls.host, rate=1000, burst=100)
+        Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self) -> None:
+        DanbooruStandIn.requests = []
+
+    def tearDown(self) -> None:
+        for file in (config_dir.joinpath(self._dummy_config), data_dir.joinpath(self._dummy_data)):
+            if file.is_file():
+                os.remove(file)
+
+    def create_parser(self, config: dict) -> DanbooruParser:
+        config = {
+            'max_pages': 2,
+            'backend': 'json',
+            'api_url': f'http://{self.host}/posts.json',
+            **config
+        }
+        with open(config_dir.joinpath(self._dummy_config), 'w', encoding='utf-8') as f:
+            json.dump(config, f, indent=4)
+        return DanbooruParser(config_file=self._dummy_config, data_file=self._dummy_data)
+
+    def test_scrape(self) -> None:
+        dp = self.create_parser({'tags': ['signalis']})
+        posts = list(dp.scrape_posts())
+        # one request per page instead of one per post
+        self.assertEqual(len(DanbooruStandIn.requests), 1)
+        self.assertEqual(len(posts), 3)
+        # chronological order, siblings are merged
+        self.assertEqual(posts[0].author_name, 'funkiflame')
+        self.assertEqual(posts[0].source_link, 'https://www.pixiv.net/artworks/127045512')
+        self.assertIsNone(posts[1].source_link)
+        self.assertEqual(len(posts[2].media_urls), 2)
+        self.assertEqual(
+            set(posts[2].tags),
+            {'1girl', 'elster_(signalis)', 'signalis', 'fune_(nkjrs12)', 'highres'}
+        )
+        self.assertTrue(posts[2].media_urls[0].endswith('sample-b2ed9ea15fc0f0b784882fcca184210e.jpg'))
+        self.assertEqual(
+            posts[2].preview_urls[0],
+            'https://cdn.donmai.us/180x180/b2/ed/b2ed9ea15fc0f0b784882fcca184210e.jpg'
+        )
+        self.assertEqual(len(posts[2].preview_urls), 2)
+        self.assertEqual(posts[2].digests[0], 'md5:b2ed9ea15fc0f0b784882fcca184210e')
+        self.assertEqual(dp.scrape_progress, 8812004)
+        # progress is saved by the caller once it has stored the posts
+        self.assertEqual(dp.file_data['last_post_id'], -1)
+        dp.save_progress(dp.scrape_progress)
+        self.assertEqual(dp.load_json(dp.data_file_path)['last_post_id'], 8812004)
+
+    def test_scrape_only_new_posts(self) -> None:
+        dp = self.create_parser({'tags': ['signalis']})
+        dp.file_data['last_post_id'] = 8811950
+        posts = list(dp.scrape_posts())
+        self.assertEqual(len(posts), 1)
+        self.assertEqual(len(posts[0].media_urls), 2)
+
+    def test_scrape_checkpoints(self) -> None:
+        dp = self.create_parser({'tags': ['signalis']})
+        posts = dp.scrape_posts()
+        next(posts)
+        # progress covers the yielded post, but the parser doesn't save it
+        self.assertEqual(dp.scrape_progress, 8811102)
+        self.assertEqual(dp.load_json(dp.data_file_path)['last_post_id'], -1)
+        next(posts)
+        # scraping is interrupted right after a post is yielded
+        posts.close()
+        self.assertEqual(dp.scrape_progress, 8811950)
+        dp.save_progress(8811102)
+        # next run resumes after the saved post
+        dp = self.create_parser({'tags': ['signalis']})
+        self.assertEqual(dp.file_data['last_post_id'], 8811102)
+        self.assertEqual([len(p.media_urls) for p in dp.scrape_posts()], [1, 2])
+
+    def test_or_query_pages_per_tag(self) -> None:
+        dp = self.create_parser({'tags': ['fune_(nkjrs12)', 'scenery'], 'max_pages': 1})
+        dp.api_page_limit = 2
+        self.assertEqual(dp.queries, ['~fune_(nkjrs12) ~scenery'])
+        posts = list(dp.scrape_posts())
+        # posts of the first tag fill the first page, posts of the second one are on the next
+        self.assertEqual([q['page'][0] for q in DanbooruStandIn.requests], ['1', '2'])
+        self.assertEqual(len(posts), 3)
+        self.assertEqual(dp.scrape_progress, 8812004)
+
+    def test_scrape_blacklisted(self) -> None:
+        dp = self.create_parser({
+            'tags': ['scenery'],
+            'blacklisted_tags': [['2girls', ['falke_(signalis)']]]
+        })
+        posts = list(dp.scrape_posts())
+        self.assertEqual(len(posts), 1)
+        self.assertEqual(posts[0].author_name, 'funkiflame')
+
+    def test_scrape_merged_tags(self) -> None:
+        dp = self.create_parser({'tags': ['scenery', 'fune_(nkjrs12)', 'scenery']})
+        posts = list(dp.scrape_posts())
+        # both tags are fetched with a single OR query
+        self.assertEqual(len(DanbooruStandIn.requests), 1)
+        self.assertEqual(DanbooruStandIn.requests[0]['tags'], ['~scenery ~fune_(nkjrs12)'])
+        self.assertEqual([len(p.media_urls) for p in posts], [1, 1, 2])
+
+    def test_merge_tag_queries(self) -> None:
+        self.assertEqual(
+            DanbooruParser.merge_tag_queries(['a', 'b', 'c d', 'e', '-f', 'rating:g'], 2),
+            ['c d', '-f', 'rating:g', '~a ~b', 'e']
+        )
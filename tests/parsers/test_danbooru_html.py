@@ -0,0 +1,62 @@
+from pathlib import Path
+from bs4 import BeautifulSoup
+import unittest
+
+import src.parse.danbooru as danbooru
+from src.parse import DanbooruParser
+
+fixtures_dir = Path(__file__).parent.joinpath('fixtures')
+
+class TestDanbooruHtml(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.post_html = fixtures_dir.joinpath('danbooru_post_page.html').read_text(encoding='utf-8')
+        cls.search_html = fixtures_dir.joinpath('danbooru_search_page.html').read_text(encoding='utf-8')
+
+    def test_post_page(self) -> None:
+        post, parent_id = DanbooruParser.parse_post_html(self.post_html)
+        self.assertEqual(parent_id, 8812003)
+        self.assertEqual(post.author_name, 'fune_(nkjrs12)')
+        self.assertEqual(post.source_link, 'https://x.com/fune_nkjrs12/status/1889471223081611390')
+        self.assertTrue(post.media_urls[0].endswith('sample-b5ba850240d4c1d967e0e32b4ff194d8.jpg'))
+        self.assertEqual(post.preview_urls, ('https://cdn.donmai.us/180x180/b5/ba/b5ba850240d4c1d967e0e32b4ff194d8.jpg', ))
+        self.assertEqual(post.digests, ('md5:b5ba850240d4c1d967e0e32b4ff194d8', ))
+        self.assertIn('elster_(signalis)', post.tags)
+
+    def test_post_page_without_parent_attributes(self) -> None:
+        html = self.post_html.replace('data-post-parent-id=', 'data-x=').replace('data-post-id=', 'data-y=')
+        post, parent_id = DanbooruParser.parse_post_html(html)
+        self.assertIsNone(parent_id)
+        self.assertEqual(post.author_name, 'fune_(nkjrs12)')
+
+    def test_preview_url(self) -> None:
+        self.assertEqual(
+            DanbooruParser.preview_url('https://cdn.donmai.us/original/14/17/__elster_drawn_by_legend_knit__14173148c25e6177e4edbfa90c32d4fb.png?x=1'),
+            'https://cdn.donmai.us/180x180/14/17/14173148c25e6177e4edbfa90c32d4fb.jpg'
+        )
+        self.assertIsNone(DanbooruParser.preview_url('https://example.com/image.jpg'))
+        self.assertIsNone(DanbooruParser.preview_url(None))
+
+    def test_fast_parsing_matches_full_tree(self) -> None:
+        full_post = DanbooruParser.post_from_soup(BeautifulSoup(self.post_html, features="html.parser"))
+        full_previews = DanbooruParser.previews_from_search_soup(BeautifulSoup(self.search_html, features="html.parser"))
+        for features in {"html.parser", danbooru.soup_features}:
+            old_features = danbooru.soup_features
+            danbooru.soup_features = features
+            try:
+                self.assertEqual(DanbooruParser.parse_post_html(self.post_html), full_post)
+                self.assertEqual(DanbooruParser.parse_search_html(self.search_html), full_previews)
+            finally:
+                danbooru.soup_features = old_features
+        self.assertEqual(len(full_previews), 20)
+
+    def test_search_page_previews(self) -> None:
+        previews = DanbooruParser.parse_search_html(self.search_html)
+        self.assertEqual(len(previews), 20)
+        first = previews[0]
+        self.assertEqual(first.post_id, 8812004)
+        self.assertEqual(first.url, 'https://danbooru.donmai.us/posts/8812004')
+        self.assertEqual(first.parent_id, 8812003)
+        self.assertEqual(first.rating, 'g')
+        self.assertIn('elster_(signalis)', first.tags)
+        self.assertIsNone(previews[1].parent_id)
@@ -0,0 +1,61 @@
+from tempfile import TemporaryDirectory
+from pathlib import Path
+import unittest
+
+from src.parse import Post
+from src.parse.post_store import PostStore
+
+class TestPostStore(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = TemporaryDirectory()
+        self.db_file = Path(self.tmp_dir.name).joinpath('post_store.db')
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    @staticmethod
+    def make_post(i: int) -> Post:
+        return Post(
+            media_urls=(f'https://cdn.donmai.us/sample/{i}.jpg', ),
+            author_name='fune_(nkjrs12)',
+            source_link=None,
+            tags=('signalis', 'elster_(signalis)'),
+            preview_urls=(f'https://cdn.donmai.us/180x180/{i}.jpg', ),
+            digests=(f'md5:{i:032x}', )
+        )
+
+    def test_persistence_and_stats(self) -> None:
+        store = PostStore(self.db_file, ttl=3600, max_posts=100)
+        self.assertIsNone(store.get('DanbooruParser', 1, 1))
+        store.put('DanbooruParser', 1, self.make_post(1), 8812003, 1)
+        store.con.close()
+
+        store = PostStore(self.db_file, ttl=3600, max_posts=100)
+        self.assertEqual(store.get('DanbooruParser', 1, 1), (self.make_post(1), 8812003))
+        # other sources and parser versions don't share posts
+        self.assertIsNone(store.get('OtherParser', 1, 1))
+        self.assertIsNone(store.get('DanbooruParser', 1, 2))
+        self.assertEqual(store.stats(), {'hits': 1, 'misses': 2, 'hit_rate': 0.333, 'posts': 1})
+
+    def test_expiration(self) -> None:
+        store = PostStore(self.db_file, ttl=0, max_posts=100)
+        store.put('DanbooruParser', 1, self.make_post(1), None, 1)
+        self.assertIsNone(store.get('DanbooruParser', 1, 1))
+
+    def test_eviction(self) -> None:
+        store = PostStore(self.db_file, ttl=3600, max_posts=3)
+        for i in range(3):
+            store.put('DanbooruParser', i, self.make_post(i), i, 1)
+        # 0 becomes the most recently used one
+        self.assertIsNotNone(store.get('DanbooruParser', 0, 1))
+        store.put('DanbooruParser', 3, self.make_post(3), 3, 1)
+        self.assertEqual(store.stats()['posts'], 3)
+        self.assertIsNone(store.get('DanbooruParser', 1, 1))
+        self.assertIsNotNone(store.get('DanbooruParser', 0, 1))
+
+    def test_expiration_uses_index(self) -> None:
+        store = PostStore(self.db_file, ttl=3600, max_posts=3)
+        plan = ' '.join(row[-1] for row in store.con.execute(
+            "EXPLAIN QUERY PLAN DELETE FROM posts WHERE fetched_at <= 0"
+        ))
+        self.assertIn('posts_fetched_at', plan)
@@ -1,7 +1,20 @@
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+from tempfile import TemporaryDirectory
+from functools import partial
+from threading import Thread
+from pathlib import Path
+import multiprocessing
 import unittest
+import sqlite3
 import os
 
-from src.dublicate_checker import DublicateChecker
+from PIL import Image, ImageDraw
+from io import BytesIO
+import imagehash
+
+from src.dublicate_checker import DublicateChecker, DedupeStage, ImageHashes, hash_image_file
+from src.request_utils import rate_limiter
+from src.parse import Post
 
 class TestDanbooruParser(unittest.TestCase):
     db_file = 'test_dummy.db'
@@ -42,3 +55,292 @@ class TestDanbooruParser(unittest.TestCase):
             self.assertTrue(ch.hash_exists(h))
 
         self.clear_dummy_db()
+
+class TestHashDb(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = TemporaryDirectory()
+        self.db_file = Path(self.tmp_dir.name).joinpath('image_hashes.db')
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def test_check_and_add_many(self) -> None:
+        ch = DublicateChecker(db_file=str(self.db_file))
+        matches = ch.check_and_add_many([
+            (ImageHashes(0xffd8e0c0c0c0e0ff, 0x1, 0xf0), 'a'),
+            (ImageHashes(0x0000000000001234, 0x2, 0xf1), 'b'),
+            # dublicate of a hash from the same batch
+            (ImageHashes(0xffd8e0c0c0c0e0fe, 0x3, 0xf2), 'c'),
+            # close by aHash only
+            (ImageHashes(0x0000000000001235, 0x2, 0xffffffff00000000), 'd')
+        ])
+        self.assertIsNone(matches[0])
+        self.assertIsNone(matches[1])
+        self.assertEqual((matches[2].img_hash, matches[2].source_link), (0xffd8e0c0c0c0e0ff, 'a'))
+        self.assertIsNone(matches[3])
+        # hashes are persisted as integers
+        ch = DublicateChecker(db_file=str(self.db_file))
+        self.assertTrue(ch.hash_exists(ImageHashes(0xffd8e0c0c0c0e0ff, 0x1, 0xf0)))
+        self.assertEqual(ch.con.execute("PRAGMA journal_mode").fetchone()[0], 'wal')
+
+    def test_text_hashes_migration(self) -> None:
+        con = sqlite3.connect(self.db_file)
+        con.execute("""
+            CREATE TABLE img_hashes (
+                img_hash TEXT PRIMARY KEY,
+                source_link TEXT,
+                matches INT DEFAULT 0 NOT NULL
+            )
+        """)
+        con.execute("INSERT INTO img_hashes VALUES('ffd8e0c0c0c0e0ff', 'a', 2)")
+        con.commit()
+        con.close()
+        ch = DublicateChecker(db_file=str(self.db_file))
+        # dHash and pHash are unknown for migrated hashes
+        match = ch.match_hash(ImageHashes(0xffd8e0c0c0c0e0ff, 0x1, 0x2))
+        self.assertEqual((match.img_hash, match.source_link), (0xffd8e0c0c0c0e0ff, 'a'))
+        self.assertEqual(ch.con.execute("SELECT matches FROM image_hashes").fetchone()[0], 3)
+
+    def test_remembered_verdicts(self) -> None:
+        ch = DublicateChecker(db_file=str(self.db_file))
+        ch.check_and_add_many([
+            (ImageHashes(0xffd8e0c0c0c0e0ff, 0x1, 0xf0), 'https://cdn.donmai.us/a.jpg'),
+            (ImageHashes(0xffd8e0c0c0c0e0fe, 0x1, 0xf0), 'https://cdn.donmai.us/b.jpg')
+        ])
+        verdicts = DublicateChecker(db_file=str(self.db_file)).remembered_verdicts([
+            'https://cdn.donmai.us/a.jpg?download=1', 'https://cdn.donmai.us/b.jpg', 'https://cdn.donmai.us/c.jpg'
+        ])
+        self.assertEqual(len(verdicts), 2)
+        self.assertIsNone(verdicts['https://cdn.donmai.us/a.jpg?download=1'].match)
+        self.assertEqual(verdicts['https://cdn.donmai.us/b.jpg'].hashes, ImageHashes(0xffd8e0c0c0c0e0fe, 0x1, 0xf0))
+        self.assertEqual(verdicts['https://cdn.donmai.us/b.jpg'].match.source_link, 'https://cdn.donmai.us/a.jpg')
+
+    def test_match_digests(self) -> None:
+        ch = DublicateChecker(db_file=str(self.db_file))
+        ch.check_and_add_many([
+            (ImageHashes(0xffd8e0c0c0c0e0ff), 'a'),
+            (ImageHashes(0xffd8e0c0c0c0e0fe), 'b'),
+            (ImageHashes(0x0000000000001234), 'c')
+        ], digests=['md5:a', 'md5:b'])
+        matches = ch.match_digests(['md5:a', 'md5:b', 'md5:c'])
+        self.assertEqual(set(matches), {'md5:a', 'md5:b'})
+        # digest of a dublicate points to the image it matched
+        self.assertEqual((matches['md5:b'].img_hash, matches['md5:b'].source_link), (0xffd8e0c0c0c0e0ff, 'a'))
+        self.assertEqual(matches['md5:b'].distance, 0)
+
+    def test_index_snapshot(self) -> None:
+        ch = DublicateChecker(db_file=str(self.db_file))
+        ch.check_and_add_many([(ImageHashes(0xffd8e0c0c0c0e0ff), 'a')])
+        ch.save_index_snapshot()
+        self.assertTrue(self.db_file.with_name('image_hashes.index.npz').is_file())
+        ch.add_hash(ImageHashes(0x0000000000001234), 'b')
+        # snapshot misses the last hash, so the index is built from the db
+        ch = DublicateChecker(db_file=str(self.db_file))
+        self.assertEqual(len(ch.index), 2)
+        with self.assertLogs('DublicateChecker', 'INFO') as logs:
+            self.assertEqual(len(DublicateChecker(db_file=str(self.db_file)).index), 2)
+        self.assertIn('Loaded index of 2 hashes', logs.output[-1])
+
+    def test_index_memory_budget(self) -> None:
+        ch = DublicateChecker(db_file=str(self.db_file))
+        ch.max_indexed_hashes = 1
+        ch.check_and_add_many([
+            (ImageHashes(0xffd8e0c0c0c0e0ff), 'a'),
+            (ImageHashes(0x0000000000001234), 'b')
+        ])
+        self.assertEqual(len(ch.index), 1)
+        # hashes out of the index are still matched exactly
+        self.assertEqual(ch.match_hash(ImageHashes(0x0000000000001234)).source_link, 'b')
+        self.assertIsNone(ch.match_hash(ImageHashes(0x0000000000001235)))
+
+    def test_replace_hash(self) -> None:
+        ch = DublicateChecker(db_file=str(self.db_file))
+        ch.check_and_add_many([
+            (ImageHashes(0xffd8e0c0c0c0e0ff, 0x1, 0xf0), 'a'),
+            (ImageHashes(0x0000000000001234, 0x2, 0xf1), 'b')
+        ])
+        image_id = ch.con.execute("SELECT id FROM image_hashes WHERE source_link = 'a'").fetchone()[0]
+        ch.replace_hash(image_id, ImageHashes(0x0f0f0f0f0f0f0f0f, 0x3, 0xf2))
+        self.assertEqual(ch.match_hash(ImageHashes(0x0f0f0f0f0f0f0f0f)).source_link, 'a')
+        self.assertIsNone(ch.match_hash(ImageHashes(0xffd8e0c0c0c0e0ff)))
+        # rehashed into stored hashes, rows are merged
+        ch.replace_hash(image_id, ImageHashes(0x0000000000001234, 0x2, 0xf1))
+        self.assertEqual(ch.con.execute("SELECT source_link, matches FROM image_hashes").fetchall(), [('b', 2)])
+
+    def test_same_ahash_different_images(self) -> None:
+        ch = DublicateChecker(db_file=str(self.db_file))
+        self.assertEqual(ch.check_and_add_many([(ImageHashes(0x1234, 0, 0), 'a')]), [None])
+        # aHash matches, but dHash and pHash don't, so it's a new image and it is stored too
+        self.assertEqual(ch.check_and_add_many([(ImageHashes(0x1234, 2**64 - 1, 2**64 - 1), 'b')]), [None])
+        self.assertEqual(ch.con.execute("SELECT COUNT(*) FROM image_hashes").fetchone()[0], 2)
+        self.assertEqual(len(ch.index), 1)
+        # both images are matched afterwards, also after the index is reloaded
+        for checker in (ch, DublicateChecker(db_file=str(self.db_file))):
+            self.assertEqual(checker.match_hash(ImageHashes(0x1234, 2**64 - 1, 2**64 - 1)).source_link, 'b')
+            self.assertEqual(checker.match_hash(ImageHashes(0x1234, 0, 0)).source_link, 'a')
+
+    def test_ahash_keyed_migration(self) -> None:
+        con = sqlite3.connect(self.db_file)
+        con.executescript("""
+            CREATE TABLE image_hashes (
+                img_hash INTEGER PRIMARY KEY,
+                dhash INTEGER,
+                phash INTEGER,
+                source_link TEXT,
+                matches INT DEFAULT 0 NOT NULL
+            );
+            CREATE TABLE image_digests (digest TEXT PRIMARY KEY, img_hash INTEGER NOT NULL);
+            INSERT INTO image_hashes VALUES(4660, 0, 0, 'a', 2);
+            INSERT INTO image_digests VALUES('md5:a', 4660);
+            PRAGMA user_version = 2;
+        """)
+        con.close()
+        ch = DublicateChecker(db_file=str(self.db_file))
+        self.assertEqual(ch.match_digests(['md5:a'])['md5:a'].source_link, 'a')
+        ch.check_and_add_many([(ImageHashes(0x1234, 2**64 - 1, 2**64 - 1), 'b')])
+        self.assertEqual(ch.con.execute("SELECT id, source_link, matches FROM image_hashes").fetchall(), [
+            (1, 'a', 3), (2, 'b', 0)
+        ])
+        self.assertIn('image_hashes_img_hash', [
+            row[0] for row in ch.con.execute("SELECT name FROM sqlite_master WHERE type = 'index'")
+        ])
+
+class TestHashing(unittest.TestCase):
+    @staticmethod
+    def make_image(image_format: str) -> bytes:
+        img = Image.new('RGB', (1200, 800), (200, 40, 40))
+        draw = ImageDraw.Draw(img)
+        draw.ellipse([100, 100, 700, 600], fill=(20, 120, 220))
+        draw.rectangle([600, 300, 1100, 750], fill=(240, 230, 40))
+        buffer = BytesIO()
+        img.save(buffer, image_format)
+        return buffer.getvalue()
+
+    def test_matches_imagehash(self) -> None:
+        data = self.make_image('PNG')
+        hashes = hash_image_file(BytesIO(data))
+        with Image.open(BytesIO(data)) as img:
+            self.assertEqual(hashes.ahash, int(str(imagehash.average_hash(img)), 16))
+            self.assertEqual(hashes.dhash, int(str(imagehash.dhash(img)), 16))
+            self.assertEqual(hashes.phash, int(str(imagehash.phash(img)), 16))
+
+    def test_jpeg_draft_is_close_to_full_decode(self) -> None:
+        data = self.make_image('JPEG')
+        hashes = hash_image_file(BytesIO(data))
+        with Image.open(BytesIO(data)) as img:
+            self.assertLessEqual((hashes.ahash ^ int(str(imagehash.average_hash(img)), 16)).bit_count(), 2)
+            self.assertLessEqual((hashes.phash ^ int(str(imagehash.phash(img)), 16)).bit_count(), 2)
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+class TestDedupeStage(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = TemporaryDirectory()
+        images_dir = Path(self.tmp_dir.name)
+        for i, color in enumerate([(200, 40, 40), (40, 200, 40), (40, 40, 200)]):
+            img = Image.new('RGB', (600, 400), color)
+            ImageDraw.Draw(img).ellipse([50 * i, 50, 300 + 50 * i, 350], fill=(250, 250, 250))
+            img.save(images_dir.joinpath(f'{i}.jpg'))
+        self.images = [images_dir.joinpath(f'{i}.jpg').read_bytes() for i in range(3)]
+        self.server = HTTPServer(('127.0.0.1', 0), partial(QuietHandler, directory=str(images_dir)))
+        host = f'127.0.0.1:{self.server.server_port}'
+        rate_limiter.configure(host, rate=1000, burst=100)
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = lambda i: f'http://{host}/{i}.jpg'
+        self.checker = DublicateChecker(db_file=str(images_dir.joinpath('image_hashes.db')))
+
+    def tearDown(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp_dir.cleanup()
+
+    def test_dublicates_between_posts_of_a_batch(self) -> None:
+        posts = [
+            Post(media_urls=(self.url(0), self.url(1))),
+            Post(media_urls=(self.url(2), self.url(0))),
+            Post(media_urls=(self.url(1), )),
+        ]
+        with DedupeStage(self.checker, download_workers=4, hash_workers=0) as dedupe:
+            filtered = list(dedupe.filter_posts(posts))
+        self.assertEqual(filtered[0], posts[0])
+        self.assertEqual(filtered[1].media_urls, (self.url(2), ))
+        self.assertEqual(filtered[2].media_urls, ())
+
+    def test_hash_workers(self) -> None:
+        posts = [
+            Post(media_urls=(self.url(0), self.url(1))),
+            Post(media_urls=(self.url(2), self.url(0))),
+        ]
+        # images are hashed in download threads by default, no processes are started
+        with DedupeStage(self.checker, download_workers=4) as dedupe:
+            inline = list(dedupe.filter_posts(posts))
+            self.assertEqual(multiprocessing.active_children(), [])
+        self.assertEqual(inline[1].media_urls, (self.url(2), ))
+        # hashing processes give the same hashes
+        checker = DublicateChecker(db_file=str(Path(self.tmp_dir.name).joinpath('processes.db')))
+        with DedupeStage(checker, download_workers=4, hash_workers=1) as dedupe:
+            self.assertEqual(list(dedupe.filter_posts(posts)), inline)
+        self.assertEqual(
+            checker.con.execute("SELECT img_hash, dhash, phash FROM image_hashes ORDER BY id").fetchall(),
+            self.checker.con.execute("SELECT img_hash, dhash, phash FROM image_hashes ORDER BY id").fetchall()
+        )
+
+    def test_checked_urls_are_dublicates(self) -> None:
+        posts = [
+            Post(media_urls=(self.url(0), self.url(1))),
+            Post(media_urls=(self.url(1), )),
+        ]
+        with DedupeStage(self.checker, download_workers=4, hash_workers=0) as dedupe:
+            first = list(dedupe.filter_posts(posts))
+        self.assertEqual(first[0].media_urls, (self.url(0), self.url(1)))
+        self.assertEqual(first[1].media_urls, ())
+        # re-scraped posts were posted already, images are not downloaded again
+        for i in range(3):
+            Path(self.tmp_dir.name).joinpath(f'{i}.jpg').unlink()
+        with DedupeStage(self.checker, download_workers=4, hash_workers=0) as dedupe:
+            second = list(dedupe.filter_posts(posts))
+        self.assertEqual([post.media_urls for post in second], [(), ()])
+
+    def test_failed_images_are_not_checked(self) -> None:
+        Path(self.tmp_dir.name).joinpath('broken.jpg').write_bytes(b'not an image')
+        post = Post(media_urls=(self.url('missing'), self.url('broken'), self.url(0)))
+        with DedupeStage(self.checker, download_workers=4, hash_workers=0) as dedupe:
+            with self.assertLogs('DublicateChecker', 'WARNING') as logs:
+                filtered = list(dedupe.filter_posts([post]))
+        # images that can't be downloaded or decoded are kept unchecked, the rest are checked
+        self.assertEqual(filtered, [post])
+        self.assertEqual(len(logs.output), 2)
+        self.assertEqual(self.checker.con.execute("SELECT source_link FROM image_hashes").fetchall(), [(self.url(0), )])
+
+    def test_known_digests_are_not_downloaded(self) -> None:
+        with DedupeStage(self.checker, download_workers=4, hash_workers=0) as dedupe:
+            list(dedupe.filter_posts([Post(media_urls=(self.url(0), ), digests=('md5:0', ))]))
+            # the file is missing, so it would fail if it was downloaded
+            filtered = list(dedupe.filter_posts([
+                Post(media_urls=(self.url('missing'), self.url(1)), digests=('md5:0', None))
+            ]))
+        self.assertEqual(filtered[0].media_urls, (self.url(1), ))
+        self.assertEqual(filtered[0].digests, (None, ))
+
+    def test_previews_are_hashed(self) -> None:
+        posts = [
+            Post(media_urls=(self.url('full_0'), ), preview_urls=(self.url(0), )),
+            Post(media_urls=(self.url(0), self.url('full_1')), preview_urls=(None, self.url(1))),
+        ]
+        with DedupeStage(self.checker, download_workers=4, hash_workers=0) as dedupe:
+            filtered = list(dedupe.filter_posts(posts))
+        self.assertEqual(filtered[0], posts[0])
+        # media url is hashed when there is no preview
+        self.assertEqual(filtered[1].media_urls, (self.url('full_1'), ))
+        self.assertEqual(filtered[1].preview_urls, (self.url(1), ))
+        self.assertEqual(self.checker.match_hash(hash_image_file(BytesIO(self.images[1]))).source_link, self.url('full_1'))
+
+    def test_missing_preview(self) -> None:
+        post = Post(media_urls=(self.url(0), ), preview_urls=(self.url('missing'), ))
+        with DedupeStage(self.checker, download_workers=4, hash_workers=0) as dedupe:
+            filtered = list(dedupe.filter_posts([post]))
+        # the preview is 404, so the media is hashed instead
+        self.assertEqual(filtered, [post])
+        self.assertEqual(self.checker.match_hash(hash_image_file(BytesIO(self.images[0]))).source_link, self.url(0))
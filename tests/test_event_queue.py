@@ -0,0 +1,38 @@
+from threading import Thread
+import datetime as dt
+import unittest
+import time
+
+from src.manager.event_queue import EventQueue
+
+class TestEventQueue(unittest.TestCase):
+    def test_pop_due_in_order(self) -> None:
+        queue = EventQueue()
+        now = dt.datetime.now()
+        for minutes, event in ((3, 'c'), (-1, 'a'), (10, 'd'), (0, 'b'), (0, 'b2')):
+            queue.push(now + dt.timedelta(minutes=minutes), event)
+        self.assertEqual([event for _, event in queue.pop_due(now)], ['a', 'b', 'b2'])
+        self.assertEqual(queue.next_due(), now + dt.timedelta(minutes=3))
+        self.assertEqual(len(queue), 2)
+        self.assertEqual({event for _, event in queue}, {'c', 'd'})
+
+    def test_wait_till_due(self) -> None:
+        queue = EventQueue()
+        queue.push(dt.datetime.now() + dt.timedelta(seconds=0.2), 'a')
+        started = time.monotonic()
+        queue.wait(max_timeout=5)
+        self.assertGreaterEqual(time.monotonic() - started, 0.15)
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertEqual(len(queue.pop_due()), 1)
+
+    def test_push_wakes_wait(self) -> None:
+        queue = EventQueue()
+        queue.push(dt.datetime.now() + dt.timedelta(hours=1), 'later')
+        def push_soon():
+            time.sleep(0.1)
+            queue.push(dt.datetime.now(), 'now')
+        Thread(target=push_soon).start()
+        started = time.monotonic()
+        queue.wait()
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertEqual([event for _, event in queue.pop_due()], ['now'])
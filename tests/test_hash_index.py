@@ -0,0 +1,69 @@
+from tempfile import TemporaryDirectory
+from pathlib import Path
+import random
+import unittest
+
+from src.dublicate_checker import HashIndex
+
+class TestHashIndex(unittest.TestCase):
+    @staticmethod
+    def flip_bits(img_hash: int, count: int) -> int:
+        for bit in random.sample(range(64), count):
+            img_hash ^= 1 << bit
+        return img_hash
+
+    def test_exact_match(self) -> None:
+        index = HashIndex(max_distance=0, hashes=[0xffd8e0c0c0c0e0ff])
+        self.assertEqual(index.nearest(0xffd8e0c0c0c0e0ff), (0xffd8e0c0c0c0e0ff, 0))
+        self.assertIsNone(index.nearest(0xffd8e0c0c0c0e0fe))
+
+    def test_matches_brute_force(self) -> None:
+        random.seed(0)
+        for max_distance in (3, 4, 9):
+            hashes = [random.getrandbits(64) for _ in range(2000)]
+            index = HashIndex(max_distance=max_distance, hashes=hashes)
+            queries = [self.flip_bits(random.choice(hashes), random.randint(0, max_distance + 2))
+                       for _ in range(300)]
+            for query in queries:
+                distances = [(h ^ query).bit_count() for h in hashes]
+                closest = min(distances)
+                found = index.nearest(query)
+                if closest > max_distance:
+                    self.assertIsNone(found)
+                else:
+                    self.assertIsNotNone(found)
+                    self.assertEqual(found[1], closest)
+                    self.assertEqual((found[0] ^ query).bit_count(), closest)
+
+    def test_added_hashes_are_merged(self) -> None:
+        random.seed(1)
+        hashes = [random.getrandbits(64) for _ in range(300)]
+        index = HashIndex(max_distance=4, hashes=hashes[:100])
+        index.merge_threshold = 64
+        for img_hash in hashes[100:]:
+            index.add(img_hash)
+        self.assertEqual(len(index), 300)
+        for img_hash in hashes:
+            self.assertIn(img_hash, index)
+            self.assertEqual(index.nearest(self.flip_bits(img_hash, 2))[0], img_hash)
+
+    def test_snapshot(self) -> None:
+        random.seed(2)
+        hashes = [random.getrandbits(64) for _ in range(1000)]
+        index = HashIndex(max_distance=4, hashes=hashes[:900])
+        for img_hash in hashes[900:]:
+            index.add(img_hash)
+        with TemporaryDirectory() as tmp_dir:
+            file = Path(tmp_dir).joinpath('index.npz')
+            index.save(file, count=1000)
+            loaded, metadata = HashIndex.load(file, max_distance=4)
+        self.assertEqual(metadata, {'count': 1000})
+        self.assertEqual(len(loaded), 1000)
+        self.assertEqual(loaded.nbytes, 1000 * 32 + (4 * 2**16 + 1) * 8)
+        for img_hash in random.sample(hashes, 100):
+            query = self.flip_bits(img_hash, 3)
+            self.assertEqual(loaded.nearest(query), (img_hash, 3))
+
+    def test_invalid_distance(self) -> None:
+        with self.assertRaises(ValueError):
+            HashIndex(max_distance=64)
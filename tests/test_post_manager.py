@@ -0,0 +1,205 @@
+from tempfile import TemporaryDirectory
+from dataclasses import replace
+from typing import Callable, List, Optional
+from threading import Thread
+from pathlib import Path
+import unittest
+import json
+import time
+import os
+
+from src.config import config_dir, data_dir
+from src.dublicate_checker import DublicateChecker
+from src.manager import PostManager
+from src.manager.post_manager import UpdateEvent
+from src.parse import BaseParser, Post
+
+class FakeParser(BaseParser):
+    """Yields given posts, progress is the index of the last yielded post"""
+    def __init__(self, posts: List[Post], on_save: Optional[Callable[[int], None]] = None) -> None:
+        self.posts = posts
+        self.on_save = on_save
+        self.saved: List[int] = []
+        self.yielded = 0
+
+    def scrape_posts(self, deadline: Optional[float] = None):
+        for i, post in enumerate(self.posts):
+            self.scrape_progress = i
+            self.yielded += 1
+            yield post
+
+    def save_progress(self, progress: int) -> None:
+        if self.on_save is not None:
+            self.on_save(progress)
+        self.saved.append(progress)
+
+class SlowParser(FakeParser):
+    """Yields its first post, the rest are fetched for longer than the test's parser_timeout"""
+    def scrape_posts(self, deadline: Optional[float] = None):
+        self.scrape_progress = 0
+        yield self.posts[0]
+        def fetch(post: Post) -> Post:
+            time.sleep(2)
+            return post
+        for i, post in enumerate(self.fetch_many(self.posts[1:], fetch, deadline=deadline), start=1):
+            self.scrape_progress = i
+            yield post
+
+class TestPostManager(unittest.TestCase):
+    config_file = 'test_scheduler_conf.json'
+    schedule_file = 'test_schedule.json'
+    source_index_file = 'test_source_index.db'
+
+    def setUp(self) -> None:
+        self.tmp_dir = TemporaryDirectory()
+        self.manager = self.create_manager(skip_known_sources=True)
+
+    def create_manager(self, skip_known_sources: bool) -> PostManager:
+        with open(config_dir.joinpath(self.config_file), 'w', encoding='utf-8') as f:
+            json.dump({
+                'update_time': ['09:00', '18:00'],
+                'check_interval': 60,
+                'parser_timeout': 0.5,
+                'skip_known_sources': skip_known_sources
+            }, f)
+        manager = PostManager(
+            config_file=self.config_file,
+            schedule_file=self.schedule_file,
+            source_index_file=self.source_index_file
+        )
+        manager.dub_checker = DublicateChecker(db_file=str(Path(self.tmp_dir.name).joinpath('hashes.db')))
+        return manager
+
+    def tearDown(self) -> None:
+        self.manager.source_index.con.close()
+        for file in (
+            config_dir.joinpath(self.config_file),
+            data_dir.joinpath(self.schedule_file),
+            data_dir.joinpath(self.schedule_file + '.journal'),
+            data_dir.joinpath(self.source_index_file)
+        ):
+            if file.is_file():
+                os.remove(file)
+        self.tmp_dir.cleanup()
+
+    @staticmethod
+    def make_posts(n: int, start: int = 0) -> List[Post]:
+        # gifs are not hashed, so nothing is downloaded
+        return [Post(media_urls=(f'https://cdn.donmai.us/original/{i}.gif', ), tags=()) for i in range(start, start + n)]
+
+    def saved_media_urls(self) -> List[str]:
+        """Media urls of posts that a restarted manager would load"""
+        manager = PostManager(
+            config_file=self.config_file,
+            schedule_file=self.schedule_file,
+            source_index_file=self.source_index_file
+        )
+        manager.source_index.con.close()
+        return [url for _, post in manager.post_schedule for url in post.media_urls]
+
+    def test_progress_is_saved_after_schedule(self) -> None:
+        posts = self.make_posts(5)
+        def on_save(progress: int) -> None:
+            # every post up to the progress is in the schedule file by then
+            saved = self.saved_media_urls()
+            for post in posts[:progress + 1]:
+                self.assertIn(post.media_urls[0], saved)
+        parser = FakeParser(posts, on_save)
+        self.manager.add_parser(parser)
+        self.manager._PostManager__update(UpdateEvent(0))
+        self.assertEqual(parser.saved[-1], 4)
+        # post times keep the scraped order
+        scheduled = sorted(self.manager.post_schedule, key=lambda x: x[0])
+        self.assertEqual([post for _, post in scheduled], posts)
+
+    def test_schedule_journal(self) -> None:
+        posts = self.make_posts(3)
+        saved_files = []
+        def on_save(progress: int) -> None:
+            # incoming posts are appended to the journal instead of rewriting the schedule
+            saved_files.append(data_dir.joinpath(self.schedule_file + '.journal').is_file())
+        self.manager.add_parser(FakeParser(posts, on_save))
+        self.manager._PostManager__update(UpdateEvent(0))
+        self.assertTrue(all(saved_files))
+        # the journal is merged into the schedule file once the update is done
+        self.assertFalse(data_dir.joinpath(self.schedule_file + '.journal').exists())
+        self.assertFalse(data_dir.joinpath(self.schedule_file + '.tmp').exists())
+        with open(data_dir.joinpath(self.schedule_file), 'r', encoding='utf-8') as f:
+            self.assertEqual(len(json.load(f)), 3)
+        # an update interrupted by a crash, its last line is cut
+        with open(data_dir.joinpath(self.schedule_file + '.journal'), 'a', encoding='utf-8') as f:
+            f.write(json.dumps({'timestamp': '2030-01-01 10:00', 'post': {
+                'media_urls': ['https://cdn.donmai.us/original/new.gif'],
+                'author_name': None, 'source_link': None, 'tags': []
+            }}) + '\n')
+            f.write('{"timestamp": "2030-01-01 11:0')
+        self.assertEqual(sorted(self.saved_media_urls()), sorted(
+            [post.media_urls[0] for post in posts] + ['https://cdn.donmai.us/original/new.gif']
+        ))
+        self.assertFalse(data_dir.joinpath(self.schedule_file + '.journal').exists())
+
+    def test_progress_of_unsaved_posts(self) -> None:
+        parser = FakeParser(self.make_posts(3))
+        self.manager.add_parser(parser)
+        posts = self.manager.gather_new_posts()
+        next(posts)
+        # caller hasn't saved the first post yet
+        self.assertEqual(parser.saved, [])
+        next(posts)
+        self.assertEqual(parser.saved, [0])
+        # update is interrupted, the second post is scraped again next time
+        posts.close()
+        self.assertEqual(parser.saved, [0])
+
+    def test_parser_timeout(self) -> None:
+        slow_parser = SlowParser(self.make_posts(3))
+        parser = FakeParser(self.make_posts(2, start=3))
+        self.manager.add_parser(slow_parser)
+        self.manager.add_parser(parser)
+        started = time.monotonic()
+        with self.assertLogs('PostManager', level='ERROR') as logs:
+            posts = list(self.manager.gather_new_posts())
+        # slow fetches are not waited for
+        self.assertLess(time.monotonic() - started, 1.5)
+        self.assertIn('SlowParser timed out', '\n'.join(logs.output))
+        # the other parser and the post scraped in time are kept
+        self.assertEqual(
+            sorted(post.media_urls[0] for post in posts),
+            sorted(post.media_urls[0] for post in slow_parser.posts[:1] + parser.posts)
+        )
+        self.assertEqual(slow_parser.saved[-1], 0)
+        self.assertEqual(parser.saved[-1], 1)
+
+    def test_parsers_stop_with_update(self) -> None:
+        parser = FakeParser(self.make_posts(100))
+        self.manager.add_parser(parser)
+        posts = self.manager.gather_new_posts()
+        next(posts)
+        # update fails, parser is stopped instead of scraping the rest
+        posts.close()
+        self.assertLess(parser.yielded, 100)
+        self.assertEqual(parser.saved, [])
+
+    def test_sources_are_recorded_without_skipping(self) -> None:
+        self.manager.source_index.con.close()
+        self.manager = self.create_manager(skip_known_sources=False)
+        posts = [replace(post, source_link='https://x.com/a/status/1') for post in self.make_posts(2)]
+        self.manager.add_parser(FakeParser(posts))
+        self.manager._PostManager__update(UpdateEvent(0))
+        # both posts of the artwork are scheduled, it is recorded anyway
+        self.assertEqual(len(self.manager.post_schedule), 2)
+        self.assertTrue(self.manager.source_index.contains('https://twitter.com/b/status/1'))
+        # once skipping is enabled, recorded artworks are skipped
+        self.manager.source_index.con.close()
+        self.manager = self.create_manager(skip_known_sources=True)
+        self.manager.add_parser(FakeParser([replace(post, source_link='https://x.com/a/status/1') for post in self.make_posts(1, start=2)]))
+        self.assertEqual(list(self.manager.gather_new_posts()), [])
+
+    def test_stop_main_loop(self) -> None:
+        self.manager.add_parser(FakeParser([]))
+        loop = Thread(target=self.manager.main_loop)
+        loop.start()
+        time.sleep(0.1)
+        self.manager.stop()
+        loop.join(timeout=2)
+        self.assertFalse(loop.is_alive())
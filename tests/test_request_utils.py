@@ -0,0 +1,141 @@
+from tempfile import TemporaryDirectory
+from time import monotonic, sleep
+from threading import Thread
+from pathlib import Path
+import asyncio
+import unittest
+
+from src.request_utils.ratelimit import TokenBucket, HostRateLimiter
+from src.request_utils.cache import HttpCache
+from src.request_utils.retry import RetryPolicy, CircuitBreaker, CircuitOpenError
+import requests
+
+class TestRateLimiter(unittest.TestCase):
+    def test_burst_is_not_delayed(self) -> None:
+        bucket = TokenBucket(rate=1, burst=3)
+        waits = [bucket.reserve() for _ in range(3)]
+        self.assertEqual(waits, [0, 0, 0])
+        self.assertGreater(bucket.reserve(), 0.9)
+
+    def test_threads_share_one_budget(self) -> None:
+        bucket = TokenBucket(rate=20, burst=1)
+        start = monotonic()
+        threads = [Thread(target=bucket.acquire) for _ in range(5)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        # 1 token at once and 4 more refilled at 20 tokens/sec
+        self.assertGreaterEqual(monotonic() - start, 4 / 20 - 0.01)
+
+    def test_async_acquire(self) -> None:
+        bucket = TokenBucket(rate=20, burst=2)
+        async def acquire_all():
+            await asyncio.gather(*[bucket.acquire_async() for _ in range(4)])
+        start = monotonic()
+        asyncio.run(acquire_all())
+        self.assertGreaterEqual(monotonic() - start, 2 / 20 - 0.01)
+
+    def test_hosts_are_independent(self) -> None:
+        limiter = HostRateLimiter(default_rate=0.1)
+        limiter.load_config({'cdn.example.com': {'rate': 100, 'burst': 5}})
+        self.assertEqual(limiter.bucket('https://example.com/posts').reserve(), 0)
+        self.assertEqual(limiter.bucket('https://cdn.example.com/a.jpg').reserve(), 0)
+        self.assertGreater(limiter.bucket('https://example.com/posts/1').reserve(), 9)
+        self.assertEqual(limiter.bucket('https://cdn.example.com/b.jpg').reserve(), 0)
+
+class TestHttpCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = TemporaryDirectory()
+        self.db_file = Path(self.tmp_dir.name).joinpath('cache.db')
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def test_max_age(self) -> None:
+        self.assertEqual(HttpCache.parse_max_age({'Cache-Control': 'public, max-age=60'}), 60)
+        self.assertEqual(HttpCache.parse_max_age({'Cache-Control': 'max-age=60', 'Age': '50'}), 10)
+        self.assertEqual(HttpCache.parse_max_age({'Cache-Control': 'no-cache'}), 0)
+        self.assertIsNone(HttpCache.parse_max_age({'Cache-Control': 'no-store'}))
+        self.assertEqual(HttpCache.parse_max_age({}), 0)
+
+    def test_store_and_revalidate(self) -> None:
+        cache = HttpCache(self.db_file, max_bytes=1000)
+        cache.store('https://a/1', 'body', {'ETag': '"x"', 'Cache-Control': 'max-age=0'})
+        entry = cache.get('https://a/1')
+        self.assertEqual(entry.body, 'body')
+        self.assertFalse(entry.is_fresh())
+        self.assertEqual(entry.validators(), {'If-None-Match': '"x"'})
+        cache.refresh('https://a/1', {'Cache-Control': 'max-age=100'})
+        self.assertTrue(cache.get('https://a/1').is_fresh())
+        # responses without validators or with no-store are useless to keep
+        cache.store('https://a/2', 'body', {})
+        cache.store('https://a/3', 'body', {'ETag': '"y"', 'Cache-Control': 'no-store'})
+        self.assertIsNone(cache.get('https://a/2'))
+        self.assertIsNone(cache.get('https://a/3'))
+
+    def test_persistent_lru_eviction(self) -> None:
+        cache = HttpCache(self.db_file, max_bytes=25)
+        for i in range(3):
+            cache.store(f'https://a/{i}', 'x' * 10, {'ETag': f'"{i}"'})
+            # touching the first entry so it is the most recently used
+            cache.get('https://a/0')
+        self.assertIsNotNone(cache.get('https://a/0'))
+        self.assertIsNone(cache.get('https://a/1'))
+        self.assertIsNotNone(cache.get('https://a/2'))
+        cache.con.close()
+        cache = HttpCache(self.db_file, max_bytes=25)
+        self.assertEqual(cache.stats()['bytes'], 20)
+        self.assertEqual(cache.get('https://a/2').etag, '"2"')
+
+class TestRetryPolicy(unittest.TestCase):
+    @staticmethod
+    def failing(times: int, exception: Exception):
+        calls = []
+        def func():
+            calls.append(1)
+            if len(calls) <= times:
+                raise exception
+            return len(calls)
+        return func, calls
+
+    def test_backoff_is_capped(self) -> None:
+        policy = RetryPolicy(base_delay=1, max_delay=5)
+        for attempt in range(10):
+            self.assertLessEqual(policy.backoff(attempt), 5)
+        self.assertEqual(policy.backoff(0, retry_after=3), 3)
+
+    def test_retries_connection_errors(self) -> None:
+        policy = RetryPolicy(max_retries=3, base_delay=0.001)
+        func, calls = self.failing(2, requests.exceptions.ConnectionError())
+        self.assertEqual(policy.call('host', func), 3)
+
+    def test_does_not_retry_unknown_errors(self) -> None:
+        policy = RetryPolicy(max_retries=3, base_delay=0.001)
+        func, calls = self.failing(2, KeyError())
+        with self.assertRaises(KeyError):
+            policy.call('host', func)
+        self.assertEqual(len(calls), 1)
+
+    def test_too_long_retry_after_fails_fast(self) -> None:
+        policy = RetryPolicy(max_retries=3, max_delay=1, classify=lambda e: (True, 100, True))
+        func, calls = self.failing(2, ValueError())
+        with self.assertRaises(ValueError):
+            policy.call('host', func)
+        self.assertEqual(len(calls), 1)
+
+    def test_circuit_breaker(self) -> None:
+        policy = RetryPolicy(
+            max_retries=10, base_delay=0.001,
+            breaker=CircuitBreaker(threshold=3, cooldown=0.05)
+        )
+        func, calls = self.failing(100, requests.exceptions.ConnectionError())
+        with self.assertRaises(CircuitOpenError):
+            policy.call('host', func)
+        self.assertEqual(len(calls), 3)
+        # other hosts are not affected
+        self.assertEqual(policy.call('other', lambda: 1), 1)
+        with self.assertRaises(CircuitOpenError):
+            policy.call('host', lambda: 1)
+        # trial call after cooldown closes the circuit
+        sleep(0.06)
+        self.assertEqual(policy.call('host', lambda: 1), 1)
+        self.assertEqual(policy.call('host', lambda: 2), 2)
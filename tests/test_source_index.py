@@ -0,0 +1,53 @@
+from tempfile import TemporaryDirectory
+from pathlib import Path
+import unittest
+
+from src.manager.source_index import SourceIndex, source_identity
+
+class TestSourceIndex(unittest.TestCase):
+    def test_source_identity(self) -> None:
+        same_artworks = [
+            ('pixiv', '127045512', [
+                'https://www.pixiv.net/artworks/127045512',
+                'https://www.pixiv.net/en/artworks/127045512',
+                'https://www.pixiv.net/member_illust.php?mode=medium&illust_id=127045512',
+            ]),
+            ('pixiv', '127045512:1', [
+                'https://i.pximg.net/img-original/img/2025/02/12/00/00/00/127045512_p1.png',
+                'https://i.pximg.net/img-master/img/2025/02/12/00/00/00/127045512_p1_master1200.jpg',
+            ]),
+            ('twitter', '1889471223081611390', [
+                'https://x.com/fune_nkjrs12/status/1889471223081611390',
+                'https://mobile.twitter.com/i/web/status/1889471223081611390',
+            ]),
+            ('twitter', '1889471223081611390:2', [
+                'https://twitter.com/fune_nkjrs12/status/1889471223081611390/photo/2',
+                'https://x.com/fune_nkjrs12/status/1889471223081611390/photo/2',
+            ]),
+            ('artstation', 'aB3xYz', [
+                'https://www.artstation.com/artwork/aB3xYz',
+                'https://someone.artstation.com/projects/aB3xYz',
+            ]),
+        ]
+        for platform, artwork_id, links in same_artworks:
+            for link in links:
+                self.assertEqual(source_identity(link), (platform, artwork_id), link)
+        self.assertIsNone(source_identity(None))
+        self.assertIsNone(source_identity('https://www.pixiv.net/users/123'))
+        self.assertIsNone(source_identity('https://example.com/artworks/1'))
+
+    def test_persistence(self) -> None:
+        with TemporaryDirectory() as tmp_dir:
+            db_file = Path(tmp_dir).joinpath('source_index.db')
+            index = SourceIndex(db_file)
+            index.add_many(['https://x.com/a/status/1', None, 'https://example.com/1'])
+            index.con.close()
+            index = SourceIndex(db_file)
+            self.assertTrue(index.contains('https://twitter.com/b/status/1'))
+            self.assertFalse(index.contains('https://x.com/a/status/2'))
+            # other pages of an artwork are not known
+            index.add_many(['https://i.pximg.net/img-original/img/2025/02/12/00/00/00/5_p0.png'])
+            self.assertTrue(index.contains('https://i.pximg.net/img-master/img/2025/02/12/00/00/00/5_p0_master1200.jpg'))
+            self.assertFalse(index.contains('https://i.pximg.net/img-original/img/2025/02/12/00/00/00/5_p1.png'))
+            self.assertFalse(index.contains('https://example.com/1'))
+            index.con.close()